@@ -0,0 +1,259 @@
+"""
+Headless JSON API di atas backend.py untuk integrasi (Sales App, job reporting, bulk client).
+
+Jalankan terpisah dari Streamlit, dari root project (butuh .streamlit/secrets.toml yang sama):
+    python api.py --port 8502
+
+Autentikasi: header "X-API-Key", daftar key di secrets.toml:
+    [api]
+    keys = ["key-sales-app", "key-reporting"]
+
+POST dengan "submission_id" (unik per submit dari client) aman di-retry: submit ulang dengan
+ID yang sama mengembalikan response pertama tanpa membuat data dobel.
+
+Format response: JSON (gzip otomatis jika client mengirim Accept-Encoding: gzip),
+atau Arrow IPC stream untuk endpoint list dengan ?format=arrow
+atau header Accept: application/vnd.apache.arrow.stream.
+
+Endpoint:
+    GET   /api/health                         selalu 200; state circuit breaker & read_only di body
+    GET   /api/pool
+    GET   /api/opportunities                  filter (slicer tab3) + sort + page/page_size
+    GET   /api/opportunities/aggregate        pipeline cube (pillar, stage, salesgroup_id, start/end)
+    GET   /api/opportunities/by-id/<opp_id>   semua line satu opportunity
+    GET   /api/opportunities/<uid>
+    POST  /api/opportunities                  {"parent": {...}, "lines": [...], "submission_id"?}
+    PATCH /api/opportunities/<uid>            {"cost": .., "notes": .., "user": ..}
+    PATCH /api/lines                          {"changes": [{"uid", "cost"?, "notes"?}], "user": ..}
+    POST  /api/cps-opportunities              {"parent": {...}, "lines": [...], "submission_id"?}
+    POST  /api/stage-transitions              {"opportunity_ids": [..], "stage", "notes", "date", "user", "closing_reason"}
+    GET   /api/activity-log                   ?opportunity_name=&page=&page_size=
+"""
+import argparse
+import asyncio
+import hmac
+import io
+import json
+from decimal import Decimal
+
+import pandas as pd
+import streamlit as st
+import tornado.web
+
+import backend as db
+import backend_async as adb
+
+MAX_PAGE_SIZE = 1000
+ARROW_MIME = "application/vnd.apache.arrow.stream"
+
+def _records(data):
+    """Record dari backend -> tipe JSON (Timestamp -> ISO, Decimal -> float, NaN -> null)."""
+    if not data:
+        return []
+    df = pd.DataFrame(data)
+    for col in df.columns:
+        if df[col].map(lambda v: isinstance(v, Decimal)).any():
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    return json.loads(df.to_json(orient="records", date_format="iso", default_handler=str))
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    def prepare(self):
+        keys = list(st.secrets.get("api", {}).get("keys", []))
+        given = self.request.headers.get("X-API-Key", "")
+        if not keys:
+            raise tornado.web.HTTPError(503, reason="API keys not configured")
+        if not any(hmac.compare_digest(given, k) for k in keys):
+            raise tornado.web.HTTPError(401, reason="Invalid API key")
+
+    def json_body(self):
+        try:
+            return json.loads(self.request.body or b"{}")
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="Body must be JSON")
+
+    def arg_list(self, name):
+        """?stage=Open&stage=Won atau ?stage=Open,Won"""
+        values = [v for raw in self.get_arguments(name) for v in raw.split(",") if v.strip()]
+        return [v.strip() for v in values] or None
+
+    def page_args(self, default_size=100):
+        try:
+            page = max(int(self.get_argument("page", "1")), 1)
+            page_size = min(max(int(self.get_argument("page_size", str(default_size))), 1), MAX_PAGE_SIZE)
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="page and page_size must be integers")
+        return page, page_size
+
+    def wants_arrow(self):
+        return self.get_argument("format", "") == "arrow" or ARROW_MIME in self.request.headers.get("Accept", "")
+
+    def respond(self, res, **meta):
+        """Kirim dict {"status", "data"/"message"} dari backend apa adanya, status HTTP = res["status"]."""
+        status = int(res.get("status", 500))
+        self.set_status(status)
+        if status == 200 and isinstance(res.get("data"), list) and self.wants_arrow():
+            import pyarrow as pa
+
+            table = pa.Table.from_pandas(pd.DataFrame(_records(res["data"])), preserve_index=False)
+            sink = io.BytesIO()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            for k, v in meta.items():
+                self.set_header(f"X-{k.replace('_', '-').title()}", str(v))
+            self.set_header("Content-Type", ARROW_MIME)
+            self.finish(sink.getvalue())
+            return
+
+        body = {k: v for k, v in res.items() if k != "data"}
+        body.update(meta)
+        if "data" in res:
+            data = res["data"]
+            if isinstance(data, list):
+                body["data"] = _records(data)
+            elif isinstance(data, dict):
+                body["data"] = _records([data])[0]
+            else:
+                body["data"] = data
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.finish(json.dumps(body, default=str))
+
+    def write_error(self, status_code, **kwargs):
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.finish(json.dumps({"status": status_code, "message": self._reason}))
+
+
+class HealthHandler(BaseHandler):
+    def prepare(self):
+        pass  # tanpa API key, untuk load balancer
+
+    async def get(self):
+        # Selalu 200: saat circuit open instance ini masih melayani read (stale) dalam mode read-only,
+        # jadi load balancer tidak boleh mengeluarkannya. State breaker ada di body.
+        health = db.get_db_health()
+        read_only = health["state"] == "open"
+        self.respond({
+            "status": 200,
+            "message": "ok (database unavailable, read-only)" if read_only else "ok",
+            "data": {**health, "read_only": read_only}
+        })
+
+
+class PoolHandler(BaseHandler):
+    async def get(self):
+        self.respond({"status": 200, "data": db.get_pool_metrics()})
+
+
+class OpportunitiesHandler(BaseHandler):
+    def filters(self):
+        return {col: self.arg_list(col) for col in db.OPPORTUNITY_FILTER_COLUMNS}
+
+    async def get(self):
+        page, page_size = self.page_args()
+        start, end = self.get_argument("start_date", None), self.get_argument("end_date", None)
+        filters = self.filters()
+        count, res = await asyncio.gather(
+            adb.count_opportunities(filters, start, end),
+            adb.get_opportunities_page(
+                filters, start, end,
+                sort_by=self.get_argument("sort", "created_at"),
+                descending=self.get_argument("order", "desc").lower() != "asc",
+                page=page, page_size=page_size
+            )
+        )
+        if count["status"] != 200:
+            return self.respond(count)
+        self.respond(res, total=count["data"], page=page, page_size=page_size)
+
+    async def post(self):
+        body = self.json_body()
+        if not isinstance(body.get("parent"), dict) or not body.get("lines"):
+            raise tornado.web.HTTPError(400, reason="parent and lines are required")
+        self.respond(await adb.add_multi_line_opportunity(body["parent"], body["lines"], submission_id=body.get("submission_id")))
+
+
+class AggregateHandler(BaseHandler):
+    async def get(self):
+        self.respond(await adb.get_pipeline_cube(
+            self.arg_list("pillar"), self.arg_list("stage"), self.arg_list("salesgroup_id"),
+            self.get_argument("start_date", None), self.get_argument("end_date", None)
+        ))
+
+
+class OpportunityLinesHandler(BaseHandler):
+    async def get(self, opp_id):
+        self.respond(await adb.get_opportunity_lines(opp_id))
+
+
+class OpportunityHandler(BaseHandler):
+    async def get(self, uid):
+        self.respond(await adb.get_lead_by_uid(uid))
+
+    async def patch(self, uid):
+        body = self.json_body()
+        change = {"uid": uid, **{k: body[k] for k in ("cost", "notes") if k in body}}
+        if len(change) == 1:
+            raise tornado.web.HTTPError(400, reason="cost or notes is required")
+        res = await adb.update_leads_batch([change], body.get("user"))
+        if res["status"] == 200 and not res["data"]["updated"]:
+            res = {"status": 404, "message": "UID not found"}
+        self.respond(res)
+
+
+class LinesHandler(BaseHandler):
+    async def patch(self):
+        body = self.json_body()
+        self.respond(await adb.update_leads_batch(body.get("changes"), body.get("user")))
+
+
+class CpsOpportunitiesHandler(BaseHandler):
+    async def post(self):
+        body = self.json_body()
+        if not isinstance(body.get("parent"), dict) or not body.get("lines"):
+            raise tornado.web.HTTPError(400, reason="parent and lines are required")
+        self.respond(await adb.add_cps_opportunity(body["parent"], body["lines"], submission_id=body.get("submission_id")))
+
+
+class StageTransitionsHandler(BaseHandler):
+    async def post(self):
+        body = self.json_body()
+        if not body.get("opportunity_ids") or not body.get("stage"):
+            raise tornado.web.HTTPError(400, reason="opportunity_ids and stage are required")
+        self.respond(await adb.update_opportunity_stage_batch(
+            body["opportunity_ids"], body["stage"], body.get("notes", ""),
+            body.get("date"), body.get("user"), body.get("closing_reason")
+        ))
+
+
+class ActivityLogHandler(BaseHandler):
+    async def get(self):
+        page, page_size = self.page_args()
+        res = await adb.get_activity_log_page(self.get_argument("opportunity_name", None), page, page_size)
+        self.respond(res, page=page, page_size=page_size)
+
+
+def make_app():
+    return tornado.web.Application([
+        (r"/api/health", HealthHandler),
+        (r"/api/pool", PoolHandler),
+        (r"/api/opportunities", OpportunitiesHandler),
+        (r"/api/opportunities/aggregate", AggregateHandler),
+        (r"/api/opportunities/by-id/([^/]+)", OpportunityLinesHandler),
+        (r"/api/opportunities/([^/]+)", OpportunityHandler),
+        (r"/api/lines", LinesHandler),
+        (r"/api/cps-opportunities", CpsOpportunitiesHandler),
+        (r"/api/stage-transitions", StageTransitionsHandler),
+        (r"/api/activity-log", ActivityLogHandler),
+    ], compress_response=True)
+
+
+async def main(port):
+    make_app().listen(port)
+    print(f"Presales API listening on :{port}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Presales headless JSON API")
+    parser.add_argument("--port", type=int, default=8502)
+    asyncio.run(main(parser.parse_args().port))
@@ -1,6 +1,16 @@
 import streamlit as st
-import pandas as pd
-import numpy as np
+
+# set_page_config harus jadi perintah st pertama; judul langsung dikirim ke browser
+# selagi modul backend / utils (pandas, sqlalchemy) masih di-import
+st.set_page_config(
+    page_title="Presales App - SISINDOKOM",
+    page_icon=":clipboard:",
+    initial_sidebar_state="expanded",
+    layout="wide"
+)
+st.title("Presales App - SISINDOKOM")
+st.markdown("---")
+
 import utils
 
 
@@ -15,17 +25,33 @@ if 'edit_submission_message' not in st.session_state: st.session_state.edit_subm
 if 'edit_new_uid' not in st.session_state: st.session_state.edit_new_uid = None
 if 'selected_kanban_opp_id' not in st.session_state: st.session_state.selected_kanban_opp_id = None
 
+# Prefetch semua master data secara paralel saat sesi baru dimulai
+if 'master_prefetched' not in st.session_state:
+    with st.spinner("Loading master data..."):
+        utils.prefetch_master_data()
+    st.session_state.master_prefetched = True
+
 
 # ==============================================================================
 # ANTARMUKA UTAMA
 # ==============================================================================
 
-st.title("Presales App - SISINDOKOM")
-st.markdown("---")
+# Circuit breaker DB terbuka: data yang tampil adalah snapshot terakhir, form submit ditolak
+db_health = utils.db.get_db_health()
+if db_health["state"] != "closed":
+    st.sidebar.error(f"⚠️ Database unavailable: read-only mode, showing last known data. "
+                     f"Next retry in {db_health['retry_in_seconds']}s.")
+
+# Submit yang diantrekan saat DB down (lihat write_queue.py)
+utils.render_write_queue_status()
+
+# Monitoring pool koneksi DB (lihat backend.get_pool_metrics)
+with st.sidebar.expander("🩺 DB Connection Pools"):
+    st.dataframe(utils.db.get_pool_metrics(), hide_index=True, use_container_width=True)
 
-tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs([
+tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
     "Add Opportunity", "View Opportunities", "Search Opportunity", 
-    "Update Opportunity", "Edit Opportunity", "Activity Log"
+    "Update Opportunity", "Edit Opportunity", "Activity Log", "Pipeline Velocity"
 ])
 
 # ==============================================================================
@@ -57,4 +83,9 @@ with tab5:
 # TAB 6: ACTIVITY LOG / AUDIT TRAIL - VISUAL RESTORED
 # ==============================================================================
 with tab6:
-    utils.tab6()
\ No newline at end of file
+    utils.tab6()
+# ==============================================================================
+# TAB 7: PIPELINE VELOCITY (STAGE HISTORY METRICS)
+# ==============================================================================
+with tab7:
+    utils.tab7()
\ No newline at end of file
@@ -1,16 +1,186 @@
 import streamlit as st
 import pandas as pd
-from sqlalchemy import text
 from datetime import datetime
 import time
 import re
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import io
+import json
+import os
+import threading
+import functools
+import hashlib
+import uuid
+from cachetools import LRUCache, TTLCache
+# sqlalchemy & stack email sengaja di-import saat pertama dipakai (cold start lebih cepat,
+# lihat check_importtime.py)
+
+def text(sql):
+    """sqlalchemy.text, dengan import sqlalchemy ditunda sampai query pertama."""
+    from sqlalchemy import text as sa_text
+    return sa_text(sql)
 
 # 1. KONEKSI DATABASE
 # Pastikan Anda sudah mengatur .streamlit/secrets.toml
-conn = st.connection("postgresql", type="sql")
+# Dua pool terpisah ke database yang sama, supaya query dashboard yang berat
+# tidak menghabiskan koneksi untuk form submit:
+#   get_conn()          -> lookup pendek & semua write dari form (statement_timeout ketat)
+#   get_conn(long=True) -> full load dashboard, analitik, export, import, snapshot
+# Koneksi dibuat saat pertama dipakai, bukan saat modul di-import.
+# Ukuran pool & timeout bisa di-override di secrets.toml, contoh:
+#   [db_pool]
+#   short_pool_size = 10
+#   long_statement_timeout_ms = 300000
+POOL_DEFAULTS = {
+    "short": {"pool_size": 5, "max_overflow": 5, "pool_timeout": 10, "statement_timeout_ms": 15000},
+    "long": {"pool_size": 2, "max_overflow": 2, "pool_timeout": 30, "statement_timeout_ms": 120000},
+}
+POOL_RECYCLE_SECONDS = 1800
+_CONNECTION_PARAMS = {"url", "driver", "dialect", "username", "password", "host", "port", "database", "query"}
+
+_timed_pool_class = None
+
+def _get_timed_pool_class():
+    """QueuePool yang mencatat lama menunggu koneksi (untuk get_pool_metrics)."""
+    global _timed_pool_class
+    if _timed_pool_class is None:
+        from sqlalchemy import exc as sa_exc
+        from sqlalchemy.pool import QueuePool
+
+        class TimedQueuePool(QueuePool):
+            def _do_get(self):
+                stats = self.__dict__.setdefault("wait_stats", {"waits": 0, "total_wait": 0.0, "max_wait": 0.0, "timeouts": 0})
+                start = time.perf_counter()
+                try:
+                    return super()._do_get()
+                except sa_exc.TimeoutError:
+                    stats["timeouts"] += 1
+                    _db_error.last = (True, True)  # pool penuh: belum ada statement, aman di-retry
+                    raise
+                finally:
+                    waited = time.perf_counter() - start
+                    stats["waits"] += 1
+                    stats["total_wait"] += waited
+                    stats["max_wait"] = max(stats["max_wait"], waited)
+
+        _timed_pool_class = TimedQueuePool
+    return _timed_pool_class
+
+def _pool_config(kind):
+    cfg = dict(POOL_DEFAULTS[kind])
+    try:
+        overrides = st.secrets.get("db_pool", {})
+    except Exception:
+        overrides = {}
+    for key in cfg:
+        if f"{kind}_{key}" in overrides:
+            cfg[key] = int(overrides[f"{kind}_{key}"])
+    return cfg
+
+def _make_connection(kind, source="postgresql"):
+    cfg = _pool_config(kind)
+    base = dict(st.secrets["connections"][source])
+    connect_args = dict(base.get("create_engine_kwargs", {}).get("connect_args", {}))
+    connect_args.update({
+        "options": f"-c statement_timeout={cfg['statement_timeout_ms']}",
+        "application_name": f"presales-app-{source}-{kind}",
+    })
+    engine_kwargs = {
+        "poolclass": _get_timed_pool_class(),
+        "pool_size": cfg["pool_size"],
+        "max_overflow": cfg["max_overflow"],
+        "pool_timeout": cfg["pool_timeout"],
+        "pool_pre_ping": True,
+        "pool_recycle": POOL_RECYCLE_SECONDS,
+        "connect_args": connect_args,
+    }
+    if kind == "short":
+        return st.connection(source, type="sql", **engine_kwargs)
+    # Pool kedua: parameter koneksi sama dengan [connections.<source>]
+    params = {k: v for k, v in base.items() if k in _CONNECTION_PARAMS}
+    return st.connection(f"{source}_long", type="sql", **params, **engine_kwargs)
+
+def _has_read_replica():
+    try:
+        return "postgresql_read" in st.secrets.get("connections", {})
+    except Exception:
+        return False
+
+def storage_backend():
+    """
+    Storage yang dipakai: "postgresql" (default) atau "sqlite" (stand-in lokal untuk test /
+    benchmark tanpa server, lihat backend_sqlite.py). Env PRESALES_STORAGE=sqlite:///file.db
+    dibaca duluan, lalu [storage] backend = "sqlite" di secrets.toml.
+    """
+    url = os.environ.get("PRESALES_STORAGE", "").strip()
+    if url:
+        return url.split(":", 1)[0]
+    try:
+        return st.secrets.get("storage", {}).get("backend", "postgresql")
+    except Exception:
+        return "postgresql"
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+def _get_connection(kind, source="postgresql"):
+    key = (source, kind)
+    c = _connections.get(key)
+    if c is None:
+        with _connections_lock:
+            c = _connections.get(key)
+            if c is None:
+                c = _connections[key] = _make_connection(kind, source)
+                _watch_engine(c.engine)
+    return c
+
+def get_conn(long=False):
+    """Koneksi primary (pool short / long)."""
+    return _get_connection("long" if long else "short")
+
+# Read-your-writes: sesi yang baru saja menulis membaca dari primary selama beberapa detik,
+# supaya tidak melihat data lama akibat replication lag.
+READ_YOUR_WRITES_SECONDS = 30
+
+def _pin_primary():
+    try:
+        st.session_state["_db_primary_until"] = time.time() + READ_YOUR_WRITES_SECONDS
+    except Exception:
+        pass  # di luar sesi Streamlit (job / script)
+
+def get_read_conn(long=False):
+    """
+    Koneksi untuk query read-only: replica jika [connections.postgresql_read] ada di secrets.toml
+    (untuk testing cukup Postgres lokal kedua), kecuali sesi ini baru menulis.
+    Tanpa replica semua baca tetap ke primary.
+    """
+    try:
+        pinned = st.session_state.get("_db_primary_until", 0) > time.time()
+    except Exception:
+        pinned = False
+    if pinned or not _has_read_replica():
+        return get_conn(long)
+    return _get_connection("long" if long else "short", "postgresql_read")
+
+def _pool_stats(name, pool):
+    stats = getattr(pool, "wait_stats", {"waits": 0, "total_wait": 0.0, "max_wait": 0.0, "timeouts": 0})
+    return {
+        "pool": name,
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "checkouts": stats["waits"],
+        "avg_wait_ms": round(stats["total_wait"] / stats["waits"] * 1000, 2) if stats["waits"] else 0.0,
+        "max_wait_ms": round(stats["max_wait"] * 1000, 2),
+        "timeouts": stats["timeouts"],
+    }
+
+def get_pool_metrics():
+    """Status setiap pool yang sudah dibuat: koneksi dipakai, overflow, dan waktu tunggu checkout."""
+    return [
+        _pool_stats(kind if source == "postgresql" else f"read_{kind}", c.engine.pool)
+        for (source, kind), c in sorted(_connections.items())
+    ]
 
 # 2. EMAIL UTILITIES
 def send_email_notification(recipient_email, subject, body_html):
@@ -24,6 +194,10 @@ def send_email_notification(recipient_email, subject, body_html):
         return {"status": 500, "message": "Konfigurasi SMTP tidak ditemukan di secrets.toml"}
 
     try:
+        import smtplib
+        from email.mime.text import MIMEText
+        from email.mime.multipart import MIMEMultipart
+
         msg = MIMEMultipart()
         msg['From'] = SENDER_EMAIL
         msg['To'] = recipient_email
@@ -54,290 +228,1009 @@ def get_master_presales(action):
         "getCompanies": "SELECT DISTINCT company_name as \"Company\", vertical_industry as \"Vertical Industry\" FROM companies ORDER BY company_name",
         "getDistributors": "SELECT DISTINCT distributor_name as \"Distributor\" FROM distributors WHERE distributor_name IS NOT NULL ORDER BY distributor_name",
         "getOpportunities": "SELECT DISTINCT opportunity_name as \"Desc\" FROM opportunities ORDER BY opportunity_name",
-        "getActivityLog": "SELECT timestamp as \"Timestamp\", opportunity_name as \"OpportunityName\", user_name as \"User\", action as \"Action\", field as \"Field\", old_value as \"OldValue\", new_value as \"NewValue\" FROM activity_logs ORDER BY timestamp DESC LIMIT 1000"
+        "getActivityLog": "SELECT timestamp as \"Timestamp\", opportunity_name as \"OpportunityName\", user_name as \"User\", action as \"Action\", field as \"Field\", old_value as \"OldValue\", new_value as \"NewValue\", record_key as \"RecordKey\" FROM activity_logs ORDER BY timestamp DESC LIMIT 1000"
     }
     
     if action in queries:
         try:
-            df = conn.query(queries[action], ttl=60)
+            df = get_read_conn().query(queries[action], ttl=60)
             return df.to_dict('records')
         except Exception as e:
             st.error(f"DB Error: {e}")
             return []
     return []
 
+def get_activity_log_page(opportunity_name=None, page=1, page_size=100):
+    """Activity log terbaru dulu, per halaman (tanpa batas 1000 baris seperti getActivityLog)."""
+    where = "WHERE COALESCE(opportunity_name, 'Unknown') = :opp" if opportunity_name else ""
+    query = f"""
+        SELECT timestamp as "Timestamp", opportunity_name as "OpportunityName", user_name as "User",
+               action as "Action", field as "Field", old_value as "OldValue", new_value as "NewValue",
+               record_key as "RecordKey", COUNT(*) OVER () AS "_total"
+        FROM activity_logs {where}
+        ORDER BY timestamp DESC
+        LIMIT :limit OFFSET :offset
+    """
+    params = {"opp": opportunity_name, "limit": int(page_size), "offset": (max(int(page), 1) - 1) * int(page_size)}
+    try:
+        df = get_read_conn().query(query, params=params, ttl=0)
+        total = int(df["_total"].iloc[0]) if not df.empty else 0
+        return {"status": 200, "data": df.drop(columns="_total").to_dict('records'), "total": total}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
 def get_all_leads_presales():
     query = "SELECT * FROM opportunities ORDER BY created_at DESC"
-    df = conn.query(query, ttl=0) # TTL 0 agar selalu fresh
+    df = get_read_conn(long=True).query(query, ttl=0) # TTL 0 agar selalu fresh
     return {"status": 200, "data": df.to_dict('records')}
 
+# Cache per key (in-process, dibagi antar sesi), keyed by uid / opportunity_id.
+# Write function di bawah meng-update (write-through) atau meng-invalidate key yang disentuh,
+# jadi editor langsung melihat perubahannya sendiri. Invalidasi hanya berlaku di proses ini:
+# write dari proses lain (api.py, replica Streamlit lain, bulk import di worker lain) baru
+# terlihat setelah TTL, jadi TTL sengaja pendek.
+OPPORTUNITY_CACHE_TTL_SECONDS = 30
+_lead_cache = TTLCache(maxsize=1024, ttl=OPPORTUNITY_CACHE_TTL_SECONDS)       # uid -> baris opportunities
+_summary_cache = TTLCache(maxsize=512, ttl=OPPORTUNITY_CACHE_TTL_SECONDS)     # opportunity_id -> ringkasan
+_opp_lines_cache = TTLCache(maxsize=512, ttl=OPPORTUNITY_CACHE_TTL_SECONDS)   # opportunity_id -> semua line
+_cache_lock = threading.Lock()
+# Naik setiap invalidasi. Reader mencatatnya sebelum query dan hanya menyimpan hasilnya jika
+# belum berubah, supaya baris lama yang di-fetch sebelum commit writer tidak masuk cache lagi.
+_cache_generation = 0
+
+def _cache_put(cache, key, value, generation):
+    """Simpan hasil fetch ke cache, kecuali ada invalidasi sejak fetch dimulai (generation)."""
+    with _cache_lock:
+        if generation == _cache_generation:
+            cache[key] = value
+
+def _invalidate_opportunities(opp_ids=None):
+    """Hapus cache untuk opp_ids tertentu (termasuk baris uid-nya), atau semuanya jika opp_ids None."""
+    global _cache_generation
+    with _cache_lock:
+        _cache_generation += 1
+        if opp_ids is None:
+            _lead_cache.clear()
+            _summary_cache.clear()
+            _opp_lines_cache.clear()
+            return
+        opp_ids = set(opp_ids)
+        for oid in opp_ids:
+            _summary_cache.pop(oid, None)
+            _opp_lines_cache.pop(oid, None)
+        for uid in [k for k, row in _lead_cache.items() if row.get('opportunity_id') in opp_ids]:
+            _lead_cache.pop(uid, None)
+
+def _cache_lead_row(row):
+    """Write-through: simpan baris hasil UPDATE ... RETURNING (format sama dengan conn.query)."""
+    record = pd.DataFrame([row]).to_dict('records')[0]
+    with _cache_lock:
+        _lead_cache[record['uid']] = record
+
+def _fetch_lead_row(uid):
+    """Satu baris opportunities by uid lewat cache. Return dict (copy) atau None."""
+    with _cache_lock:
+        cached, generation = _lead_cache.get(uid), _cache_generation
+    if cached is None:
+        df = get_conn().query("SELECT * FROM opportunities WHERE uid = :uid", params={"uid": uid}, ttl=0)
+        if df.empty:
+            return None
+        cached = df.to_dict('records')[0]
+        _cache_put(_lead_cache, uid, cached, generation)
+    return dict(cached)
+
+def _query_leads_by_uids(uids):
+    return get_conn().query("SELECT * FROM opportunities WHERE uid = ANY(CAST(:uids AS text[]))",
+                            params={"uids": list(uids)}, ttl=0)
+
+def get_leads_by_uids(uids):
+    """Banyak baris sekaligus by uid: yang belum ada di cache diambil dalam satu query."""
+    uids = list(dict.fromkeys(str(u).strip() for u in (uids or []) if str(u).strip()))
+    with _cache_lock:
+        found = {u: dict(_lead_cache[u]) for u in uids if u in _lead_cache}
+        generation = _cache_generation
+    missing = [u for u in uids if u not in found]
+    if missing:
+        try:
+            df = _query_leads_by_uids(missing)
+        except Exception as e:
+            return {"status": 500, "message": str(e)}
+        for record in df.to_dict('records'):
+            _cache_put(_lead_cache, record['uid'], record, generation)
+            found[record['uid']] = dict(record)
+    if not found:
+        return {"status": 404, "message": "UID Not Found"}
+    # Urutan sesuai input, UID yang tidak ditemukan dilaporkan terpisah
+    return {
+        "status": 200,
+        "data": [found[u] for u in uids if u in found],
+        "missing": [u for u in uids if u not in found]
+    }
+
 def get_single_lead(search_params):
     # Search by UID
     if "uid" in search_params:
-        uid = search_params["uid"]
-        query = "SELECT * FROM opportunities WHERE uid = :uid"
-        df = conn.query(query, params={"uid": uid}, ttl=0)
-        if not df.empty:
-            return {"status": 200, "data": df.to_dict('records')}
+        row = _fetch_lead_row(search_params["uid"])
+        if row:
+            return {"status": 200, "data": [row]}
     return {"status": 404, "message": "Not Found"}
 
+# Kolom yang boleh difilter / di-sort dari dashboard tab3 (whitelist, dipakai sebagai nama kolom SQL)
+OPPORTUNITY_FILTER_COLUMNS = {
+    'presales_name', 'responsible_name', 'salesgroup_id', 'channel', 'distributor_name', 'brand',
+    'pillar', 'solution', 'company_name', 'vertical_industry', 'stage', 'opportunity_name'
+}
+OPPORTUNITY_SORT_COLUMNS = OPPORTUNITY_FILTER_COLUMNS | {
+    'uid', 'opportunity_id', 'sales_name', 'service', 'cost', 'start_date', 'created_at', 'updated_at'
+}
+
+def build_opportunity_filter(filters, start_date=None, end_date=None):
+    """
+    WHERE clause yang setara dengan filter pandas di tab3:
+    nilai NULL dianggap "Unknown", tanggal memakai start_date (baris tanpa start_date ikut terbuang).
+    Return (sql, params); sql kosong jika tidak ada filter.
+    """
+    where, params = [], {}
+    for col, selection in (filters or {}).items():
+        if col not in OPPORTUNITY_FILTER_COLUMNS or not selection:
+            continue
+        where.append(f"COALESCE({col}::text, 'Unknown') = ANY(CAST(:f_{col} AS text[]))")
+        params[f"f_{col}"] = [str(v) for v in selection]
+
+    if start_date and end_date:
+        where.append("start_date::date BETWEEN CAST(:start AS date) AND CAST(:end AS date)")
+        params.update({"start": start_date, "end": end_date})
+
+    return (" WHERE " + " AND ".join(where)) if where else "", params
+
+def count_opportunities(filters, start_date=None, end_date=None):
+    where_sql, params = build_opportunity_filter(filters, start_date, end_date)
+    try:
+        df = get_read_conn().query(f"SELECT COUNT(*) AS total FROM opportunities{where_sql}", params=params, ttl=0)
+        return {"status": 200, "data": int(df['total'].iloc[0])}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+def get_opportunities_page(filters, start_date=None, end_date=None,
+                           sort_by="created_at", descending=True, page=1, page_size=50):
+    """
+    Satu halaman hasil filter tab3 (LIMIT/OFFSET), diurutkan di DB.
+    uid dipakai sebagai tie-breaker agar urutan antar halaman stabil.
+    """
+    if sort_by not in OPPORTUNITY_SORT_COLUMNS:
+        return {"status": 400, "message": f"Invalid sort column: {sort_by}"}
+    where_sql, params = build_opportunity_filter(filters, start_date, end_date)
+    direction = "DESC" if descending else "ASC"
+    query = f"""
+        SELECT * FROM opportunities{where_sql}
+        ORDER BY {sort_by} {direction} NULLS LAST, uid {direction}
+        LIMIT :limit OFFSET :offset
+    """
+    params.update({"limit": int(page_size), "offset": (max(int(page), 1) - 1) * int(page_size)})
+    try:
+        df = get_read_conn().query(query, params=params, ttl=0)
+        return {"status": 200, "data": df.to_dict('records')}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+def get_opportunity_lines(opp_id):
+    """
+    Semua line satu opportunity lewat index opportunity_id (idx_opportunities_opportunity_id).
+    Dipakai detail view Kanban (tab2) sebagai pengganti load + filter seluruh tabel.
+    """
+    with _cache_lock:
+        cached, generation = _opp_lines_cache.get(opp_id), _cache_generation
+    if cached is not None:
+        return {"status": 200, "data": list(cached)}
+
+    query = "SELECT * FROM opportunities WHERE opportunity_id = :oid ORDER BY created_at, uid"
+    try:
+        df = get_conn().query(query, params={"oid": opp_id}, ttl=0)
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+    if df.empty:
+        return {"status": 404, "message": "Opportunity ID not found"}
+
+    data = df.to_dict('records')
+    _cache_put(_opp_lines_cache, opp_id, data, generation)
+    return {"status": 200, "data": list(data)}
+
+def search_opportunities(keyword, limit=50):
+    """
+    Full-text search ke opportunity_name, company_name, notes, stage_notes & closing_notes.
+    Memakai index GIN di tabel opportunity_search (lihat migrations/001_opportunity_search.sql).
+    Setiap kata diperlakukan sebagai prefix, contoh: "bank firew" -> bank:* & firew:*
+    """
+    terms = re.findall(r"\w+", keyword or "")
+    if not terms:
+        return {"status": 400, "message": "Keyword is empty"}
+
+    ts_query = " & ".join(f"{t}:*" for t in terms)
+    query = """
+        SELECT o.*, ts_rank(s.search_vector, q) AS search_rank
+        FROM opportunity_search s
+        CROSS JOIN to_tsquery('simple', :q) AS q
+        JOIN opportunities o ON o.uid = s.uid
+        WHERE s.search_vector @@ q
+        ORDER BY search_rank DESC, o.created_at DESC
+        LIMIT :lim
+    """
+    try:
+        df = get_read_conn().query(query, params={"q": ts_query, "lim": int(limit)}, ttl=0)
+        return {"status": 200, "data": df.to_dict('records')}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+def get_pipeline_velocity(pillars=None, sales_groups=None):
+    """
+    Metrik funnel dari tabel agregat stage_flow_stats (migrations/005_stage_flow_stats.sql):
+    - time_in_stage : rata-rata lama (hari) di setiap stage sebelum pindah
+    - conversion    : persentase perpindahan stage A -> stage B dari semua exit stage A
+    - win_rate      : Closed Won / (Closed Won + Closed Lost) per pillar & sales group
+    Tanpa filter, setiap opportunity dihitung sekali (baris rollup '*'). Dengan filter pillar,
+    opportunity yang punya beberapa pillar terpilih dihitung sekali per pillar tsb. Pillar diambil
+    saat transisi terjadi: pillar yang ditambahkan ke opportunity belakangan tidak menghitung
+    transisi sebelumnya (sampai stage_flow_stats_rebuild() dijalankan).
+    """
+    params = {"pillars": list(pillars) if pillars else None,
+              "groups": list(sales_groups) if sales_groups else None}
+    # Tanpa filter dimensi -> baris rollup '*' (opportunity multi-pillar dihitung sekali)
+    flt = """
+        FROM stage_flow_stats
+        WHERE CASE WHEN CAST(:pillars AS text[]) IS NULL THEN pillar = '*'
+                   ELSE pillar = ANY(CAST(:pillars AS text[])) END
+          AND CASE WHEN CAST(:groups AS text[]) IS NULL THEN salesgroup_id = '*'
+                   ELSE salesgroup_id = ANY(CAST(:groups AS text[])) END
+    """
+    # Breakdown per pillar & sales group (win rate) -> hanya baris detail
+    flt_detail = """
+        FROM stage_flow_stats
+        WHERE pillar <> '*' AND salesgroup_id <> '*'
+          AND (CAST(:pillars AS text[]) IS NULL OR pillar = ANY(CAST(:pillars AS text[])))
+          AND (CAST(:groups AS text[]) IS NULL OR salesgroup_id = ANY(CAST(:groups AS text[])))
+    """
+    queries = {
+        "time_in_stage": f"""
+            SELECT from_stage AS stage, SUM(transitions) AS exits,
+                   SUM(total_seconds) / NULLIF(SUM(transitions), 0) / 86400.0 AS avg_days
+            {flt} AND from_stage <> ''
+            GROUP BY from_stage
+            ORDER BY from_stage
+        """,
+        "conversion": f"""
+            WITH f AS (
+                SELECT from_stage, to_stage, SUM(transitions) AS transitions
+                {flt} AND from_stage <> ''
+                GROUP BY from_stage, to_stage
+            )
+            SELECT from_stage, to_stage, transitions,
+                   100.0 * transitions / SUM(transitions) OVER (PARTITION BY from_stage) AS conversion_pct
+            FROM f
+            ORDER BY from_stage, transitions DESC
+        """,
+        "win_rate": f"""
+            SELECT pillar, salesgroup_id,
+                   SUM(transitions) FILTER (WHERE to_stage = 'Closed Won') AS won,
+                   SUM(transitions) FILTER (WHERE to_stage = 'Closed Lost') AS lost,
+                   100.0 * SUM(transitions) FILTER (WHERE to_stage = 'Closed Won')
+                       / NULLIF(SUM(transitions) FILTER (WHERE to_stage IN ('Closed Won', 'Closed Lost')), 0) AS win_rate_pct
+            {flt_detail}
+            GROUP BY pillar, salesgroup_id
+            HAVING SUM(transitions) FILTER (WHERE to_stage IN ('Closed Won', 'Closed Lost')) > 0
+            ORDER BY pillar, salesgroup_id
+        """
+    }
+    try:
+        data = {name: get_read_conn(long=True).query(q, params=params, ttl=60).to_dict('records') for name, q in queries.items()}
+        return {"status": 200, "data": data}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+def get_pipeline_cube(pillars=None, stages=None, sales_groups=None, start_date=None, end_date=None):
+    """
+    Nilai pipeline per pillar x stage x sales group x bulan start dari tabel pipeline_cube
+    (migrations/006_pipeline_cube.sql). Ukuran hasil tergantung jumlah kombinasi dimensi,
+    bukan jumlah baris opportunities.
+    """
+    query = """
+        SELECT pillar, stage, salesgroup_id, start_month, total_cost, line_count, opp_count
+        FROM pipeline_cube
+        WHERE (CAST(:pillars AS text[]) IS NULL OR pillar = ANY(CAST(:pillars AS text[])))
+          AND (CAST(:stages AS text[]) IS NULL OR stage = ANY(CAST(:stages AS text[])))
+          AND (CAST(:groups AS text[]) IS NULL OR salesgroup_id = ANY(CAST(:groups AS text[])))
+          AND (CAST(:start AS date) IS NULL OR start_month >= date_trunc('month', CAST(:start AS date)))
+          AND (CAST(:end AS date) IS NULL OR start_month <= CAST(:end AS date))
+        ORDER BY start_month, pillar, stage, salesgroup_id
+    """
+    params = {
+        "pillars": list(pillars) if pillars else None,
+        "stages": list(stages) if stages else None,
+        "groups": list(sales_groups) if sales_groups else None,
+        "start": start_date, "end": end_date
+    }
+    try:
+        df = get_read_conn(long=True).query(query, params=params, ttl=60)
+        return {"status": 200, "data": df.to_dict('records')}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+def get_pipeline_as_of(as_of_date, pillars=None, stages=None, sales_groups=None):
+    """
+    Posisi pipeline per line pada tanggal tertentu dari pipeline_snapshots
+    (migrations/007_pipeline_snapshots.sql). Hanya tersedia sejak snapshot pertama.
+    """
+    query = """
+        SELECT uid, opportunity_id, pillar, stage, salesgroup_id, cost, snapshot_date AS last_changed
+        FROM pipeline_snapshot_as_of(CAST(:d AS date))
+        WHERE (CAST(:pillars AS text[]) IS NULL OR pillar = ANY(CAST(:pillars AS text[])))
+          AND (CAST(:stages AS text[]) IS NULL OR stage = ANY(CAST(:stages AS text[])))
+          AND (CAST(:groups AS text[]) IS NULL OR salesgroup_id = ANY(CAST(:groups AS text[])))
+        ORDER BY opportunity_id, uid
+    """
+    params = {
+        "d": as_of_date,
+        "pillars": list(pillars) if pillars else None,
+        "stages": list(stages) if stages else None,
+        "groups": list(sales_groups) if sales_groups else None
+    }
+    try:
+        df = get_read_conn(long=True).query(query, params=params, ttl=300)
+        return {"status": 200, "data": df.to_dict('records')}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+def get_pipeline_trend(start_date=None, end_date=None, pillars=None, stages=None, sales_groups=None):
+    """Nilai pipeline harian per stage dari ringkasan pipeline_snapshot_daily."""
+    query = """
+        SELECT snapshot_date, stage, SUM(total_cost) AS total_cost,
+               SUM(line_count) AS line_count, SUM(opp_count) AS opp_count
+        FROM pipeline_snapshot_daily
+        WHERE (CAST(:start AS date) IS NULL OR snapshot_date >= CAST(:start AS date))
+          AND (CAST(:end AS date) IS NULL OR snapshot_date <= CAST(:end AS date))
+          AND (CAST(:pillars AS text[]) IS NULL OR pillar = ANY(CAST(:pillars AS text[])))
+          AND (CAST(:stages AS text[]) IS NULL OR stage = ANY(CAST(:stages AS text[])))
+          AND (CAST(:groups AS text[]) IS NULL OR salesgroup_id = ANY(CAST(:groups AS text[])))
+        GROUP BY snapshot_date, stage
+        ORDER BY snapshot_date, stage
+    """
+    params = {
+        "start": start_date, "end": end_date,
+        "pillars": list(pillars) if pillars else None,
+        "stages": list(stages) if stages else None,
+        "groups": list(sales_groups) if sales_groups else None
+    }
+    try:
+        df = get_read_conn(long=True).query(query, params=params, ttl=300)
+        return {"status": 200, "data": df.to_dict('records')}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+def take_pipeline_snapshot(snapshot_date=None):
+    """Dipanggil oleh snapshot_job.py (harian). Hanya baris yang berubah yang disimpan; tanggal lampau ditolak."""
+    try:
+        with get_conn(long=True).session as session:
+            written = session.execute(
+                text("SELECT pipeline_snapshot_take(COALESCE(CAST(:d AS date), CURRENT_DATE))"),
+                {"d": snapshot_date}
+            ).scalar()
+            session.commit()
+            return {"status": 200, "message": f"Snapshot stored ({written} changed lines)", "data": {"written": written}}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
 # 4. WRITE OPERATIONS (INPUT & UPDATE)
 
-def add_multi_line_opportunity(parent_data, product_lines):
+def _claim_submission(session, submission_id, kind):
+    """
+    Tandai submission_id sebagai diproses di transaksi yang sedang berjalan
+    (migrations/009_processed_submissions.sql). Return None jika baru, atau response
+    submit pertama jika submission_id ini sudah pernah disimpan (replay / double submit).
+    """
+    if not submission_id:
+        return None
+    claimed = session.execute(text("""
+        INSERT INTO processed_submissions (submission_id, kind, processed_at)
+        VALUES (:sid, :kind, :now)
+        ON CONFLICT (submission_id) DO NOTHING
+        RETURNING submission_id
+    """), {"sid": submission_id, "kind": kind, "now": datetime.now()}).first()
+    if claimed:
+        return None
+    stored = session.execute(
+        text("SELECT result FROM processed_submissions WHERE submission_id = :sid"), {"sid": submission_id}
+    ).scalar()
+    previous = json.loads(stored) if stored else {"status": 200, "message": "Submission already processed."}
+    return {**previous, "duplicate": True}
+
+def _finish_submission(session, submission_id, result):
+    """Simpan response untuk submission_id (dikembalikan lagi jika submit yang sama datang ulang)."""
+    if submission_id:
+        session.execute(
+            text("UPDATE processed_submissions SET result = :res WHERE submission_id = :sid"),
+            {"sid": submission_id, "res": json.dumps(result, default=str)}
+        )
+    return result
+
+def _line_uid_stamp(submission_id=None):
+    """
+    Bagian tengah uid line ({opportunity_id}-{product_id}-{stamp}{idx} / {cps_id}-{stamp}-{idx}).
+    Dulu detik wall-clock, jadi dua submit untuk opportunity & produk yang sama dalam detik
+    yang sama (misal replay antrian write) bentrok di primary key. Sekarang diturunkan dari
+    submission_id (id acak jika tidak ada); tetap angka supaya urutan line dari suffix uid jalan.
+    """
+    key = submission_id or uuid.uuid4().hex
+    return str(int(hashlib.sha1(key.encode()).hexdigest()[:12], 16))
+
+def add_multi_line_opportunity(parent_data, product_lines, submission_id=None):
     try:
-        with conn.session as session:
-            # A. Logic Rows ID (Q3xxxx)
-            chk_q = text("SELECT rows_id FROM description WHERE description = :desc LIMIT 1")
-            res_desc = session.execute(chk_q, {"desc": parent_data['opportunity_name']}).mappings().first()
-            
-            if res_desc:
-                current_rows_id = res_desc['rows_id']
-            else:
-                # Generate New Q3 ID
-                max_q = text("SELECT MAX(rows_id) FROM description")
-                max_val = session.execute(max_q).scalar()
-                
-                prefix = "Q3"
-                if max_val:
-                    try:
-                        num_part = int(max_val.replace(prefix, ""))
-                        new_num = num_part + 1
-                        current_rows_id = f"{prefix}{new_num:04d}"
-                    except:
-                        current_rows_id = f"{prefix}{int(time.time())}"
-                else:
-                    current_rows_id = "Q30000"
-                
-                # Insert ke tabel description
-                ins_desc = text("INSERT INTO description (rows_id, description) VALUES (:rid, :desc)")
-                session.execute(ins_desc, {"rid": current_rows_id, "desc": parent_data['opportunity_name']})
-            
-            # B. Generate Opp ID
+        with get_conn().session as session:
+            previous = _claim_submission(session, submission_id, "add_multi_line_opportunity")
+            if previous is not None:
+                return previous
             safe_group = parent_data.get('salesgroup_id', 'GEN')
-            new_opp_id = f"{safe_group}{current_rows_id}"
-            
-            timestamp_now = int(time.time())
+            uid_stamp = _line_uid_stamp(submission_id)
             created_at = datetime.now()
-            created_uids = []
-            
-            # --- [BARU] INSERT KE HEADER SALES (Integrasi ke Sales App) ---
-            # Kita cek dulu apakah ID ini sudah ada di sales_opportunities
-            # Jika belum, kita buat.
-            check_header = text("SELECT opportunity_id FROM sales_opportunities WHERE opportunity_id = :oid")
-            if not session.execute(check_header, {"oid": new_opp_id}).first():
-                ins_header = text("""
+
+            # A + B. Upsert Rows ID (Q3xxxx) & Header Sales dalam satu statement
+            # - rows_id baru diambil dari sequence (migrations/002_header_upserts.sql)
+            # - Jika nama opportunity sudah ada, rows_id lama yang dipakai
+            # - ON CONFLICT menangani dua submit bersamaan untuk nama yang sama
+            header_q = text("""
+                WITH actor AS (
+                    -- Actor untuk trigger audit (migrations/003_audit_triggers.sql)
+                    SELECT set_config('app.actor', :actor, true) AS name
+                ),
+                existing AS (
+                    SELECT rows_id FROM description WHERE description = :desc
+                ),
+                inserted AS (
+                    INSERT INTO description (rows_id, description)
+                    SELECT 'Q3' || lpad(seq.n::text, greatest(4, length(seq.n::text)), '0'), :desc
+                    FROM (
+                        SELECT nextval('description_rows_id_seq') AS n
+                        WHERE NOT EXISTS (SELECT 1 FROM existing)
+                    ) seq
+                    ON CONFLICT (description) DO UPDATE SET description = EXCLUDED.description
+                    RETURNING rows_id
+                ),
+                rid AS (
+                    SELECT rows_id FROM inserted
+                    UNION ALL
+                    SELECT rows_id FROM existing
+                    LIMIT 1
+                ),
+                header AS (
+                    -- [BARU] Header Sales (Integrasi ke Sales App)
+                    -- selling_price default 0 atau null, nanti diisi Sales
                     INSERT INTO sales_opportunities (
-                        opportunity_id, opportunity_name, salesgroup_id, sales_name, 
+                        opportunity_id, opportunity_name, salesgroup_id, sales_name,
                         stage, created_at, updated_at
-                        -- selling_price default 0 atau null, nanti diisi Sales
-                    ) VALUES (
-                        :oid, :oname, :sgid, :sname, 
-                        :stg, :now, :now
                     )
-                """)
-                session.execute(ins_header, {
-                    "oid": new_opp_id,
-                    "oname": parent_data['opportunity_name'],
-                    "sgid": parent_data['salesgroup_id'],
-                    "sname": parent_data['sales_name'],
-                    "stg": parent_data.get('stage', 'Open'),
-                    "now": created_at
-                })
-            # --------------------------------------------------------------
+                    SELECT :oid_prefix || rid.rows_id, :desc, :sgid, :sname, :stg, :now, :now
+                    FROM rid
+                    ON CONFLICT (opportunity_id) DO NOTHING
+                )
+                SELECT rid.rows_id FROM rid CROSS JOIN actor
+            """)
+            current_rows_id = session.execute(header_q, {
+                "actor": parent_data['presales_name'],
+                "desc": parent_data['opportunity_name'],
+                "oid_prefix": safe_group,
+                "sgid": parent_data['salesgroup_id'],
+                "sname": parent_data['sales_name'],
+                "stg": parent_data.get('stage', 'Open'),
+                "now": created_at
+            }).scalar_one()
+
+            new_opp_id = f"{safe_group}{current_rows_id}"
             
-            # C. Loop Insert Lines
-            for i, line in enumerate(product_lines):
-                # Cari IDs
-                cat_q = text("SELECT pillar_id, solution_id, service_id FROM master_pillars WHERE pillar_name=:p AND solution_name=:s AND service_name=:svc LIMIT 1")
-                cat = session.execute(cat_q, {"p": line['pillar'], "s": line['solution'], "svc": line['service']}).mappings().first()
-                
-                br_q = text("SELECT brand_code FROM brands WHERE brand_name=:b LIMIT 1")
-                br = session.execute(br_q, {"b": line.get('brand')}).mappings().first()
-                
-                pid = cat['pillar_id'] if cat and cat['pillar_id'] else "GEN"
-                sol = str(cat['solution_id']) if cat and cat['solution_id'] else "0"
-                svc = str(cat['service_id']) if cat and cat['service_id'] else "S0"
-                br_code = br['brand_code'] if br and br['brand_code'] else "GEN"
-                
-                product_id_code = f"{pid}{sol}{svc}{br_code}".replace(" ", "").upper()
-                uid = f"{new_opp_id}-{product_id_code}-{timestamp_now}{i}"
+            # C. Insert semua line dalam satu statement
+            # Lookup master_pillars & brands dilakukan di DB (LATERAL join), bukan per line dari Python
+            lines_json = json.dumps([
+                {
+                    "idx": i, "pillar": line['pillar'], "solution": line['solution'],
+                    "service": line['service'], "brand": line.get('brand'),
+                    "channel": line.get('channel'), "distributor_name": line.get('distributor_name'),
+                    "cost": line.get('cost', 0), "notes": line.get('notes', '')
+                }
+                for i, line in enumerate(product_lines)
+            ], default=str)
 
-                session.execute(text("""
+            ins_lines = text("""
+                WITH lines AS (
                     INSERT INTO opportunities (
                         uid, opportunity_id, product_id, presales_name, salesgroup_id, sales_name, 
                         responsible_name, opportunity_name, start_date, company_name, 
                         vertical_industry, pillar, solution, service, brand, channel, 
                         distributor_name, cost, notes, stage, stage_notes, created_at, updated_at
-                    ) VALUES (
-                        :uid, :oid, :pid, :pname, :sgid, :sname, 
-                        :pam, :oname, :sdate, :cname, 
-                        :vi, :plr, :sol, :svc, :br, :ch, 
-                        :dist, :cost, :note, :stage_val, :s_note, :now, :now
                     )
-                """), {
-                    "uid": uid, "oid": new_opp_id, "pid": product_id_code,
-                    "pname": parent_data['presales_name'], "sgid": parent_data['salesgroup_id'], 
-                    "sname": parent_data['sales_name'], "pam": parent_data['responsible_name'], 
-                    "oname": parent_data['opportunity_name'], "sdate": parent_data['start_date'],
-                    "cname": parent_data['company_name'], "vi": parent_data['vertical_industry'],
-                    "plr": line['pillar'], "sol": line['solution'], "svc": line['service'], 
-                    "br": line.get('brand'), "ch": line.get('channel'), "dist": line.get('distributor_name'), 
-                    "cost": line.get('cost', 0), "note": line.get('notes', ''), 
-                    "stage_val": parent_data.get('stage', 'Open'),
-                    "s_note": parent_data.get('stage_notes', ''), 
-                    "now": created_at
-                })
-                
-                created_uids.append({"uid": uid, "opportunity_id": new_opp_id})
+                    SELECT
+                        :oid || '-' || code.product_id || '-' || :ts || l.idx, :oid, code.product_id,
+                        :pname, :sgid, :sname,
+                        :pam, :oname, :sdate, :cname,
+                        :vi, l.pillar, l.solution, l.service, l.brand, l.channel,
+                        l.distributor_name, l.cost, l.notes, :stage_val, :s_note, :now, :now
+                    FROM jsonb_to_recordset(CAST(:lines AS jsonb)) AS l(
+                        idx int, pillar text, solution text, service text, brand text,
+                        channel text, distributor_name text, cost numeric, notes text
+                    )
+                    LEFT JOIN LATERAL (
+                        SELECT pillar_id, solution_id, service_id FROM master_pillars
+                        WHERE pillar_name = l.pillar AND solution_name = l.solution AND service_name = l.service
+                        LIMIT 1
+                    ) cat ON true
+                    LEFT JOIN LATERAL (
+                        SELECT brand_code FROM brands WHERE brand_name = l.brand LIMIT 1
+                    ) br ON true
+                    CROSS JOIN LATERAL (
+                        SELECT upper(replace(
+                            COALESCE(NULLIF(cat.pillar_id::text, ''), 'GEN') ||
+                            COALESCE(NULLIF(cat.solution_id::text, ''), '0') ||
+                            COALESCE(NULLIF(cat.service_id::text, ''), 'S0') ||
+                            COALESCE(NULLIF(br.brand_code::text, ''), 'GEN'),
+                        ' ', '')) AS product_id
+                    ) code
+                    RETURNING uid, opportunity_id
+                ),
+                history AS (
+                    -- Stage awal masuk ke riwayat stage (sekali per opportunity_id)
+                    INSERT INTO opportunity_stage_history (opportunity_id, from_stage, to_stage, changed_at, actor)
+                    SELECT :oid, NULL, :stage_val, :now, :pname
+                    WHERE NOT EXISTS (SELECT 1 FROM opportunity_stage_history WHERE opportunity_id = :oid)
+                )
+                SELECT uid, opportunity_id FROM lines
+            """)
+            inserted = session.execute(ins_lines, {
+                "oid": new_opp_id, "ts": uid_stamp, "lines": lines_json,
+                "pname": parent_data['presales_name'], "sgid": parent_data['salesgroup_id'], 
+                "sname": parent_data['sales_name'], "pam": parent_data['responsible_name'], 
+                "oname": parent_data['opportunity_name'], "sdate": parent_data['start_date'],
+                "cname": parent_data['company_name'], "vi": parent_data['vertical_industry'],
+                "stage_val": parent_data.get('stage', 'Open'),
+                "s_note": parent_data.get('stage_notes', ''), 
+                "now": created_at
+            }).mappings().all()
+
+            # Urutkan sesuai urutan line di form (suffix uid = stamp + index)
+            created_uids = sorted(
+                ({"uid": r['uid'], "opportunity_id": r['opportunity_id']} for r in inserted),
+                key=lambda x: int(x['uid'].rsplit('-', 1)[-1])
+            )
             
-            # Log Activity (TETAP SAMA)
-            log_q = text("INSERT INTO activity_logs (timestamp, opportunity_name, user_name, action, field, new_value) VALUES (:ts, :oname, :user, 'CREATE', 'New Opportunity', :val)")
-            session.execute(log_q, {
-                "ts": created_at, "oname": parent_data['opportunity_name'], 
-                "user": parent_data['presales_name'], "val": f"Created {len(product_lines)} lines. ID: {new_opp_id}"
-            })
+            # Log Activity ditulis oleh trigger audit (migrations/003_audit_triggers.sql)
             
+            result = _finish_submission(session, submission_id, {
+                "status": 200, "message": "Opportunity successfully added!", "data": created_uids
+            })
             session.commit()
-            return {"status": 200, "message": "Opportunity successfully added!", "data": created_uids}
+            _pin_primary()
+            _invalidate_opportunities([new_opp_id])
+            return result
             
     except Exception as e:
         return {"status": 500, "message": f"Database Error: {str(e)}"}
 
+# Kolom staging bulk import (urutan = urutan kolom COPY, lihat importer.py)
+IMPORT_STAGING_COLUMNS = [
+    'row_no', 'opportunity_name', 'presales_name', 'responsible_name', 'salesgroup_id', 'sales_name',
+    'company_name', 'vertical_industry', 'start_date', 'pillar', 'solution', 'service', 'brand',
+    'cost', 'channel', 'distributor_name', 'notes', 'stage', 'stage_notes'
+]
+
+def bulk_import_opportunities(lines_df, user):
+    """
+    Import banyak line sekaligus (hasil importer.validate_import).
+    COPY ke temp table lalu merge ke description, sales_opportunities, opportunities
+    dan riwayat stage dalam satu transaksi. rows_id baru diambil dari sequence
+    sekaligus untuk semua nama opportunity baru.
+    """
+    if lines_df is None or lines_df.empty:
+        return {"status": 400, "message": "No valid lines to import"}
+
+    staging_ddl = text("""
+        CREATE TEMP TABLE import_staging (
+            row_no int, opportunity_name text, presales_name text, responsible_name text,
+            salesgroup_id text, sales_name text, company_name text, vertical_industry text,
+            start_date date, pillar text, solution text, service text, brand text,
+            cost numeric, channel text, distributor_name text, notes text, stage text, stage_notes text
+        ) ON COMMIT DROP
+    """)
+
+    # rows_id (Q3xxxx) untuk nama baru, satu nextval per nama dalam satu statement
+    descriptions_q = text("""
+        INSERT INTO description (rows_id, description)
+        SELECT 'Q3' || lpad(n::text, greatest(4, length(n::text)), '0'), opportunity_name
+        FROM (
+            SELECT opportunity_name, nextval('description_rows_id_seq') AS n
+            FROM (
+                SELECT DISTINCT s.opportunity_name FROM import_staging s
+                WHERE NOT EXISTS (SELECT 1 FROM description d WHERE d.description = s.opportunity_name)
+            ) names
+        ) alloc
+        ON CONFLICT (description) DO NOTHING
+    """)
+
+    merge_q = text("""
+        WITH actor AS (
+            SELECT set_config('app.actor', :actor, true) AS name
+        ),
+        opp AS (
+            SELECT s.*, s.salesgroup_id || d.rows_id AS opportunity_id
+            FROM import_staging s
+            JOIN description d ON d.description = s.opportunity_name
+        ),
+        header AS (
+            INSERT INTO sales_opportunities (
+                opportunity_id, opportunity_name, salesgroup_id, sales_name, stage, created_at, updated_at
+            )
+            SELECT DISTINCT ON (opportunity_id)
+                   opportunity_id, opportunity_name, salesgroup_id, sales_name, stage, :now, :now
+            FROM opp
+            ORDER BY opportunity_id, row_no
+            ON CONFLICT (opportunity_id) DO NOTHING
+            RETURNING opportunity_id
+        ),
+        lines AS (
+            INSERT INTO opportunities (
+                uid, opportunity_id, product_id, presales_name, salesgroup_id, sales_name,
+                responsible_name, opportunity_name, start_date, company_name,
+                vertical_industry, pillar, solution, service, brand, channel,
+                distributor_name, cost, notes, stage, stage_notes, created_at, updated_at
+            )
+            SELECT
+                opp.opportunity_id || '-' || code.product_id || '-' || :ts || opp.row_no,
+                opp.opportunity_id, code.product_id, opp.presales_name, opp.salesgroup_id, opp.sales_name,
+                opp.responsible_name, opp.opportunity_name, opp.start_date, opp.company_name,
+                opp.vertical_industry, opp.pillar, opp.solution, opp.service, opp.brand, opp.channel,
+                opp.distributor_name, opp.cost, COALESCE(opp.notes, ''), opp.stage,
+                COALESCE(opp.stage_notes, ''), :now, :now
+            FROM opp
+            LEFT JOIN LATERAL (
+                SELECT pillar_id, solution_id, service_id FROM master_pillars
+                WHERE pillar_name = opp.pillar AND solution_name = opp.solution AND service_name = opp.service
+                LIMIT 1
+            ) cat ON true
+            LEFT JOIN LATERAL (
+                SELECT brand_code FROM brands WHERE brand_name = opp.brand LIMIT 1
+            ) br ON true
+            CROSS JOIN LATERAL (
+                SELECT upper(replace(
+                    COALESCE(NULLIF(cat.pillar_id::text, ''), 'GEN') ||
+                    COALESCE(NULLIF(cat.solution_id::text, ''), '0') ||
+                    COALESCE(NULLIF(cat.service_id::text, ''), 'S0') ||
+                    COALESCE(NULLIF(br.brand_code::text, ''), 'GEN'),
+                ' ', '')) AS product_id
+            ) code
+            RETURNING opportunity_id
+        ),
+        history AS (
+            INSERT INTO opportunity_stage_history (opportunity_id, from_stage, to_stage, changed_at, actor)
+            SELECT DISTINCT ON (opp.opportunity_id) opp.opportunity_id, NULL, opp.stage, :now, :actor
+            FROM opp
+            WHERE NOT EXISTS (
+                SELECT 1 FROM opportunity_stage_history h WHERE h.opportunity_id = opp.opportunity_id
+            )
+            ORDER BY opp.opportunity_id, opp.row_no
+        )
+        SELECT (SELECT COUNT(*) FROM lines) AS lines,
+               (SELECT COUNT(DISTINCT opportunity_id) FROM lines) AS opportunities,
+               (SELECT COUNT(*) FROM header) AS new_headers
+        FROM actor
+    """)
+
+    try:
+        buf = io.StringIO()
+        lines_df[IMPORT_STAGING_COLUMNS].to_csv(buf, index=False, header=False)
+        buf.seek(0)
+
+        with get_conn(long=True).session as session:
+            session.execute(staging_ddl)
+            # COPY lewat koneksi psycopg2 yang sama (masih di transaksi session ini)
+            dbapi_conn = session.connection().connection
+            with dbapi_conn.cursor() as cur:
+                cur.copy_expert(
+                    f"COPY import_staging ({', '.join(IMPORT_STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buf
+                )
+            session.execute(text("ANALYZE import_staging"))
+            session.execute(descriptions_q)
+            summary = session.execute(merge_q, {
+                "actor": user, "ts": str(int(time.time())), "now": datetime.now()
+            }).mappings().one()
+            session.commit()
+            _pin_primary()
+            _invalidate_opportunities()
+            return {
+                "status": 200,
+                "message": f"Imported {summary['lines']} lines into {summary['opportunities']} opportunities.",
+                "data": dict(summary)
+            }
+    except Exception as e:
+        return {"status": 500, "message": f"Database Error: {str(e)}"}
+
+def _update_with_audit(session, table, key_col, key_val, set_exprs, user, params=None):
+    """
+    UPDATE satu baris dalam SATU statement (CTE), dengan actor audit ikut di-set.
+    Diff per field ditulis ke activity_logs oleh trigger (migrations/003_audit_triggers.sql).
+    - set_exprs: {kolom: ekspresi SQL}. Boleh merujuk baris lama lewat alias `prev`
+      dan parameter bind dari `params`.
+    Return: dict baris setelah update, atau None jika key tidak ditemukan.
+    """
+    set_sql = ",\n                ".join(f"{col} = {expr}" for col, expr in set_exprs.items())
+    query = text(f"""
+        WITH actor AS (
+            SELECT set_config('app.actor', :_user, true) AS name
+        ),
+        prev AS (
+            SELECT * FROM {table} WHERE {key_col} = :_key FOR UPDATE
+        )
+        UPDATE {table} t SET
+                {set_sql}
+        FROM prev CROSS JOIN actor
+        WHERE t.{key_col} = prev.{key_col}
+        RETURNING t.*
+    """)
+    row = session.execute(query, {**(params or {}), "_key": key_val, "_user": user or ""}).mappings().first()
+    return dict(row) if row else None
+
 def update_lead(lead_data):
-    # Simple update (Cost/Notes)
+    # Simple update (Cost/Notes), log perubahan via trigger audit. Satu round trip.
     uid = lead_data.get('uid')
     cost = lead_data.get('cost')
     notes = lead_data.get('notes')
     user = lead_data.get('user')
     
     try:
-        with conn.session as session:
-            old = session.execute(text("SELECT cost, notes FROM opportunities WHERE uid=:u"), {"u": uid}).mappings().first()
-            
-            upd = text("UPDATE opportunities SET cost=:c, notes=:n, updated_at=NOW() WHERE uid=:u")
-            session.execute(upd, {"c": cost, "n": notes, "u": uid})
-            
-            # Log Cost Change
-            if old and float(old['cost'] or 0) != float(cost):
-                log = text("INSERT INTO activity_logs (timestamp, user_name, action, field, old_value, new_value) VALUES (NOW(), :u, 'UPDATE', 'Cost', :ov, :nv)")
-                session.execute(log, {"u": user, "ov": str(old['cost']), "nv": str(cost)})
-
-            # Log Notes Change
-            if old and str(old['notes'] or "") != str(notes):
-                log = text("INSERT INTO activity_logs (timestamp, user_name, action, field, old_value, new_value) VALUES (NOW(), :u, 'UPDATE', 'Notes', :ov, :nv)")
-                session.execute(log, {"u": user, "ov": str(old['notes']), "nv": str(notes)})
+        with get_conn().session as session:
+            row = _update_with_audit(
+                session, "opportunities", "uid", uid,
+                set_exprs={"cost": ":c", "notes": ":n", "updated_at": "NOW()"},
+                user=user,
+                params={"c": cost, "n": notes}
+            )
+            if not row: return {"status": 404, "message": "UID not found"}
                 
             session.commit()
+            _pin_primary()
+            _invalidate_opportunities([row['opportunity_id']])
+            _cache_lead_row(row)
             return {"status": 200, "message": "Updated successfully"}
     except Exception as e:
         return {"status": 500, "message": str(e)}
 
+def update_leads_batch(changes, user):
+    """
+    Simpan banyak perubahan cost/notes dalam SATU transaksi & SATU UPDATE.
+    changes: [{"uid": ..., "cost": ..., "notes": ...}], hanya berisi baris & field yang berubah
+    (field yang tidak ada di dict tidak disentuh). Diff per field tetap dicatat trigger audit.
+    """
+    rows = [
+        {
+            "uid": c['uid'],
+            "cost": c.get('cost'), "has_cost": 'cost' in c,
+            "notes": c.get('notes'), "has_notes": 'notes' in c
+        }
+        for c in (changes or []) if c.get('uid')
+    ]
+    if not rows:
+        return {"status": 400, "message": "No changes to save"}
+
+    query = text("""
+        WITH actor AS (
+            SELECT set_config('app.actor', :usr, true) AS name
+        ),
+        c AS (
+            SELECT * FROM jsonb_to_recordset(CAST(:rows AS jsonb)) AS c(
+                uid text, cost numeric, has_cost boolean, notes text, has_notes boolean
+            )
+        )
+        UPDATE opportunities o SET
+            cost = CASE WHEN c.has_cost THEN c.cost ELSE o.cost END,
+            notes = CASE WHEN c.has_notes THEN c.notes ELSE o.notes END,
+            updated_at = NOW()
+        FROM c CROSS JOIN actor
+        WHERE o.uid = c.uid
+        RETURNING o.*
+    """)
+    try:
+        with get_conn().session as session:
+            updated = [dict(r) for r in session.execute(query, {
+                "usr": user or "", "rows": json.dumps(rows, default=str)
+            }).mappings().all()]
+            session.commit()
+            _pin_primary()
+
+        _invalidate_opportunities({r['opportunity_id'] for r in updated})
+        for r in updated:
+            _cache_lead_row(r)
+        updated_uids = {r['uid'] for r in updated}
+        return {
+            "status": 200,
+            "message": f"{len(updated)} line(s) updated.",
+            "data": {"updated": len(updated), "missing": [r['uid'] for r in rows if r['uid'] not in updated_uids]}
+        }
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
 def update_full_opportunity(payload):
     # Full Edit with Re-ID logic
     uid = payload.get('uid')
+
+    # 1. Re-calculate ID based on potentially new Sales Group
+    #    rows_id dari tabel description, fallback ke pola Q3xxxx / 6 karakter terakhir ID lama
+    new_opp_id_sql = """:sg || COALESCE(
+                    (SELECT d.rows_id FROM description d WHERE d.description = prev.opportunity_name LIMIT 1),
+                    substring(prev.opportunity_id FROM 'Q3[0-9]+'),
+                    right(prev.opportunity_id, 6)
+                )"""
+    # 2. Update UID (preserve timestamp part)
+    new_uid_sql = f"""{new_opp_id_sql} || '-' || prev.product_id || '-' ||
+                CASE WHEN prev.uid ~ '-.*-' THEN substring(prev.uid FROM '[^-]*$')
+                     ELSE floor(extract(epoch FROM NOW()))::bigint::text END"""
+
     try:
-        with conn.session as session:
-            old_data = session.execute(text("SELECT * FROM opportunities WHERE uid=:uid"), {"uid": uid}).mappings().first()
-            if not old_data: return {"status": 404, "message": "UID not found"}
-            
-            # 1. Re-calculate ID based on potentially new Sales Group
-            rows_id_part = ""
-            desc_res = session.execute(text("SELECT rows_id FROM description WHERE description=:d"), {"d": old_data['opportunity_name']}).mappings().first()
-            if desc_res:
-                rows_id_part = desc_res['rows_id']
-            else:
-                match = re.search(r'(Q3\d+)', old_data['opportunity_id'])
-                rows_id_part = match.group(1) if match else old_data['opportunity_id'][-6:]
-            
-            new_opp_id = f"{payload['salesgroup_id']}{rows_id_part}"
-            
-            # 2. Update UID (preserve timestamp part)
-            parts = old_data['uid'].split('-')
-            ts_part = parts[-1] if len(parts) >=3 else str(int(time.time()))
-            new_uid = f"{new_opp_id}-{old_data['product_id']}-{ts_part}"
-            
-            # 3. Execute Update
-            upd_q = text("""
-                UPDATE opportunities SET
-                    uid=:nuid, opportunity_id=:noid, salesgroup_id=:sg, sales_name=:sn,
-                    responsible_name=:pam, pillar=:p, solution=:s, service=:svc,
-                    brand=:b, company_name=:cn, vertical_industry=:vi, distributor_name=:dn,
-                    updated_at=NOW()
-                WHERE uid=:ouid
-            """)
-            session.execute(upd_q, {
-                "nuid": new_uid, "noid": new_opp_id, "sg": payload['salesgroup_id'],
-                "sn": payload['sales_name'], "pam": payload['responsible_name'],
-                "p": payload['pillar'], "s": payload['solution'], "svc": payload['service'],
-                "b": payload['brand'], "cn": payload['company_name'],
-                "vi": payload['vertical_industry'], "dn": payload['distributor_name'],
-                "ouid": uid
-            })
+        with get_conn().session as session:
+            # 3. Execute Update (audit per field via trigger)
+            row = _update_with_audit(
+                session, "opportunities", "uid", uid,
+                set_exprs={
+                    "uid": new_uid_sql, "opportunity_id": new_opp_id_sql,
+                    "salesgroup_id": ":sg", "sales_name": ":sn", "responsible_name": ":pam",
+                    "pillar": ":p", "solution": ":s", "service": ":svc",
+                    "brand": ":b", "company_name": ":cn", "vertical_industry": ":vi",
+                    "distributor_name": ":dn", "updated_at": "NOW()"
+                },
+                user=payload.get('user'),
+                params={
+                    "sg": payload['salesgroup_id'], "sn": payload['sales_name'],
+                    "pam": payload['responsible_name'], "p": payload['pillar'],
+                    "s": payload['solution'], "svc": payload['service'],
+                    "b": payload['brand'], "cn": payload['company_name'],
+                    "vi": payload['vertical_industry'], "dn": payload['distributor_name']
+                }
+            )
+            if not row: return {"status": 404, "message": "UID not found"}
             
             session.commit()
-            return {"status": 200, "message": "Full Data Updated!", "data": {"uid": new_uid}}
+            _pin_primary()
+            # opportunity_id bisa berubah (re-ID), ID lama tidak diketahui di sini
+            _invalidate_opportunities()
+            _cache_lead_row(row)
+            return {"status": 200, "message": "Full Data Updated!", "data": {"uid": row['uid']}}
     except Exception as e:
         return {"status": 500, "message": str(e)}
     
-def update_opportunity_stage_bulk_enhanced(opp_id, new_stage, notes, manual_date, user, closing_reason=None):
+def update_opportunity_stage_batch(opp_ids, new_stage, notes, manual_date, user, closing_reason=None):
+    """
+    Engine tunggal perpindahan stage (satu atau BANYAK opportunity ID sekaligus).
+    Dalam SATU statement (CTE):
+      1. Baca stage saat ini & validasi transisi ke stage_pipeline.allowed_next_stages
+         (NULL = bebas, lihat migrations/004_stage_transitions.sql)
+      2. Update detail line (opportunities) & header (sales_opportunities), set-based
+      3. Append ke opportunity_stage_history jika stage benar-benar berpindah
+    Activity log per field ditulis oleh trigger audit.
+    Return data: hasil per ID -> opportunity_id, from_stage, lines_updated, header_updated, status.
+    """
+    ids = list(dict.fromkeys(str(i).strip() for i in (opp_ids or []) if str(i).strip()))
+    if not ids:
+        return {"status": 400, "message": "No Opportunity ID given"}
+
     try:
-        with conn.session as session:
-            # 1. Update Tabel Opportunities (Detail) - KODE LAMA
-            if closing_reason:
-                query_upd = text("""
-                    UPDATE opportunities 
-                    SET stage = :stg, stage_notes = :note, closing_reason = :reason, closing_notes = :note, updated_at = :date
-                    WHERE opportunity_id = :oid
-                """)
-                params = {"stg": new_stage, "note": notes, "reason": closing_reason, "date": manual_date, "oid": opp_id}
-            else:
-                query_upd = text("""
-                    UPDATE opportunities 
-                    SET stage = :stg, stage_notes = :note, updated_at = :date
-                    WHERE opportunity_id = :oid
-                """)
-                params = {"stg": new_stage, "note": notes, "date": manual_date, "oid": opp_id}
-            
-            session.execute(query_upd, params)
-
-            # --- [BARU] SYNC UPDATE KE TABEL SALES_OPPORTUNITIES (HEADER) ---
-            # Agar Sales App juga melihat perubahan status ini
-            if closing_reason:
-                query_sales = text("""
-                    UPDATE sales_opportunities
-                    SET stage = :stg, closing_reason = :reason, sales_notes = :note, updated_at = :date
-                    WHERE opportunity_id = :oid
-                """)
-            else:
-                query_sales = text("""
-                    UPDATE sales_opportunities
-                    SET stage = :stg, sales_notes = :note, updated_at = :date
-                    WHERE opportunity_id = :oid
-                """)
-            
-            # Gunakan parameter yang sama karena nama kolom & valuenya cocok
-            session.execute(query_sales, params)
-            # ---------------------------------------------------------------
-
-            # 2. Log Activity (TETAP SAMA)
-            log_msg = f"Stage updated to {new_stage}"
-            if closing_reason:
-                log_msg += f" (Reason: {closing_reason})"
-            
-            query_log = text("""
-                INSERT INTO activity_logs (timestamp, opportunity_name, user_name, action, field, new_value)
-                VALUES (NOW(), :oid, :usr, 'UPDATE', 'Stage Progression', :val)
+        with get_conn().session as session:
+            query = text("""
+                WITH actor AS (
+                    SELECT set_config('app.actor', :usr, true) AS name
+                ),
+                ids AS (
+                    SELECT t.opportunity_id, t.pos
+                    FROM unnest(CAST(:ids AS text[])) WITH ORDINALITY AS t(opportunity_id, pos)
+                ),
+                checked AS (
+                    SELECT ids.opportunity_id, ids.pos, cur.stage AS from_stage,
+                           CASE
+                               WHEN cur.opportunity_id IS NULL THEN 'Not Found'
+                               WHEN cur.stage IS NOT DISTINCT FROM :stg
+                                    OR rule.allowed_next_stages IS NULL
+                                    OR :stg = ANY(rule.allowed_next_stages) THEN 'Updated'
+                               ELSE 'Invalid Transition'
+                           END AS status
+                    FROM ids
+                    LEFT JOIN LATERAL (
+                        SELECT o.opportunity_id, o.stage FROM opportunities o
+                        WHERE o.opportunity_id = ids.opportunity_id
+                        ORDER BY o.updated_at DESC NULLS LAST
+                        LIMIT 1
+                    ) cur ON true
+                    LEFT JOIN stage_pipeline rule
+                        ON rule.stage_type = 'PRESALES' AND rule.stage_name = cur.stage
+                ),
+                ok AS (
+                    SELECT opportunity_id, from_stage FROM checked WHERE status = 'Updated'
+                ),
+                lines AS (
+                    UPDATE opportunities o
+                    SET stage = :stg,
+                        stage_notes = :note,
+                        closing_reason = COALESCE(:reason, o.closing_reason),
+                        closing_notes = CASE WHEN :reason IS NULL THEN o.closing_notes ELSE :note END,
+                        updated_at = :date
+                    FROM ok CROSS JOIN actor
+                    WHERE o.opportunity_id = ok.opportunity_id
+                    RETURNING o.opportunity_id
+                ),
+                headers AS (
+                    -- SYNC KE HEADER SALES agar Sales App juga melihat perubahan status
+                    UPDATE sales_opportunities s
+                    SET stage = :stg,
+                        sales_notes = :note,
+                        closing_reason = COALESCE(:reason, s.closing_reason),
+                        updated_at = :date
+                    FROM ok CROSS JOIN actor
+                    WHERE s.opportunity_id = ok.opportunity_id
+                    RETURNING s.opportunity_id
+                ),
+                history AS (
+                    INSERT INTO opportunity_stage_history (opportunity_id, from_stage, to_stage, changed_at, actor, reason)
+                    SELECT ok.opportunity_id, ok.from_stage, :stg, COALESCE(CAST(:date AS timestamptz), NOW()), :usr, :reason
+                    FROM ok
+                    WHERE ok.from_stage IS DISTINCT FROM :stg
+                )
+                SELECT c.opportunity_id, c.from_stage, c.status,
+                       (SELECT count(*) FROM lines l WHERE l.opportunity_id = c.opportunity_id) AS lines_updated,
+                       EXISTS (SELECT 1 FROM headers h WHERE h.opportunity_id = c.opportunity_id) AS header_updated
+                FROM checked c
+                ORDER BY c.pos
             """)
-            session.execute(query_log, {"oid": opp_id, "usr": user, "val": log_msg})
-            
+            rows = session.execute(query, {
+                "usr": user, "ids": ids, "stg": new_stage, "note": notes,
+                "reason": closing_reason, "date": manual_date
+            }).mappings().all()
             session.commit()
-            return {"status": 200, "message": "Stage updated successfully."}
+            _pin_primary()
+        _invalidate_opportunities(ids)
+
+        results = [
+            {
+                "opportunity_id": r['opportunity_id'],
+                "from_stage": r['from_stage'],
+                "lines_updated": int(r['lines_updated']),
+                "header_updated": bool(r['header_updated']),
+                "status": r['status']
+            }
+            for r in rows
+        ]
+        n_ok = sum(1 for r in results if r['status'] == "Updated")
+        return {
+            "status": 200,
+            "message": f"Stage updated for {n_ok} of {len(results)} opportunities.",
+            "data": results
+        }
 
     except Exception as e:
         return {"status": 500, "message": str(e)}
 
+def update_opportunity_stage_bulk_enhanced(opp_id, new_stage, notes, manual_date, user, closing_reason=None):
+    """
+    Update stage untuk semua item dalam satu opportunity ID.
+    Mendukung input Closing Reason dan Closing Notes.
+    """
+    res = update_opportunity_stage_batch([opp_id], new_stage, notes, manual_date, user, closing_reason)
+    if res['status'] != 200:
+        return res
+
+    result = res['data'][0]
+    if result['status'] == "Not Found":
+        return {"status": 404, "message": "Opportunity ID not found"}
+    if result['status'] == "Invalid Transition":
+        return {"status": 409, "message": f"Stage change from '{result['from_stage']}' to '{new_stage}' is not allowed."}
+    return {"status": 200, "message": "Stage updated successfully."}
+
 def get_opportunity_summary(opp_id):
     """Mengambil ringkasan opportunity berdasarkan ID untuk preview."""
+    with _cache_lock:
+        cached, generation = _summary_cache.get(opp_id), _cache_generation
+    if cached is not None:
+        return {"status": 200, "data": dict(cached)}
+
     try:
         # HAPUS 'text()' dan gunakan string biasa (f-string atau string biasa)
         # conn.query lebih suka string murni.
@@ -349,10 +1242,12 @@ def get_opportunity_summary(opp_id):
         """
         
         # Jalankan query dengan string biasa
-        df = conn.query(query_str, params={"oid": opp_id}, ttl=0)
+        df = get_conn().query(query_str, params={"oid": opp_id}, ttl=0)
         
         if not df.empty:
-            return {"status": 200, "data": df.iloc[0].to_dict()}
+            data = df.iloc[0].to_dict()
+            _cache_put(_summary_cache, opp_id, data, generation)
+            return {"status": 200, "data": dict(data)}
         else:
             return {"status": 404, "message": "Opportunity ID not found"}
     except Exception as e:
@@ -361,18 +1256,11 @@ def get_opportunity_summary(opp_id):
 def get_lead_by_uid(uid):
     """
     Mengambil data spesifik berdasarkan UID string.
-    Berfungsi sebagai wrapper atau direct query.
+    Berfungsi sebagai wrapper atau direct query (lewat cache per uid).
     """
-    # Pastikan query ini sesuai dengan tabel Anda
-    query = "SELECT * FROM opportunities WHERE uid = :uid"
-    
-    # Jalankan query
-    df = conn.query(query, params={"uid": uid}, ttl=0)
-    
-    if not df.empty:
-        # Pre-processing datetime objects to string agar JSON serializable (opsional tapi aman)
-        data = df.to_dict('records')
-        return {"status": 200, "data": data}
+    row = _fetch_lead_row(uid)
+    if row:
+        return {"status": 200, "data": [row]}
     else:
         return {"status": 404, "message": "UID Not Found"}
     
@@ -386,7 +1274,7 @@ def generate_cps_id(sales_group_id):
     Contoh: CPS-ENT10005
     """
     try:
-        with conn.session as session:
+        with get_conn().session as session:
             # Cari ID terakhir di tabel cps_opportunities
             # Kita ambil angka 4 digit terakhir dari kolom cps_id
             # Asumsi format selalu konsisten CPS-XXX0000
@@ -411,7 +1299,41 @@ def generate_cps_id(sales_group_id):
         # Fallback jika error, gunakan timestamp agar tidak duplicate
         return f"CPS-{sales_group_id}{int(time.time())}"
 
-def add_cps_opportunity(parent_data, cps_lines):
+def _build_cps_rows(cps_id, cps_lines, uid_stamp):
+    """Baris cps_opportunities (uid & cps_product_id per configuration line), belum di-insert."""
+    # Mapping Dictionaries (Dipakai berulang dalam loop)
+    ms_map = {"Easy Access": "MS1", "Easy Guard": "MS2", "Easy Connect": "MS3"}
+    so_map = {"No Service Offering": "S1", "Full Stack": "S2", "WiFi Only": "S3"}
+    p_map = {"Launch": "P1", "Growth": "P2", "Accelerate": "P3"}
+    sla_map = {"Core": "SLA1", "Pro": "SLA2", "Elite": "SLA3"}
+    se_map = {"Internal": "SE1", "Subcont": "SE2"}
+    
+    rows = []
+    for i, line in enumerate(cps_lines):
+        # A. Generate UID Unik per Baris
+        uid = f"{cps_id}-{uid_stamp}-{i}"
+        
+        # B. Generate Product ID per Baris
+        ms_code = ms_map.get(line['managed_service'], "MS0")
+        so_code = so_map.get(line['service_offering'], "S1") 
+        p_code = p_map.get(line['package'], "P0")
+        sla_code = sla_map.get(line['sla_level'], "SLA0")
+        se_code = se_map.get(line['service_execution'], "SE0")
+        
+        rows.append({
+            "uid": uid,
+            "cps_product_id": f"{ms_code}-{so_code}-{p_code}-{sla_code}-{se_code}",
+            "managed_service": line['managed_service'],
+            "service_offering": line['service_offering'],
+            "package": line['package'],
+            "sla_level": line['sla_level'],
+            "service_execution": line['service_execution'],
+            "cost": line['cost'],
+            "notes": line['notes']
+        })
+    return rows
+
+def add_cps_opportunity(parent_data, cps_lines, submission_id=None):
     """
     Menyimpan data CPS Opportunity dengan Multi-Configuration support.
     Menginsert banyak baris dengan satu CPS ID yang sama.
@@ -420,162 +1342,306 @@ def add_cps_opportunity(parent_data, cps_lines):
         # 1. Generate CPS ID (Satu ID untuk satu batch submission)
         cps_id = generate_cps_id(parent_data['salesgroup_id'])
         
-        # Mapping Dictionaries (Dipakai berulang dalam loop)
-        ms_map = {"Easy Access": "MS1", "Easy Guard": "MS2", "Easy Connect": "MS3"}
-        so_map = {"No Service Offering": "S1", "Full Stack": "S2", "WiFi Only": "S3"}
-        p_map = {"Launch": "P1", "Growth": "P2", "Accelerate": "P3"}
-        sla_map = {"Core": "SLA1", "Pro": "SLA2", "Elite": "SLA3"}
-        se_map = {"Internal": "SE1", "Subcont": "SE2"}
-        
-        timestamp_now = int(time.time())
         created_at = datetime.now() # Gunakan satu waktu yang sama
         
-        with conn.session as session:
+        # Susun semua configuration line dulu, lalu insert dalam SATU statement
+        rows = _build_cps_rows(cps_id, cps_lines, _line_uid_stamp(submission_id))
+        
+        with get_conn().session as session:
+            previous = _claim_submission(session, submission_id, "add_cps_opportunity")
+            if previous is not None:
+                return previous
+
+            # C. Query Insert (Log Activity sekali per batch ditulis oleh trigger audit)
+            query = text("""
+                WITH actor AS (
+                    SELECT set_config('app.actor', :pname, true) AS name
+                )
+                INSERT INTO cps_opportunities (
+                    uid, cps_id, cps_product_id,
+                    managed_service, service_offering, package, sla_level, service_execution,
+                    presales_name, salesgroup_id, sales_name, responsible_name,
+                    company_name, vertical_industry, stage,
+                    opportunity_name, start_date,
+                    cost, notes, created_at, updated_at
+                )
+                SELECT
+                    l.uid, :cps_id, l.cps_product_id,
+                    l.managed_service, l.service_offering, l.package, l.sla_level, l.service_execution,
+                    :pname, :sgid, :sname, :pam,
+                    :comp, :vert, :stg,
+                    :oname, :sdate,
+                    l.cost, l.notes, :now, :now
+                FROM jsonb_to_recordset(CAST(:lines AS jsonb)) AS l(
+                    uid text, cps_product_id text,
+                    managed_service text, service_offering text, package text,
+                    sla_level text, service_execution text, cost numeric, notes text
+                )
+                CROSS JOIN actor
+            """)
             
-            # LOOPING SETIAP CONFIGURATION LINE
-            for i, line in enumerate(cps_lines):
-                # A. Generate UID Unik per Baris
-                uid = f"{cps_id}-{timestamp_now}-{i}"
-                
-                # B. Generate Product ID per Baris
-                ms_code = ms_map.get(line['managed_service'], "MS0")
-                so_code = so_map.get(line['service_offering'], "S1") 
-                p_code = p_map.get(line['package'], "P0")
-                sla_code = sla_map.get(line['sla_level'], "SLA0")
-                se_code = se_map.get(line['service_execution'], "SE0")
+            session.execute(query, {
+                "cps_id": cps_id,
+                "lines": json.dumps(rows, default=str),
                 
-                cps_product_id = f"{ms_code}-{so_code}-{p_code}-{sla_code}-{se_code}"
-                
-                # C. Query Insert
-                query = text("""
-                    INSERT INTO cps_opportunities (
-                        uid, cps_id, cps_product_id,
-                        managed_service, service_offering, package, sla_level, service_execution,
-                        presales_name, salesgroup_id, sales_name, responsible_name,
-                        company_name, vertical_industry, stage,
-                        opportunity_name, start_date,
-                        cost, notes, created_at, updated_at
-                    ) VALUES (
-                        :uid, :cps_id, :prod_id,
-                        :ms, :so, :pkg, :sla, :se,
-                        :pname, :sgid, :sname, :pam,
-                        :comp, :vert, :stg,
-                        :oname, :sdate,
-                        :cost, :note, :now, :now
-                    )
-                """)
+                # Data dari Parent (Header)
+                "pname": parent_data['presales_name'],
+                "sgid": parent_data['salesgroup_id'],
+                "sname": parent_data['sales_name'],
+                "pam": parent_data['responsible_name'],
+                "comp": parent_data['company_name'],
+                "vert": parent_data['vertical_industry'],
+                "stg": parent_data['stage'],
+                "oname": parent_data['opportunity_name'],
+                "sdate": parent_data['start_date'],
                 
-                session.execute(query, {
-                    "uid": uid,
-                    "cps_id": cps_id,
-                    "prod_id": cps_product_id,
-                    # Data dari Line
-                    "ms": line['managed_service'],
-                    "so": line['service_offering'],
-                    "pkg": line['package'],
-                    "sla": line['sla_level'],
-                    "se": line['service_execution'],
-                    "cost": line['cost'],
-                    "note": line['notes'],
-                    
-                    # Data dari Parent (Header)
-                    "pname": parent_data['presales_name'],
-                    "sgid": parent_data['salesgroup_id'],
-                    "sname": parent_data['sales_name'],
-                    "pam": parent_data['responsible_name'],
-                    "comp": parent_data['company_name'],
-                    "vert": parent_data['vertical_industry'],
-                    "stg": parent_data['stage'],
-                    "oname": parent_data['opportunity_name'],
-                    "sdate": parent_data['start_date'],
-                    
-                    "now": created_at
-                })
-            
-            # Log Activity (Sekali saja per batch)
-            log_msg = f"Created CPS Opp: {cps_id} ({len(cps_lines)} configs)"
-            session.execute(text("""
-                INSERT INTO activity_logs (timestamp, opportunity_name, user_name, action, field, new_value) 
-                VALUES (:now, :oid, :usr, 'CREATE', 'CPS Opportunity', :val)
-            """), {"now": created_at, "oid": cps_id, "usr": parent_data['presales_name'], "val": log_msg})
+                "now": created_at
+            })
             
+            result = _finish_submission(session, submission_id, {
+                "status": 200, "message": f"Success! Generated ID: {cps_id} with {len(cps_lines)} configurations."
+            })
             session.commit()
+            _pin_primary()
             
-        return {"status": 200, "message": f"Success! Generated ID: {cps_id} with {len(cps_lines)} configurations."}
+        return result
 
     except Exception as e:
         return {"status": 500, "message": str(e)}
-    
-    
-def update_opportunity_stage_bulk_enhanced(opp_id, new_stage, notes, manual_date, user, closing_reason=None):
+
+
+# ==============================================================================
+# SECTION 5: STORAGE ADAPTER
+# ==============================================================================
+# Fungsi di atas ditulis untuk Postgres. Dengan storage "sqlite", fungsi yang SQL-nya khusus
+# Postgres (lihat backend_sqlite.__all__) diganti versi SQLite dengan kontrak return yang sama;
+# sisanya (master data, lookup per uid, paging, summary, cache) tetap dari modul ini.
+# Harus jalan sebelum SECTION 6, supaya wrapper retry / circuit breaker membungkus versi SQLite.
+def _install_storage_adapter():
+    """Pasang fungsi backend_sqlite ke modul ini jika storage "sqlite". Tidak bergantung urutan import."""
+    if storage_backend() != "sqlite":
+        return
+    import backend_sqlite
+    for name in backend_sqlite.__all__:
+        globals()[name] = getattr(backend_sqlite, name)
+
+_install_storage_adapter()
+
+
+# ==============================================================================
+# SECTION 6: RESILIENCE (RETRY, BACKOFF, CIRCUIT BREAKER)
+# ==============================================================================
+# Fungsi di atas menangkap Exception dan mengembalikan status 500. Error DB aslinya dicatat per
+# thread lewat event handle_error engine, lalu wrapper di bawah memutuskan:
+# - read : retry error transient diserahkan ke SQLConnection.query() (lihat READ_RETRY_ATTEMPTS);
+#          jika tetap gagal / circuit open -> hasil sukses terakhir untuk argumen yang sama ("stale")
+# - write: di-retry hanya jika aman (statement belum jalan, transaksi di-rollback server,
+#          atau write-nya idempotent); circuit open -> status 503, app jadi read-only
+# Circuit breaker: open setelah BREAKER_FAILURE_THRESHOLD panggilan berturut-turut gagal karena
+# error transient, lalu setelah BREAKER_RESET_SECONDS satu panggilan percobaan (half-open).
+RETRY_ATTEMPTS = 3
+# Read lewat SQLConnection.query() sudah di-retry 3x oleh Streamlit (OperationalError dll., engine
+# di-reset tiap kali). Retry luar di sini akan mengalikan jumlah percobaan (3 x 3) ke DB yang sedang
+# bermasalah, jadi read hanya satu percobaan luar; RETRY_ATTEMPTS hanya untuk write (session, tanpa retry).
+READ_RETRY_ATTEMPTS = 1
+RETRY_WAIT_MULTIPLIER = 0.2
+RETRY_WAIT_MAX_SECONDS = 2.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 30
+LAST_GOOD_MAXSIZE = 256
+DB_UNAVAILABLE_MESSAGE = "Database is temporarily unavailable (read-only mode). Please try again in a moment."
+
+_TRANSIENT_PGCODES = {"40001", "40P01", "53300", "57P01", "57P02", "57P03"}
+_ROLLED_BACK_PGCODES = {"40001", "40P01"}  # serialization failure / deadlock: transaksi sudah dibatalkan
+_QUERY_CANCELED_PGCODE = "57014"           # statement_timeout: query berat, retry hanya menambah beban
+
+# .last = (transient, safe_to_retry) dari error DB terakhir di thread ini,
+# .queried = ada statement yang benar-benar jalan di DB (bukan hit cache) sejak direset
+_db_error = threading.local()
+
+def _on_db_error(ctx):
+    orig = ctx.original_exception
+    pgcode = getattr(orig, "pgcode", None)
+    dbapi = getattr(ctx.dialect, "loaded_dbapi", None)
+    operational = dbapi is not None and isinstance(orig, dbapi.OperationalError)
+    if operational and ctx.dialect.name == "sqlite":
+        # sqlite3 memakai OperationalError juga untuk error SQL; yang transient hanya lock
+        operational = "locked" in str(orig) or "busy" in str(orig)
+    transient = ctx.is_disconnect or pgcode in _TRANSIENT_PGCODES or (operational and pgcode != _QUERY_CANCELED_PGCODE)
+    _db_error.last = (transient, ctx.statement is None or pgcode in _ROLLED_BACK_PGCODES)
+
+def _watch_engine(engine):
+    from sqlalchemy import event
+    event.listen(engine, "handle_error", _on_db_error)
+    event.listen(engine, "after_cursor_execute", _on_db_query)
+
+def _on_db_query(conn, cursor, statement, parameters, context, executemany):
+    _db_error.queried = True
+
+
+class _CircuitBreaker:
+    def __init__(self, threshold, reset_seconds):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.time() - self.opened_at >= self.reset_seconds else "open"
+
+    def allow(self):
+        """Boleh ke DB? Saat half-open hanya satu panggilan percobaan yang diloloskan."""
+        with self._lock:
+            state = self.state()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures, self.opened_at, self.trial_running = 0, None, False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.threshold:
+                self.opened_at = time.time()
+            self.trial_running = False
+
+    def release(self):
+        """Panggilan percobaan selesai tanpa menyentuh DB (misal dari cache): belum ada kesimpulan."""
+        with self._lock:
+            self.trial_running = False
+
+
+_breaker = _CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+_last_good = LRUCache(maxsize=LAST_GOOD_MAXSIZE)  # (fungsi, argumen) -> hasil sukses terakhir
+
+def get_db_health():
+    """Status circuit breaker untuk UI / API: state closed | open | half_open."""
+    state = _breaker.state()
+    retry_in = max(_breaker.reset_seconds - (time.time() - _breaker.opened_at), 0) if state == "open" else 0
+    return {"state": state, "failures": _breaker.failures, "retry_in_seconds": round(retry_in)}
+
+def _call_with_retry(fn, args, kwargs, retryable, attempts=RETRY_ATTEMPTS):
     """
-    Update stage untuk semua item dalam satu opportunity ID.
-    Mendukung input Closing Reason dan Closing Notes.
+    Jalankan fn dengan tenacity. Return (hasil, exception, error DB terakhir (transient, safe) / None).
+    _db_error.queried sesudahnya berlaku untuk percobaan terakhir.
     """
-    try:
-        # Konversi tanggal manual ke format timestamp DB
-        # Pastikan manual_date dikonversi ke string atau datetime yang sesuai dengan DB Anda
-        
-        with conn.session as session:
-            # 1. Update Tabel Opportunities
-            # Jika stage Closed, kita update kolom closing_reason dan closing_notes juga
-            # Notes dari UI masuk ke kolom 'stage_notes' atau 'closing_notes' (tergantung preferensi)
-            
-            # Query Dinamis
-            if closing_reason:
-                query_upd = text("""
-                    UPDATE opportunities 
-                    SET stage = :stg, 
-                        stage_notes = :note, 
-                        closing_reason = :reason,
-                        closing_notes = :note, -- Optional: Duplicate note ke kolom closing biar spesifik
-                        updated_at = :date
-                    WHERE opportunity_id = :oid
-                """)
-                params = {
-                    "stg": new_stage, 
-                    "note": notes, 
-                    "reason": closing_reason, 
-                    "date": manual_date, 
-                    "oid": opp_id
-                }
-            else:
-                # Update biasa (Bukan closing)
-                query_upd = text("""
-                    UPDATE opportunities 
-                    SET stage = :stg, 
-                        stage_notes = :note,
-                        updated_at = :date
-                    WHERE opportunity_id = :oid
-                """)
-                params = {
-                    "stg": new_stage, 
-                    "note": notes, 
-                    "date": manual_date, 
-                    "oid": opp_id
-                }
-            
-            session.execute(query_upd, params)
+    from tenacity import Retrying, retry_if_result, stop_after_attempt, wait_random_exponential
 
-            # 2. Catat Activity Log
-            log_msg = f"Stage updated to {new_stage}"
-            if closing_reason:
-                log_msg += f" (Reason: {closing_reason})"
-            
-            query_log = text("""
-                INSERT INTO activity_logs (timestamp, opportunity_name, user_name, action, field, new_value)
-                VALUES (NOW(), :oid, :usr, 'UPDATE', 'Stage', :val)
-            """)
-            
-            session.execute(query_log, {
-                "oid": opp_id, 
-                "usr": user, 
-                "val": log_msg
-            })
-            
-            session.commit()
-            
-        return {"status": 200, "message": "Stage updated successfully."}
+    def attempt():
+        _db_error.last, _db_error.queried = None, False
+        try:
+            return fn(*args, **kwargs), None, _db_error.last
+        except Exception as e:
+            return None, e, _db_error.last
 
-    except Exception as e:
-        return {"status": 500, "message": str(e)}
\ No newline at end of file
+    return Retrying(
+        stop=stop_after_attempt(attempts),
+        wait=wait_random_exponential(multiplier=RETRY_WAIT_MULTIPLIER, max=RETRY_WAIT_MAX_SECONDS),
+        retry=retry_if_result(lambda outcome: outcome[2] is not None and retryable(*outcome[2])),
+        retry_error_callback=lambda retry_state: retry_state.outcome.result(),
+    )(attempt)
+
+def _settle(err):
+    if err is None:
+        if getattr(_db_error, "queried", False):
+            _breaker.record_success()
+        else:
+            _breaker.release()  # dilayani cache / validasi tanpa ke DB: bukan bukti DB sehat
+    elif err[0]:
+        _breaker.record_failure()
+    else:
+        _breaker.release()  # error non-transient (SQL / data): bukan tanda DB tidak sehat
+
+def _resilient_read(fn, unavailable):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = (fn.__name__, repr(args), repr(sorted(kwargs.items())))
+        _db_error.read_from_db = False
+        if not _breaker.allow():
+            return _stale(key, unavailable if unavailable is not None else {"status": 503, "message": DB_UNAVAILABLE_MESSAGE})
+        result, exc, err = _call_with_retry(fn, args, kwargs, lambda transient, safe: transient, READ_RETRY_ATTEMPTS)
+        _settle(err)
+        if err is None and exc is None:
+            with _cache_lock:
+                _last_good[key] = result
+            _db_error.read_from_db = _db_error.queried
+            return result
+        if err is not None and err[0]:
+            # Error transient setelah semua retry: hasil sukses terakhir jika ada
+            result = _stale(key, None) or result
+            if result is not None:
+                return result
+        if exc is not None:
+            raise exc
+        return result
+    return wrapper
+
+def _stale(key, fallback):
+    """Hasil sukses terakhir untuk argumen yang sama (ditandai stale), atau fallback."""
+    with _cache_lock:
+        snapshot = _last_good.get(key)
+    if snapshot is None:
+        return fallback
+    if isinstance(snapshot, dict):
+        return {**snapshot, "stale": True, "message": "Database unavailable, showing last known data (read-only)."}
+    return snapshot
+
+def _resilient_write(fn, idempotent):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _breaker.allow():
+            return {"status": 503, "message": DB_UNAVAILABLE_MESSAGE}
+        # submission_id (lihat _claim_submission) membuat submit ulang idempotent
+        retry_safe = idempotent or bool(kwargs.get("submission_id"))
+        result, exc, err = _call_with_retry(fn, args, kwargs, lambda transient, safe: transient and (safe or retry_safe))
+        _settle(err)
+        if exc is not None:
+            raise exc
+        return result
+    return wrapper
+
+def last_read_from_db():
+    """
+    True jika read terakhir (di thread ini) benar-benar menjalankan query ke DB dan berhasil, bukan
+    hit cache (_lead_cache, conn.query ttl, ...) atau nilai pengganti saat circuit open / hasil
+    stale / fallback error. Cache di atas backend (misal st.cache_data di utils.get_master) hanya
+    boleh menyimpan hasil yang True.
+    """
+    return getattr(_db_error, "read_from_db", False)
+
+def is_unavailable(res):
+    """
+    True jika write barusan (di thread ini) gagal karena DB tidak bisa dijangkau: circuit open
+    atau error transient setelah semua retry. Dipakai write_queue.py untuk memutuskan antre vs error.
+    """
+    err = getattr(_db_error, "last", None)
+    return res.get("status") == 503 or (res.get("status") == 500 and err is not None and err[0])
+
+# Read: nilai pengganti jika circuit open & belum ada hasil sukses (None = dict status 503)
+_RESILIENT_READS = {
+    "get_master_presales": [], "get_activity_log_page": None, "get_all_leads_presales": None,
+    "get_leads_by_uids": None, "get_single_lead": None, "get_lead_by_uid": None,
+    "count_opportunities": None, "get_opportunities_page": None, "get_opportunity_lines": None,
+    "get_opportunity_summary": None, "search_opportunities": None, "get_pipeline_velocity": None,
+    "get_pipeline_cube": None, "get_pipeline_as_of": None, "get_pipeline_trend": None,
+}
+# Write: True = idempotent (nilai absolut / upsert), boleh di-retry walau statement sempat jalan
+_RESILIENT_WRITES = {
+    "add_multi_line_opportunity": False, "bulk_import_opportunities": False, "update_lead": True,
+    "update_leads_batch": True, "update_full_opportunity": False, "update_opportunity_stage_batch": False,
+    "add_cps_opportunity": False, "take_pipeline_snapshot": True,
+}
+for _name, _unavailable in _RESILIENT_READS.items():
+    globals()[_name] = _resilient_read(globals()[_name], _unavailable)
+for _name, _idempotent in _RESILIENT_WRITES.items():
+    globals()[_name] = _resilient_write(globals()[_name], _idempotent)
@@ -0,0 +1,88 @@
+"""
+Versi async (asyncio) dari fungsi backend.py, dengan kontrak return yang sama:
+{"status": ..., "data"/"message": ...}.
+
+SQL, cache per key, trigger audit dan routing replica tetap satu implementasi di
+backend.py. Setiap panggilan dijalankan di thread pool yang ukurannya sama dengan
+kapasitas pool koneksi DB, jadi query independen berjalan bersamaan tanpa
+mengantre koneksi berlebihan. Contoh dari script Streamlit (sync):
+
+    import backend_async as adb
+    res = adb.run(adb.gather_dict(
+        presales=adb.get_master_presales('getPresales'),
+        brands=adb.get_master_presales('getBrands'),
+    ))
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+import backend as db
+
+_executor = ThreadPoolExecutor(
+    max_workers=sum(cfg["pool_size"] + cfg["max_overflow"] for cfg in db.POOL_DEFAULTS.values()),
+    thread_name_prefix="backend-async"
+)
+
+
+async def run_in_pool(fn, *args, **kwargs):
+    """Jalankan fungsi backend sync di thread pool, membawa context sesi Streamlit pemanggil
+    (dibutuhkan read-your-writes di backend.get_read_conn)."""
+    ctx = get_script_run_ctx(suppress_warning=True)
+
+    def job():
+        thread = threading.current_thread()
+        add_script_run_ctx(thread, ctx)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            add_script_run_ctx(thread, None)
+
+    return await asyncio.get_running_loop().run_in_executor(_executor, job)
+
+def _async(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run_in_pool(fn, *args, **kwargs)
+    return wrapper
+
+async def gather_dict(**aws):
+    """Jalankan beberapa coroutine bersamaan, hasil dikembalikan sebagai dict dengan key yang sama."""
+    results = await asyncio.gather(*aws.values())
+    return dict(zip(aws.keys(), results))
+
+def run(coro):
+    """Jalankan coroutine dari kode sync (script Streamlit / job)."""
+    return asyncio.run(coro)
+
+
+# 1. READ OPERATIONS
+get_master_presales = _async(db.get_master_presales)
+get_activity_log_page = _async(db.get_activity_log_page)
+get_all_leads_presales = _async(db.get_all_leads_presales)
+get_single_lead = _async(db.get_single_lead)
+get_lead_by_uid = _async(db.get_lead_by_uid)
+get_leads_by_uids = _async(db.get_leads_by_uids)
+get_opportunity_lines = _async(db.get_opportunity_lines)
+get_opportunity_summary = _async(db.get_opportunity_summary)
+count_opportunities = _async(db.count_opportunities)
+get_opportunities_page = _async(db.get_opportunities_page)
+search_opportunities = _async(db.search_opportunities)
+get_pipeline_velocity = _async(db.get_pipeline_velocity)
+get_pipeline_cube = _async(db.get_pipeline_cube)
+get_pipeline_as_of = _async(db.get_pipeline_as_of)
+get_pipeline_trend = _async(db.get_pipeline_trend)
+
+# 2. WRITE OPERATIONS
+add_multi_line_opportunity = _async(db.add_multi_line_opportunity)
+bulk_import_opportunities = _async(db.bulk_import_opportunities)
+update_lead = _async(db.update_lead)
+update_leads_batch = _async(db.update_leads_batch)
+update_full_opportunity = _async(db.update_full_opportunity)
+update_opportunity_stage_batch = _async(db.update_opportunity_stage_batch)
+update_opportunity_stage_bulk_enhanced = _async(db.update_opportunity_stage_bulk_enhanced)
+add_cps_opportunity = _async(db.add_cps_opportunity)
+take_pipeline_snapshot = _async(db.take_pipeline_snapshot)
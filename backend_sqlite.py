@@ -0,0 +1,1180 @@
+"""
+Stand-in SQLite untuk backend.py: test, CI dan benchmark offline tanpa server Postgres.
+
+Aktifkan salah satu (dibaca oleh backend.storage_backend()):
+    PRESALES_STORAGE=sqlite:///presales_local.db      # env, dibaca duluan
+    [storage]                                          # secrets.toml
+    backend = "sqlite"
+    path = "presales_local.db"
+
+backend.py lalu memasang fungsi di __all__ (backend._install_storage_adapter, sebelum wrapper
+retry / circuit breaker) sebagai pengganti fungsi yang SQL-nya khusus Postgres (CTE yang menulis, jsonb_to_recordset, COPY, tsvector, fungsi snapshot). Fungsi lain
+(master data, lookup per uid, paging, summary, generate_cps_id) tetap dari backend.py lewat
+get_conn() di sini, termasuk cache per key & read-your-writes.
+
+Schema dibuat otomatis saat koneksi pertama. Database contoh (master data + N opportunity dummy):
+    python backend_sqlite.py presales_local.db --seed 500
+
+Beda dengan Postgres:
+- Audit UPDATE per field lewat trigger SQLite (di-generate dari daftar kolom), actor dari fungsi
+  app_actor() yang di-set per thread. Audit CREATE (statement-level di Postgres) ditulis dari Python.
+- rows_id (Q3xxxx) dari tabel app_sequences, pengganti sequence description_rows_id_seq.
+- Agregat velocity & pipeline cube dihitung dari tabel dasar saat dibaca, bukan dari tabel
+  yang di-maintain trigger. Search memakai LIKE per kata, bukan tsvector.
+- ttl di query() diabaikan (tanpa st.cache_data), supaya benchmark mengukur query sebenarnya.
+"""
+import argparse
+import importlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import Session
+
+__all__ = [
+    "get_conn", "get_read_conn", "get_pool_metrics", "build_opportunity_filter", "_query_leads_by_uids",
+    "search_opportunities", "get_pipeline_velocity", "get_pipeline_cube", "get_pipeline_as_of",
+    "get_pipeline_trend", "take_pipeline_snapshot", "add_multi_line_opportunity",
+    "bulk_import_opportunities", "update_lead", "update_leads_batch", "update_full_opportunity",
+    "update_opportunity_stage_batch", "add_cps_opportunity",
+]
+
+DEFAULT_DB_PATH = "presales_local.db"
+
+# Tipe Python yang tidak dikenal sqlite3 secara default
+sqlite3.register_adapter(Decimal, float)
+sqlite3.register_adapter(np.int64, int)
+sqlite3.register_adapter(np.bool_, bool)
+sqlite3.register_adapter(datetime, lambda v: v.isoformat(" "))
+sqlite3.register_adapter(pd.Timestamp, lambda v: v.isoformat(" "))
+sqlite3.register_adapter(date, lambda v: v.isoformat())
+
+# Kolom yang dikembalikan sebagai datetime / date (Postgres mengembalikan tipe aslinya)
+DATETIME_COLUMNS = {"created_at", "updated_at", "changed_at", "timestamp", "Timestamp"}
+DATE_COLUMNS = {"start_date", "snapshot_date", "start_month", "last_changed"}
+
+
+# ==============================================================================
+# 1. SCHEMA
+# ==============================================================================
+SCHEMA = [
+    # Master data
+    "CREATE TABLE IF NOT EXISTS presales (presales_name TEXT PRIMARY KEY, email TEXT)",
+    "CREATE TABLE IF NOT EXISTS mapping_pam (inputter_name TEXT, pam_name TEXT)",
+    "CREATE TABLE IF NOT EXISTS responsible (responsible_name TEXT)",
+    "CREATE TABLE IF NOT EXISTS sales_names (sales_group TEXT, sales_name TEXT)",
+    "CREATE TABLE IF NOT EXISTS companies (company_name TEXT, vertical_industry TEXT)",
+    "CREATE TABLE IF NOT EXISTS distributors (distributor_name TEXT)",
+    "CREATE TABLE IF NOT EXISTS brands (brand_name TEXT, channel TEXT, brand_code TEXT)",
+    """CREATE TABLE IF NOT EXISTS master_pillars (
+        pillar_name TEXT, solution_name TEXT, service_name TEXT,
+        pillar_id TEXT, solution_id TEXT, service_id TEXT
+    )""",
+    # allowed_next_stages: JSON array, NULL = bebas (lihat migrations/004_stage_transitions.sql)
+    "CREATE TABLE IF NOT EXISTS stage_pipeline (stage_name TEXT, stage_type TEXT, allowed_next_stages TEXT)",
+
+    # Opportunity
+    "CREATE TABLE IF NOT EXISTS description (rows_id TEXT PRIMARY KEY, description TEXT UNIQUE)",
+    """CREATE TABLE IF NOT EXISTS sales_opportunities (
+        opportunity_id TEXT PRIMARY KEY, opportunity_name TEXT, salesgroup_id TEXT, sales_name TEXT,
+        stage TEXT, sales_notes TEXT, closing_reason TEXT, selling_price REAL,
+        created_at TEXT, updated_at TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS opportunities (
+        uid TEXT PRIMARY KEY, opportunity_id TEXT, product_id TEXT, presales_name TEXT,
+        salesgroup_id TEXT, sales_name TEXT, responsible_name TEXT, opportunity_name TEXT,
+        start_date TEXT, company_name TEXT, vertical_industry TEXT, pillar TEXT, solution TEXT,
+        service TEXT, brand TEXT, channel TEXT, distributor_name TEXT, cost REAL, notes TEXT,
+        stage TEXT, stage_notes TEXT, closing_reason TEXT, closing_notes TEXT, sales_notes TEXT,
+        created_at TEXT, updated_at TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_opportunities_opportunity_id ON opportunities (opportunity_id)",
+    "CREATE INDEX IF NOT EXISTS idx_opportunities_created_at_uid ON opportunities (created_at DESC, uid DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_opportunities_start_date ON opportunities (start_date)",
+    """CREATE TABLE IF NOT EXISTS cps_opportunities (
+        uid TEXT PRIMARY KEY, cps_id TEXT, cps_product_id TEXT, managed_service TEXT,
+        service_offering TEXT, package TEXT, sla_level TEXT, service_execution TEXT,
+        presales_name TEXT, salesgroup_id TEXT, sales_name TEXT, responsible_name TEXT,
+        company_name TEXT, vertical_industry TEXT, stage TEXT, opportunity_name TEXT,
+        start_date TEXT, cost REAL, notes TEXT, created_at TEXT, updated_at TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_cps_opportunities_created_at ON cps_opportunities (created_at)",
+
+    # Audit & riwayat stage
+    """CREATE TABLE IF NOT EXISTS activity_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT, opportunity_name TEXT, user_name TEXT,
+        action TEXT, field TEXT, old_value TEXT, new_value TEXT, source_table TEXT, record_key TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_activity_logs_timestamp ON activity_logs (timestamp)",
+    """CREATE TABLE IF NOT EXISTS opportunity_stage_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, opportunity_id TEXT NOT NULL, from_stage TEXT,
+        to_stage TEXT NOT NULL, changed_at TEXT NOT NULL, actor TEXT, reason TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_stage_history_opp ON opportunity_stage_history (opportunity_id, changed_at)",
+
+    # Snapshot pipeline (tanpa partisi, lihat migrations/007_pipeline_snapshots.sql)
+    """CREATE TABLE IF NOT EXISTS pipeline_snapshots (
+        uid TEXT NOT NULL, snapshot_date TEXT NOT NULL, opportunity_id TEXT, pillar TEXT, stage TEXT,
+        salesgroup_id TEXT, cost REAL, is_deleted INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (uid, snapshot_date)
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_pipeline_snapshots_date ON pipeline_snapshots (snapshot_date)",
+    """CREATE TABLE IF NOT EXISTS pipeline_snapshot_latest (
+        uid TEXT PRIMARY KEY, snapshot_date TEXT NOT NULL, opportunity_id TEXT, pillar TEXT, stage TEXT,
+        salesgroup_id TEXT, cost REAL, is_deleted INTEGER NOT NULL DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS pipeline_snapshot_daily (
+        snapshot_date TEXT NOT NULL, pillar TEXT NOT NULL, stage TEXT NOT NULL, salesgroup_id TEXT NOT NULL,
+        total_cost REAL NOT NULL DEFAULT 0, line_count INTEGER NOT NULL DEFAULT 0, opp_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (snapshot_date, pillar, stage, salesgroup_id)
+    )""",
+
+    # Submit idempotent (migrations/009_processed_submissions.sql)
+    """CREATE TABLE IF NOT EXISTS processed_submissions (
+        submission_id TEXT PRIMARY KEY, kind TEXT NOT NULL, result TEXT, processed_at TEXT NOT NULL
+    )""",
+
+    # Pengganti sequence Postgres: next_value = nomor berikutnya yang dibagikan
+    "CREATE TABLE IF NOT EXISTS app_sequences (name TEXT PRIMARY KEY, next_value INTEGER NOT NULL)",
+    """INSERT INTO app_sequences (name, next_value)
+       SELECT 'description_rows_id_seq', COALESCE(
+           (SELECT MAX(CAST(substr(rows_id, 3) AS INTEGER)) + 1 FROM description WHERE rows_id GLOB 'Q3[0-9]*'), 0)
+       WHERE true
+       ON CONFLICT (name) DO NOTHING""",
+]
+
+# Tabel yang di-audit -> kolom kunci (record_key), sama dengan migrations/003_audit_triggers.sql
+AUDITED_TABLES = {"opportunities": "uid", "sales_opportunities": "opportunity_id", "cps_opportunities": "uid"}
+
+def _audit_update_trigger(table, key_col, columns):
+    """Trigger UPDATE: satu baris activity_logs per field yang berubah (old -> new)."""
+    diffs = "\n                UNION ALL ".join(
+        f"SELECT '{col.replace('_', ' ').title()}' AS field, CAST(OLD.{col} AS TEXT) AS old_value, "
+        f"CAST(NEW.{col} AS TEXT) AS new_value WHERE OLD.{col} IS NOT NEW.{col}"
+        for col in columns if col not in ("created_at", "updated_at")
+    )
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS trg_audit_upd_{table} AFTER UPDATE ON {table}
+        FOR EACH ROW BEGIN
+            INSERT INTO activity_logs (
+                timestamp, opportunity_name, user_name, action, field,
+                old_value, new_value, source_table, record_key
+            )
+            SELECT strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'), NEW.opportunity_name, app_actor(),
+                   'UPDATE', d.field, d.old_value, d.new_value, '{table}', OLD.{key_col}
+            FROM (
+                {diffs}
+            ) AS d;
+        END
+    """
+
+def bootstrap_schema(engine):
+    """Buat semua tabel, index & trigger audit (idempotent)."""
+    with engine.begin() as connection:
+        for ddl in SCHEMA:
+            connection.exec_driver_sql(ddl)
+        for table, key_col in AUDITED_TABLES.items():
+            columns = [r[1] for r in connection.exec_driver_sql(f"PRAGMA table_info({table})")]
+            connection.exec_driver_sql(_audit_update_trigger(table, key_col, columns))
+
+
+# ==============================================================================
+# 2. KONEKSI
+# ==============================================================================
+# Actor audit per thread, pengganti set_config('app.actor', ...) di Postgres
+_actor = threading.local()
+
+def _set_actor(user):
+    _actor.name = user or ""
+
+def _current_actor():
+    return getattr(_actor, "name", "") or "system"
+
+def _db_path():
+    url = os.environ.get("PRESALES_STORAGE", "").strip()
+    if url.startswith("sqlite:///"):
+        return url[len("sqlite:///"):]
+    try:
+        return st.secrets.get("storage", {}).get("path", DEFAULT_DB_PATH)
+    except Exception:
+        return DEFAULT_DB_PATH
+
+def _convert_types(df):
+    for col in df.columns:
+        if col in DATETIME_COLUMNS:
+            df[col] = pd.to_datetime(df[col], errors="coerce", format="mixed")
+        elif col in DATE_COLUMNS:
+            df[col] = pd.to_datetime(df[col], errors="coerce", format="mixed").dt.date
+    return df
+
+def _records(rows):
+    """Baris hasil RETURNING -> list of dict dengan tipe yang sama seperti query()."""
+    rows = [dict(r) for r in rows]
+    return _convert_types(pd.DataFrame(rows)).to_dict('records') if rows else []
+
+
+class LocalConnection:
+    """Pengganti st.connection("postgresql"): interface yang dipakai backend.py (query, session, engine)."""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def query(self, sql, params=None, ttl=None, **kwargs):
+        with self.engine.connect() as connection:
+            df = pd.read_sql(text(sql), connection, params=params or {})
+        return _convert_types(df)
+
+    @property
+    def session(self):
+        return Session(self.engine)
+
+
+_connection = None
+_connection_lock = threading.Lock()
+
+def _get_local_connection():
+    global _connection
+    if _connection is None:
+        with _connection_lock:
+            if _connection is None:
+                cfg = db._pool_config("short")
+                engine = create_engine(
+                    f"sqlite:///{_db_path()}",
+                    poolclass=db._get_timed_pool_class(),
+                    pool_size=cfg["pool_size"],
+                    max_overflow=cfg["max_overflow"],
+                    pool_timeout=cfg["pool_timeout"],
+                    connect_args={"check_same_thread": False, "timeout": 30},
+                )
+
+                @event.listens_for(engine, "connect")
+                def _on_connect(dbapi_conn, _record):
+                    dbapi_conn.create_function("app_actor", 0, _current_actor)
+                    cursor = dbapi_conn.cursor()
+                    cursor.execute("PRAGMA journal_mode=WAL")
+                    cursor.execute("PRAGMA synchronous=NORMAL")
+                    cursor.close()
+
+                bootstrap_schema(engine)
+                db._watch_engine(engine)
+                _connection = LocalConnection(engine)
+    return _connection
+
+def get_conn(long=False):
+    """Satu database file untuk semua pool (short / long)."""
+    return _get_local_connection()
+
+def get_read_conn(long=False):
+    """Tanpa replica: baca dan tulis ke file yang sama."""
+    return _get_local_connection()
+
+def get_pool_metrics():
+    return [db._pool_stats("sqlite", _connection.engine.pool)] if _connection else []
+
+
+# ==============================================================================
+# 3. HELPER SQL
+# ==============================================================================
+def _json_list(values):
+    """Parameter list untuk `IN (SELECT value FROM json_each(:p))`, None = tanpa filter."""
+    return json.dumps([str(v) for v in values]) if values else None
+
+def _json_rows(columns, param):
+    """Pengganti jsonb_to_recordset: SELECT kolom dari array JSON di parameter :param."""
+    cols = ", ".join(f"json_extract(value, '$.{c}') AS {c}" for c in columns)
+    return f"SELECT {cols} FROM json_each(:{param})"
+
+def _product_id_sql(alias):
+    """product_id dari master_pillars & brands untuk line `alias` (sama dengan LATERAL join di Postgres)."""
+    def lookup(column):
+        return (f"(SELECT CAST(m.{column} AS TEXT) FROM master_pillars m WHERE m.pillar_name = {alias}.pillar "
+                f"AND m.solution_name = {alias}.solution AND m.service_name = {alias}.service LIMIT 1)")
+    brand = f"(SELECT CAST(b.brand_code AS TEXT) FROM brands b WHERE b.brand_name = {alias}.brand LIMIT 1)"
+    return f"""upper(replace(
+        COALESCE(NULLIF({lookup('pillar_id')}, ''), 'GEN') ||
+        COALESCE(NULLIF({lookup('solution_id')}, ''), '0') ||
+        COALESCE(NULLIF({lookup('service_id')}, ''), 'S0') ||
+        COALESCE(NULLIF({brand}, ''), 'GEN'),
+    ' ', ''))"""
+
+def _nextval(session, name, count=1):
+    """Pengganti nextval(): ambil `count` nomor berurutan, return nomor pertama."""
+    return session.execute(
+        text("UPDATE app_sequences SET next_value = next_value + :n WHERE name = :name RETURNING next_value - :n"),
+        {"n": int(count), "name": name}
+    ).scalar_one()
+
+def _rows_id_for(session, opportunity_name):
+    """rows_id (Q3xxxx) untuk nama opportunity: yang lama jika ada, jika belum ambil nomor baru."""
+    find = text("SELECT rows_id FROM description WHERE description = :d")
+    rows_id = session.execute(find, {"d": opportunity_name}).scalar()
+    if rows_id:
+        return rows_id
+    n = _nextval(session, "description_rows_id_seq")
+    session.execute(
+        text("INSERT INTO description (rows_id, description) VALUES (:r, :d) ON CONFLICT (description) DO NOTHING"),
+        {"r": f"Q3{n:04d}", "d": opportunity_name}
+    )
+    return session.execute(find, {"d": opportunity_name}).scalar_one()
+
+def _log_created(session, table, label, groups, now):
+    """
+    Pengganti trigger audit INSERT (statement-level di Postgres): satu log per kelompok.
+    groups: Counter {(record_key, opportunity_name): jumlah line}
+    """
+    if not groups:
+        return
+    session.execute(text("""
+        INSERT INTO activity_logs (timestamp, opportunity_name, user_name, action, field, new_value, source_table, record_key)
+        VALUES (:now, :oname, app_actor(), 'CREATE', :field, :new_value, :tbl, :key)
+    """), [
+        {"now": now, "oname": oname, "field": label, "new_value": f"Created {n} lines. ID: {key}", "tbl": table, "key": key}
+        for (key, oname), n in groups.items()
+    ])
+
+
+# ==============================================================================
+# 4. READ (SQL KHUSUS POSTGRES)
+# ==============================================================================
+def build_opportunity_filter(filters, start_date=None, end_date=None):
+    """Versi SQLite dari backend.build_opportunity_filter (NULL = "Unknown", tanggal dari start_date)."""
+    where, params = [], {}
+    for col, selection in (filters or {}).items():
+        if col not in db.OPPORTUNITY_FILTER_COLUMNS or not selection:
+            continue
+        where.append(f"COALESCE(CAST({col} AS TEXT), 'Unknown') IN (SELECT value FROM json_each(:f_{col}))")
+        params[f"f_{col}"] = _json_list(selection)
+
+    if start_date and end_date:
+        where.append("date(start_date) BETWEEN date(:start) AND date(:end)")
+        params.update({"start": start_date, "end": end_date})
+
+    return (" WHERE " + " AND ".join(where)) if where else "", params
+
+def _query_leads_by_uids(uids):
+    return get_conn().query("SELECT * FROM opportunities WHERE uid IN (SELECT value FROM json_each(:uids))",
+                            params={"uids": json.dumps(list(uids))})
+
+def search_opportunities(keyword, limit=50):
+    """Semua kata harus ada (LIKE) di nama, company, notes, stage/closing notes; nama & company diberi bobot lebih."""
+    terms = re.findall(r"\w+", keyword or "")
+    if not terms:
+        return {"status": 400, "message": "Keyword is empty"}
+
+    where, rank, params = [], [], {"lim": int(limit)}
+    for i, term in enumerate(terms):
+        params[f"t{i}"] = f"%{term}%"
+        a = f"(o.opportunity_name LIKE :t{i} OR o.company_name LIKE :t{i})"
+        b = f"(o.notes LIKE :t{i})"
+        c = f"(o.stage_notes LIKE :t{i} OR o.closing_notes LIKE :t{i})"
+        where.append(f"({a} OR {b} OR {c})")
+        rank.append(f"{a} * 1.0 + {b} * 0.4 + {c} * 0.2")
+    query = f"""
+        SELECT o.*, {' + '.join(rank)} AS search_rank
+        FROM opportunities o
+        WHERE {' AND '.join(where)}
+        ORDER BY search_rank DESC, o.created_at DESC
+        LIMIT :lim
+    """
+    try:
+        df = get_read_conn().query(query, params=params)
+        return {"status": 200, "data": df.to_dict('records')}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+# stage_flow_stats dihitung dari opportunity_stage_history (isi tabelnya di migrations/005_stage_flow_stats.sql),
+# termasuk baris rollup '*' yang menghitung setiap opportunity sekali. Beda dengan Postgres: pillar
+# diambil dari line saat ini (dihitung saat dibaca), bukan dibekukan saat transisi.
+_STAGE_FLOW_CTE = """
+    t AS (
+        SELECT h.id, h.opportunity_id, COALESCE(h.from_stage, '') AS from_stage, h.to_stage,
+               CASE WHEN h.from_stage IS NULL THEN 0
+                    ELSE max((julianday(h.changed_at) - julianday(COALESCE(
+                        LAG(h.changed_at) OVER (PARTITION BY h.opportunity_id ORDER BY h.id),
+                        f.created_at, h.changed_at))) * 86400.0, 0)
+               END AS seconds
+        FROM opportunity_stage_history h
+        LEFT JOIN (
+            SELECT opportunity_id, min(created_at) AS created_at FROM opportunities GROUP BY opportunity_id
+        ) f ON f.opportunity_id = h.opportunity_id
+    ),
+    d AS (
+        SELECT DISTINCT t.id, COALESCE(o.pillar, 'Unknown') AS pillar,
+               COALESCE(o.salesgroup_id, 'Unknown') AS salesgroup_id
+        FROM t
+        JOIN opportunities o ON o.opportunity_id = t.opportunity_id
+    ),
+    grains AS (
+        SELECT id, pillar, salesgroup_id FROM d
+        UNION SELECT id, pillar, '*' FROM d
+        UNION SELECT id, '*', salesgroup_id FROM d
+        UNION SELECT id, '*', '*' FROM d
+    ),
+    stage_flow_stats AS (
+        SELECT g.pillar, g.salesgroup_id, t.from_stage, t.to_stage,
+               COUNT(*) AS transitions, SUM(t.seconds) AS total_seconds
+        FROM grains g
+        JOIN t ON t.id = g.id
+        GROUP BY 1, 2, 3, 4
+    )
+"""
+
+def get_pipeline_velocity(pillars=None, sales_groups=None):
+    params = {"pillars": _json_list(pillars), "groups": _json_list(sales_groups)}
+    flt = """
+        FROM stage_flow_stats
+        WHERE CASE WHEN :pillars IS NULL THEN pillar = '*'
+                   ELSE pillar IN (SELECT value FROM json_each(:pillars)) END
+          AND CASE WHEN :groups IS NULL THEN salesgroup_id = '*'
+                   ELSE salesgroup_id IN (SELECT value FROM json_each(:groups)) END
+    """
+    flt_detail = """
+        FROM stage_flow_stats
+        WHERE pillar <> '*' AND salesgroup_id <> '*'
+          AND (:pillars IS NULL OR pillar IN (SELECT value FROM json_each(:pillars)))
+          AND (:groups IS NULL OR salesgroup_id IN (SELECT value FROM json_each(:groups)))
+    """
+    queries = {
+        "time_in_stage": f"""
+            WITH {_STAGE_FLOW_CTE}
+            SELECT from_stage AS stage, SUM(transitions) AS exits,
+                   SUM(total_seconds) / NULLIF(SUM(transitions), 0) / 86400.0 AS avg_days
+            {flt} AND from_stage <> ''
+            GROUP BY from_stage
+            ORDER BY from_stage
+        """,
+        "conversion": f"""
+            WITH {_STAGE_FLOW_CTE},
+            f AS (
+                SELECT from_stage, to_stage, SUM(transitions) AS transitions
+                {flt} AND from_stage <> ''
+                GROUP BY from_stage, to_stage
+            )
+            SELECT from_stage, to_stage, transitions,
+                   100.0 * transitions / SUM(transitions) OVER (PARTITION BY from_stage) AS conversion_pct
+            FROM f
+            ORDER BY from_stage, transitions DESC
+        """,
+        "win_rate": f"""
+            WITH {_STAGE_FLOW_CTE}
+            SELECT pillar, salesgroup_id,
+                   SUM(transitions) FILTER (WHERE to_stage = 'Closed Won') AS won,
+                   SUM(transitions) FILTER (WHERE to_stage = 'Closed Lost') AS lost,
+                   100.0 * SUM(transitions) FILTER (WHERE to_stage = 'Closed Won')
+                       / NULLIF(SUM(transitions) FILTER (WHERE to_stage IN ('Closed Won', 'Closed Lost')), 0) AS win_rate_pct
+            {flt_detail}
+            GROUP BY pillar, salesgroup_id
+            HAVING SUM(transitions) FILTER (WHERE to_stage IN ('Closed Won', 'Closed Lost')) > 0
+            ORDER BY pillar, salesgroup_id
+        """
+    }
+    try:
+        data = {name: get_read_conn(long=True).query(q, params=params).to_dict('records') for name, q in queries.items()}
+        return {"status": 200, "data": data}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+def get_pipeline_cube(pillars=None, stages=None, sales_groups=None, start_date=None, end_date=None):
+    query = """
+        SELECT * FROM (
+            SELECT COALESCE(pillar, 'Unknown') AS pillar, COALESCE(stage, 'Unknown') AS stage,
+                   COALESCE(salesgroup_id, 'Unknown') AS salesgroup_id,
+                   date(COALESCE(date(start_date), date(created_at), '1970-01-01'), 'start of month') AS start_month,
+                   SUM(COALESCE(cost, 0)) AS total_cost, COUNT(*) AS line_count,
+                   COUNT(DISTINCT opportunity_id) AS opp_count
+            FROM opportunities
+            GROUP BY 1, 2, 3, 4
+        ) cube
+        WHERE (:pillars IS NULL OR pillar IN (SELECT value FROM json_each(:pillars)))
+          AND (:stages IS NULL OR stage IN (SELECT value FROM json_each(:stages)))
+          AND (:groups IS NULL OR salesgroup_id IN (SELECT value FROM json_each(:groups)))
+          AND (:start IS NULL OR start_month >= date(:start, 'start of month'))
+          AND (:end IS NULL OR start_month <= date(:end))
+        ORDER BY start_month, pillar, stage, salesgroup_id
+    """
+    params = {
+        "pillars": _json_list(pillars), "stages": _json_list(stages), "groups": _json_list(sales_groups),
+        "start": start_date, "end": end_date
+    }
+    try:
+        df = get_read_conn(long=True).query(query, params=params)
+        return {"status": 200, "data": df.to_dict('records')}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+def get_pipeline_as_of(as_of_date, pillars=None, stages=None, sales_groups=None):
+    query = """
+        SELECT uid, opportunity_id, pillar, stage, salesgroup_id, cost, snapshot_date AS last_changed
+        FROM (
+            SELECT s.*, ROW_NUMBER() OVER (PARTITION BY s.uid ORDER BY s.snapshot_date DESC) AS rn
+            FROM pipeline_snapshots s
+            WHERE s.snapshot_date <= date(:d)
+        ) v
+        WHERE rn = 1 AND NOT is_deleted
+          AND (:pillars IS NULL OR pillar IN (SELECT value FROM json_each(:pillars)))
+          AND (:stages IS NULL OR stage IN (SELECT value FROM json_each(:stages)))
+          AND (:groups IS NULL OR salesgroup_id IN (SELECT value FROM json_each(:groups)))
+        ORDER BY opportunity_id, uid
+    """
+    params = {
+        "d": as_of_date,
+        "pillars": _json_list(pillars), "stages": _json_list(stages), "groups": _json_list(sales_groups)
+    }
+    try:
+        df = get_read_conn(long=True).query(query, params=params)
+        return {"status": 200, "data": df.to_dict('records')}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+def get_pipeline_trend(start_date=None, end_date=None, pillars=None, stages=None, sales_groups=None):
+    query = """
+        SELECT snapshot_date, stage, SUM(total_cost) AS total_cost,
+               SUM(line_count) AS line_count, SUM(opp_count) AS opp_count
+        FROM pipeline_snapshot_daily
+        WHERE (:start IS NULL OR snapshot_date >= date(:start))
+          AND (:end IS NULL OR snapshot_date <= date(:end))
+          AND (:pillars IS NULL OR pillar IN (SELECT value FROM json_each(:pillars)))
+          AND (:stages IS NULL OR stage IN (SELECT value FROM json_each(:stages)))
+          AND (:groups IS NULL OR salesgroup_id IN (SELECT value FROM json_each(:groups)))
+        GROUP BY snapshot_date, stage
+        ORDER BY snapshot_date, stage
+    """
+    params = {
+        "start": start_date, "end": end_date,
+        "pillars": _json_list(pillars), "stages": _json_list(stages), "groups": _json_list(sales_groups)
+    }
+    try:
+        df = get_read_conn(long=True).query(query, params=params)
+        return {"status": 200, "data": df.to_dict('records')}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+
+# ==============================================================================
+# 5. WRITE
+# ==============================================================================
+def take_pipeline_snapshot(snapshot_date=None):
+    """Sama dengan pipeline_snapshot_take(): simpan baris yang berubah + tombstone, lalu ringkasan harian."""
+    snap_date = pd.Timestamp(snapshot_date or date.today()).date()
+    set_cols = ["opportunity_id", "pillar", "stage", "salesgroup_id", "cost", "is_deleted"]
+    upsert = ", ".join(f"{c} = excluded.{c}" for c in set_cols)
+    try:
+        with get_conn(long=True).session as session:
+            # Tidak bisa backfill: snapshot selalu berisi state saat ini
+            last_date = session.execute(text("SELECT max(snapshot_date) FROM pipeline_snapshots")).scalar()
+            if last_date and snap_date.isoformat() < last_date:
+                raise ValueError(f"Cannot snapshot {snap_date}: latest snapshot is {last_date} and snapshots "
+                                 f"can only record the current state (no backfill)")
+            if snap_date > date.today():
+                raise ValueError(f"Cannot snapshot {snap_date}: date is in the future")
+            session.execute(text("DROP TABLE IF EXISTS temp.snapshot_changed"))
+            session.execute(text("""
+                CREATE TEMP TABLE snapshot_changed AS
+                SELECT c.uid, c.opportunity_id, c.pillar, c.stage, c.salesgroup_id, c.cost, 0 AS is_deleted
+                FROM opportunities c
+                LEFT JOIN pipeline_snapshot_latest l ON l.uid = c.uid
+                WHERE c.uid IS NOT NULL
+                  AND (l.uid IS NULL OR l.is_deleted
+                       OR l.opportunity_id IS NOT c.opportunity_id OR l.pillar IS NOT c.pillar
+                       OR l.stage IS NOT c.stage OR l.salesgroup_id IS NOT c.salesgroup_id
+                       OR l.cost IS NOT c.cost)
+                UNION ALL
+                SELECT l.uid, l.opportunity_id, l.pillar, l.stage, l.salesgroup_id, l.cost, 1
+                FROM pipeline_snapshot_latest l
+                WHERE NOT l.is_deleted AND NOT EXISTS (SELECT 1 FROM opportunities c WHERE c.uid = l.uid)
+            """))
+            written = session.execute(text("SELECT COUNT(*) FROM snapshot_changed")).scalar_one()
+            for table, conflict in (("pipeline_snapshots", "uid, snapshot_date"), ("pipeline_snapshot_latest", "uid")):
+                session.execute(text(f"""
+                    INSERT INTO {table} (snapshot_date, uid, {', '.join(set_cols)})
+                    SELECT :d, uid, {', '.join(set_cols)} FROM snapshot_changed WHERE true
+                    ON CONFLICT ({conflict}) DO UPDATE SET snapshot_date = excluded.snapshot_date, {upsert}
+                """), {"d": snap_date})
+
+            # Ringkasan harian dihitung ulang dari state terkini
+            session.execute(text("DELETE FROM pipeline_snapshot_daily WHERE snapshot_date = :d"), {"d": snap_date})
+            session.execute(text("""
+                INSERT INTO pipeline_snapshot_daily (snapshot_date, pillar, stage, salesgroup_id, total_cost, line_count, opp_count)
+                SELECT :d, COALESCE(pillar, 'Unknown'), COALESCE(stage, 'Unknown'), COALESCE(salesgroup_id, 'Unknown'),
+                       SUM(COALESCE(cost, 0)), COUNT(*), COUNT(DISTINCT opportunity_id)
+                FROM pipeline_snapshot_latest
+                WHERE NOT is_deleted
+                GROUP BY 2, 3, 4
+            """), {"d": snap_date})
+            session.execute(text("DROP TABLE temp.snapshot_changed"))
+            session.commit()
+            return {"status": 200, "message": f"Snapshot stored ({written} changed lines)", "data": {"written": written}}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+_LINE_COLUMNS = ["idx", "pillar", "solution", "service", "brand", "channel", "distributor_name", "cost", "notes"]
+
+def add_multi_line_opportunity(parent_data, product_lines, submission_id=None):
+    try:
+        with get_conn().session as session:
+            previous = db._claim_submission(session, submission_id, "add_multi_line_opportunity")
+            if previous is not None:
+                return previous
+            _set_actor(parent_data['presales_name'])
+            safe_group = parent_data.get('salesgroup_id', 'GEN')
+            uid_stamp = db._line_uid_stamp(submission_id)
+            created_at = datetime.now()
+            oname = parent_data['opportunity_name']
+            stage_val = parent_data.get('stage', 'Open')
+
+            # A + B. rows_id (Q3xxxx) & header Sales
+            new_opp_id = f"{safe_group}{_rows_id_for(session, oname)}"
+            header = session.execute(text("""
+                INSERT INTO sales_opportunities (
+                    opportunity_id, opportunity_name, salesgroup_id, sales_name, stage, created_at, updated_at
+                )
+                VALUES (:oid, :desc, :sgid, :sname, :stg, :now, :now)
+                ON CONFLICT (opportunity_id) DO NOTHING
+                RETURNING opportunity_id
+            """), {
+                "oid": new_opp_id, "desc": oname, "sgid": parent_data['salesgroup_id'],
+                "sname": parent_data['sales_name'], "stg": stage_val, "now": created_at
+            }).fetchall()
+
+            # C. Semua line dalam satu statement
+            lines_json = json.dumps([
+                {
+                    "idx": i, "pillar": line['pillar'], "solution": line['solution'],
+                    "service": line['service'], "brand": line.get('brand'),
+                    "channel": line.get('channel'), "distributor_name": line.get('distributor_name'),
+                    "cost": line.get('cost', 0), "notes": line.get('notes', '')
+                }
+                for i, line in enumerate(product_lines)
+            ], default=str)
+            inserted = session.execute(text(f"""
+                WITH l AS ({_json_rows(_LINE_COLUMNS, 'lines')})
+                INSERT INTO opportunities (
+                    uid, opportunity_id, product_id, presales_name, salesgroup_id, sales_name,
+                    responsible_name, opportunity_name, start_date, company_name,
+                    vertical_industry, pillar, solution, service, brand, channel,
+                    distributor_name, cost, notes, stage, stage_notes, created_at, updated_at
+                )
+                SELECT
+                    :oid || '-' || p.product_id || '-' || :ts || p.idx, :oid, p.product_id,
+                    :pname, :sgid, :sname,
+                    :pam, :oname, :sdate, :cname,
+                    :vi, p.pillar, p.solution, p.service, p.brand, p.channel,
+                    p.distributor_name, p.cost, p.notes, :stage_val, :s_note, :now, :now
+                FROM (SELECT l.*, {_product_id_sql('l')} AS product_id FROM l) p
+                RETURNING uid, opportunity_id
+            """), {
+                "oid": new_opp_id, "ts": uid_stamp, "lines": lines_json,
+                "pname": parent_data['presales_name'], "sgid": parent_data['salesgroup_id'],
+                "sname": parent_data['sales_name'], "pam": parent_data['responsible_name'],
+                "oname": oname, "sdate": parent_data['start_date'],
+                "cname": parent_data['company_name'], "vi": parent_data['vertical_industry'],
+                "stage_val": stage_val, "s_note": parent_data.get('stage_notes', ''), "now": created_at
+            }).mappings().all()
+
+            # Stage awal masuk ke riwayat stage (sekali per opportunity_id)
+            session.execute(text("""
+                INSERT INTO opportunity_stage_history (opportunity_id, from_stage, to_stage, changed_at, actor)
+                SELECT :oid, NULL, :stg, :now, :pname
+                WHERE NOT EXISTS (SELECT 1 FROM opportunity_stage_history WHERE opportunity_id = :oid)
+            """), {"oid": new_opp_id, "stg": stage_val, "now": created_at, "pname": parent_data['presales_name']})
+
+            if header:
+                _log_created(session, "sales_opportunities", "Sales Header", Counter({(new_opp_id, oname): 1}), created_at)
+            _log_created(session, "opportunities", "Opportunity", Counter({(new_opp_id, oname): len(inserted)}), created_at)
+
+            created_uids = sorted(
+                ({"uid": r['uid'], "opportunity_id": r['opportunity_id']} for r in inserted),
+                key=lambda x: int(x['uid'].rsplit('-', 1)[-1])
+            )
+            result = db._finish_submission(session, submission_id, {
+                "status": 200, "message": "Opportunity successfully added!", "data": created_uids
+            })
+            session.commit()
+            db._pin_primary()
+            db._invalidate_opportunities([new_opp_id])
+            return result
+
+    except Exception as e:
+        return {"status": 500, "message": f"Database Error: {str(e)}"}
+
+_STAGING_TYPES = {"row_no": "INTEGER", "cost": "REAL"}
+
+def bulk_import_opportunities(lines_df, user):
+    """Versi SQLite dari backend.bulk_import_opportunities: staging table biasa (tanpa COPY), satu transaksi."""
+    if lines_df is None or lines_df.empty:
+        return {"status": 400, "message": "No valid lines to import"}
+
+    cols = db.IMPORT_STAGING_COLUMNS
+    staged = lines_df[cols].astype(object)
+    records = staged.where(staged.notna(), None).to_dict('records')
+    first_line = "SELECT s.*, ROW_NUMBER() OVER (PARTITION BY opportunity_id ORDER BY row_no) AS rn FROM import_staging s"
+
+    try:
+        now, ts = datetime.now(), str(int(time.time()))
+        with get_conn(long=True).session as session:
+            _set_actor(user)
+            session.execute(text("DROP TABLE IF EXISTS temp.import_staging"))
+            session.execute(text(
+                "CREATE TEMP TABLE import_staging ("
+                + ", ".join(f"{c} {_STAGING_TYPES.get(c, 'TEXT')}" for c in cols)
+                + ", opportunity_id TEXT)"
+            ))
+            session.execute(
+                text(f"INSERT INTO import_staging ({', '.join(cols)}) VALUES ({', '.join(':' + c for c in cols)})"),
+                records
+            )
+
+            # rows_id (Q3xxxx) untuk nama baru, dialokasikan sekaligus
+            names = session.execute(text("""
+                SELECT DISTINCT s.opportunity_name FROM import_staging s
+                WHERE NOT EXISTS (SELECT 1 FROM description d WHERE d.description = s.opportunity_name)
+                ORDER BY s.opportunity_name
+            """)).scalars().all()
+            if names:
+                first = _nextval(session, "description_rows_id_seq", len(names))
+                session.execute(
+                    text("INSERT INTO description (rows_id, description) VALUES (:r, :d) ON CONFLICT (description) DO NOTHING"),
+                    [{"r": f"Q3{first + i:04d}", "d": name} for i, name in enumerate(names)]
+                )
+            session.execute(text("""
+                UPDATE import_staging SET opportunity_id = salesgroup_id ||
+                    (SELECT d.rows_id FROM description d WHERE d.description = import_staging.opportunity_name)
+            """))
+
+            headers = session.execute(text(f"""
+                INSERT INTO sales_opportunities (
+                    opportunity_id, opportunity_name, salesgroup_id, sales_name, stage, created_at, updated_at
+                )
+                SELECT opportunity_id, opportunity_name, salesgroup_id, sales_name, stage, :now, :now
+                FROM ({first_line}) WHERE rn = 1
+                ON CONFLICT (opportunity_id) DO NOTHING
+                RETURNING opportunity_id, opportunity_name
+            """), {"now": now}).mappings().all()
+
+            lines = session.execute(text(f"""
+                INSERT INTO opportunities (
+                    uid, opportunity_id, product_id, presales_name, salesgroup_id, sales_name,
+                    responsible_name, opportunity_name, start_date, company_name,
+                    vertical_industry, pillar, solution, service, brand, channel,
+                    distributor_name, cost, notes, stage, stage_notes, created_at, updated_at
+                )
+                SELECT
+                    s.opportunity_id || '-' || s.product_id || '-' || :ts || s.row_no,
+                    s.opportunity_id, s.product_id, s.presales_name, s.salesgroup_id, s.sales_name,
+                    s.responsible_name, s.opportunity_name, s.start_date, s.company_name,
+                    s.vertical_industry, s.pillar, s.solution, s.service, s.brand, s.channel,
+                    s.distributor_name, s.cost, COALESCE(s.notes, ''), s.stage,
+                    COALESCE(s.stage_notes, ''), :now, :now
+                FROM (SELECT l.*, {_product_id_sql('l')} AS product_id FROM import_staging l) s
+                RETURNING opportunity_id, opportunity_name
+            """), {"ts": ts, "now": now}).mappings().all()
+
+            session.execute(text(f"""
+                INSERT INTO opportunity_stage_history (opportunity_id, from_stage, to_stage, changed_at, actor)
+                SELECT opportunity_id, NULL, stage, :now, :actor
+                FROM ({first_line}) f
+                WHERE rn = 1 AND NOT EXISTS (
+                    SELECT 1 FROM opportunity_stage_history h WHERE h.opportunity_id = f.opportunity_id
+                )
+            """), {"now": now, "actor": user})
+
+            _log_created(session, "sales_opportunities", "Sales Header",
+                         Counter((r['opportunity_id'], r['opportunity_name']) for r in headers), now)
+            _log_created(session, "opportunities", "Opportunity",
+                         Counter((r['opportunity_id'], r['opportunity_name']) for r in lines), now)
+            session.execute(text("DROP TABLE temp.import_staging"))
+            session.commit()
+
+        db._pin_primary()
+        db._invalidate_opportunities()
+        summary = {
+            "lines": len(lines),
+            "opportunities": len({r['opportunity_id'] for r in lines}),
+            "new_headers": len(headers)
+        }
+        return {
+            "status": 200,
+            "message": f"Imported {summary['lines']} lines into {summary['opportunities']} opportunities.",
+            "data": summary
+        }
+    except Exception as e:
+        return {"status": 500, "message": f"Database Error: {str(e)}"}
+
+def update_lead(lead_data):
+    try:
+        with get_conn().session as session:
+            _set_actor(lead_data.get('user'))
+            rows = _records(session.execute(text("""
+                UPDATE opportunities SET cost = :c, notes = :n, updated_at = :now
+                WHERE uid = :uid
+                RETURNING *
+            """), {
+                "c": lead_data.get('cost'), "n": lead_data.get('notes'),
+                "uid": lead_data.get('uid'), "now": datetime.now()
+            }).mappings().all())
+            if not rows:
+                return {"status": 404, "message": "UID not found"}
+            session.commit()
+
+        db._pin_primary()
+        db._invalidate_opportunities([rows[0]['opportunity_id']])
+        db._cache_lead_row(rows[0])
+        return {"status": 200, "message": "Updated successfully"}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+def update_leads_batch(changes, user):
+    rows = [
+        {
+            "uid": c['uid'],
+            "cost": c.get('cost'), "has_cost": 'cost' in c,
+            "notes": c.get('notes'), "has_notes": 'notes' in c
+        }
+        for c in (changes or []) if c.get('uid')
+    ]
+    if not rows:
+        return {"status": 400, "message": "No changes to save"}
+
+    query = text(f"""
+        UPDATE opportunities AS o SET
+            cost = CASE WHEN c.has_cost THEN c.cost ELSE o.cost END,
+            notes = CASE WHEN c.has_notes THEN c.notes ELSE o.notes END,
+            updated_at = :now
+        FROM ({_json_rows(['uid', 'cost', 'has_cost', 'notes', 'has_notes'], 'rows')}) AS c
+        WHERE o.uid = c.uid
+        RETURNING *
+    """)
+    try:
+        with get_conn().session as session:
+            _set_actor(user)
+            updated = _records(session.execute(query, {
+                "rows": json.dumps(rows, default=str), "now": datetime.now()
+            }).mappings().all())
+            session.commit()
+
+        db._pin_primary()
+        db._invalidate_opportunities({r['opportunity_id'] for r in updated})
+        for r in updated:
+            db._cache_lead_row(r)
+        updated_uids = {r['uid'] for r in updated}
+        return {
+            "status": 200,
+            "message": f"{len(updated)} line(s) updated.",
+            "data": {"updated": len(updated), "missing": [r['uid'] for r in rows if r['uid'] not in updated_uids]}
+        }
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+def update_full_opportunity(payload):
+    uid = payload.get('uid')
+    try:
+        with get_conn().session as session:
+            _set_actor(payload.get('user'))
+            prev = session.execute(text("SELECT * FROM opportunities WHERE uid = :uid"), {"uid": uid}).mappings().first()
+            if not prev:
+                return {"status": 404, "message": "UID not found"}
+
+            # Re-ID: rows_id dari description, fallback pola Q3xxxx / 6 karakter terakhir ID lama
+            old_opp_id = prev['opportunity_id'] or ""
+            rows_id = session.execute(
+                text("SELECT rows_id FROM description WHERE description = :d LIMIT 1"), {"d": prev['opportunity_name']}
+            ).scalar()
+            if not rows_id:
+                match = re.search(r"Q3[0-9]+", old_opp_id)
+                rows_id = match.group(0) if match else old_opp_id[-6:]
+            new_opp_id = f"{payload['salesgroup_id']}{rows_id}"
+            # Bagian timestamp uid lama dipertahankan
+            suffix = uid.rsplit('-', 1)[-1] if re.search(r"-.*-", uid) else str(int(time.time()))
+            new_uid = f"{new_opp_id}-{prev['product_id'] or ''}-{suffix}"
+
+            rows = _records(session.execute(text("""
+                UPDATE opportunities SET
+                    uid = :new_uid, opportunity_id = :new_oid,
+                    salesgroup_id = :sg, sales_name = :sn, responsible_name = :pam,
+                    pillar = :p, solution = :s, service = :svc,
+                    brand = :b, company_name = :cn, vertical_industry = :vi,
+                    distributor_name = :dn, updated_at = :now
+                WHERE uid = :uid
+                RETURNING *
+            """), {
+                "new_uid": new_uid, "new_oid": new_opp_id, "uid": uid, "now": datetime.now(),
+                "sg": payload['salesgroup_id'], "sn": payload['sales_name'],
+                "pam": payload['responsible_name'], "p": payload['pillar'],
+                "s": payload['solution'], "svc": payload['service'],
+                "b": payload['brand'], "cn": payload['company_name'],
+                "vi": payload['vertical_industry'], "dn": payload['distributor_name']
+            }).mappings().all())
+            session.commit()
+
+        db._pin_primary()
+        db._invalidate_opportunities()
+        db._cache_lead_row(rows[0])
+        return {"status": 200, "message": "Full Data Updated!", "data": {"uid": rows[0]['uid']}}
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+def update_opportunity_stage_batch(opp_ids, new_stage, notes, manual_date, user, closing_reason=None):
+    """Versi SQLite dari backend.update_opportunity_stage_batch (validasi transisi, header sync, riwayat)."""
+    ids = list(dict.fromkeys(str(i).strip() for i in (opp_ids or []) if str(i).strip()))
+    if not ids:
+        return {"status": 400, "message": "No Opportunity ID given"}
+
+    params = {
+        "ids": json.dumps(ids), "stg": new_stage, "note": notes, "reason": closing_reason,
+        "date": manual_date, "usr": user, "now": datetime.now()
+    }
+    try:
+        with get_conn().session as session:
+            _set_actor(user)
+            # 1. Stage saat ini (line yang terakhir di-update) & aturan transisi
+            current = dict(session.execute(text("""
+                SELECT opportunity_id, stage FROM (
+                    SELECT opportunity_id, stage,
+                           ROW_NUMBER() OVER (PARTITION BY opportunity_id ORDER BY updated_at DESC NULLS LAST) AS rn
+                    FROM opportunities
+                    WHERE opportunity_id IN (SELECT value FROM json_each(:ids))
+                ) WHERE rn = 1
+            """), params).all())
+            rules = {
+                name: json.loads(allowed) if allowed else None
+                for name, allowed in session.execute(text(
+                    "SELECT stage_name, allowed_next_stages FROM stage_pipeline WHERE stage_type = 'PRESALES'"
+                )).all()
+            }
+
+            checked = []
+            for oid in ids:
+                if oid not in current:
+                    status = "Not Found"
+                else:
+                    allowed = rules.get(current[oid])
+                    free = current[oid] == new_stage or allowed is None or new_stage in allowed
+                    status = "Updated" if free else "Invalid Transition"
+                checked.append((oid, current.get(oid), status))
+            ok = [oid for oid, _, status in checked if status == "Updated"]
+
+            # 2. Update line & header, 3. riwayat stage
+            lines, headers = Counter(), set()
+            if ok:
+                params["ok"] = json.dumps(ok)
+                lines = Counter(session.execute(text("""
+                    UPDATE opportunities
+                    SET stage = :stg,
+                        stage_notes = :note,
+                        closing_reason = COALESCE(:reason, closing_reason),
+                        closing_notes = CASE WHEN :reason IS NULL THEN closing_notes ELSE :note END,
+                        updated_at = :date
+                    WHERE opportunity_id IN (SELECT value FROM json_each(:ok))
+                    RETURNING opportunity_id
+                """), params).scalars().all())
+                headers = set(session.execute(text("""
+                    UPDATE sales_opportunities
+                    SET stage = :stg,
+                        sales_notes = :note,
+                        closing_reason = COALESCE(:reason, closing_reason),
+                        updated_at = :date
+                    WHERE opportunity_id IN (SELECT value FROM json_each(:ok))
+                    RETURNING opportunity_id
+                """), params).scalars().all())
+                moved = [
+                    {**params, "oid": oid, "from_stage": from_stage}
+                    for oid, from_stage, status in checked if status == "Updated" and from_stage != new_stage
+                ]
+                if moved:
+                    session.execute(text("""
+                        INSERT INTO opportunity_stage_history (opportunity_id, from_stage, to_stage, changed_at, actor, reason)
+                        VALUES (:oid, :from_stage, :stg, COALESCE(:date, :now), :usr, :reason)
+                    """), moved)
+            session.commit()
+            db._pin_primary()
+        db._invalidate_opportunities(ids)
+
+        results = [
+            {
+                "opportunity_id": oid,
+                "from_stage": from_stage,
+                "lines_updated": lines.get(oid, 0),
+                "header_updated": oid in headers,
+                "status": status
+            }
+            for oid, from_stage, status in checked
+        ]
+        n_ok = sum(1 for r in results if r['status'] == "Updated")
+        return {
+            "status": 200,
+            "message": f"Stage updated for {n_ok} of {len(results)} opportunities.",
+            "data": results
+        }
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+_CPS_COLUMNS = [
+    "uid", "cps_product_id", "managed_service", "service_offering", "package",
+    "sla_level", "service_execution", "cost", "notes"
+]
+
+def add_cps_opportunity(parent_data, cps_lines, submission_id=None):
+    try:
+        cps_id = db.generate_cps_id(parent_data['salesgroup_id'])
+        created_at = datetime.now()
+        rows = db._build_cps_rows(cps_id, cps_lines, db._line_uid_stamp(submission_id))
+
+        with get_conn().session as session:
+            previous = db._claim_submission(session, submission_id, "add_cps_opportunity")
+            if previous is not None:
+                return previous
+            _set_actor(parent_data['presales_name'])
+            session.execute(text(f"""
+                WITH l AS ({_json_rows(_CPS_COLUMNS, 'lines')})
+                INSERT INTO cps_opportunities (
+                    uid, cps_id, cps_product_id,
+                    managed_service, service_offering, package, sla_level, service_execution,
+                    presales_name, salesgroup_id, sales_name, responsible_name,
+                    company_name, vertical_industry, stage,
+                    opportunity_name, start_date,
+                    cost, notes, created_at, updated_at
+                )
+                SELECT
+                    l.uid, :cps_id, l.cps_product_id,
+                    l.managed_service, l.service_offering, l.package, l.sla_level, l.service_execution,
+                    :pname, :sgid, :sname, :pam,
+                    :comp, :vert, :stg,
+                    :oname, :sdate,
+                    l.cost, l.notes, :now, :now
+                FROM l
+            """), {
+                "cps_id": cps_id, "lines": json.dumps(rows, default=str),
+                "pname": parent_data['presales_name'], "sgid": parent_data['salesgroup_id'],
+                "sname": parent_data['sales_name'], "pam": parent_data['responsible_name'],
+                "comp": parent_data['company_name'], "vert": parent_data['vertical_industry'],
+                "stg": parent_data['stage'], "oname": parent_data['opportunity_name'],
+                "sdate": parent_data['start_date'], "now": created_at
+            })
+            _log_created(session, "cps_opportunities", "CPS Opportunity",
+                         Counter({(cps_id, parent_data['opportunity_name']): len(rows)}), created_at)
+            result = db._finish_submission(session, submission_id, {
+                "status": 200, "message": f"Success! Generated ID: {cps_id} with {len(cps_lines)} configurations."
+            })
+            session.commit()
+            db._pin_primary()
+
+        return result
+    except Exception as e:
+        return {"status": 500, "message": str(e)}
+
+
+# ==============================================================================
+# 6. DATA CONTOH (TEST / BENCHMARK)
+# ==============================================================================
+DEMO_MASTER = {
+    "presales": [("Andi", "andi@example.com"), ("Budi", "budi@example.com"), ("Citra", "citra@example.com")],
+    "mapping_pam": [("Andi", "Dewi"), ("Budi", "Eko"), ("Citra", "Dewi")],
+    "responsible": [("Dewi",), ("Eko",)],
+    "sales_names": [("ENT1", "Fajar"), ("ENT1", "Gita"), ("COM2", "Hadi"), ("GOV3", "Indah")],
+    "companies": [("PT Bank Contoh", "Banking"), ("PT Telko Nusantara", "Telco"), ("Kementerian Contoh", "Government")],
+    "distributors": [("Metrodata",), ("Synnex",)],
+    "brands": [("Cisco", "Distributor", "CSC"), ("Fortinet", "Direct", "FTN"), ("Dell", "Distributor", "DEL")],
+    "master_pillars": [
+        ("Network", "Campus LAN", "Implementation", "NW", "1", "S1"),
+        ("Network", "SD-WAN", "Managed Service", "NW", "2", "S2"),
+        ("Security", "Firewall", "Implementation", "SEC", "1", "S1"),
+        ("Data Center", "Compute", "Supply Only", "DC", "1", "S3"),
+    ],
+    "stage_pipeline": [
+        (stage, "PRESALES", None) for stage in ["Open", "Proposal", "Negotiation", "Closed Won", "Closed Lost"]
+    ],
+}
+
+def seed_master_data():
+    """Isi master data contoh jika tabel presales masih kosong."""
+    with get_conn().session as session:
+        if session.execute(text("SELECT COUNT(*) FROM presales")).scalar_one():
+            return
+        for table, rows in DEMO_MASTER.items():
+            cols = [r[1] for r in session.execute(text(f"PRAGMA table_info({table})"))][:len(rows[0])]
+            session.execute(
+                text(f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join(':' + c for c in cols)})"),
+                [dict(zip(cols, r)) for r in rows]
+            )
+        session.commit()
+
+def seed_opportunities(n, seed=0):
+    """
+    Buat n opportunity dummy lewat write path yang sama dengan app (ID, header, history, audit),
+    lalu pindahkan sebagian ke stage berikutnya dan ambil snapshot hari ini.
+    """
+    rnd = random.Random(seed)
+    m = DEMO_MASTER
+    stages = [s[0] for s in m["stage_pipeline"]]
+    created = []
+    for i in range(n):
+        presales, _ = rnd.choice(m["presales"])
+        group, sales = rnd.choice(m["sales_names"])
+        company, vertical = rnd.choice(m["companies"])
+        lines = []
+        for _ in range(rnd.randint(1, 3)):
+            pillar, solution, service = rnd.choice(m["master_pillars"])[:3]
+            brand, channel, _ = rnd.choice(m["brands"])
+            lines.append({
+                "pillar": pillar, "solution": solution, "service": service, "brand": brand,
+                "channel": channel, "distributor_name": rnd.choice(m["distributors"])[0],
+                "cost": rnd.randrange(10, 5000) * 1_000_000, "notes": f"Demo line {i}"
+            })
+        res = add_multi_line_opportunity({
+            "presales_name": presales, "salesgroup_id": group, "sales_name": sales,
+            "responsible_name": rnd.choice(m["responsible"])[0], "opportunity_name": f"Demo Opportunity {i:05d}",
+            "start_date": date.today() - timedelta(days=rnd.randrange(365)), "company_name": company,
+            "vertical_industry": vertical, "stage": "Open", "stage_notes": ""
+        }, lines)
+        if res["status"] != 200:
+            raise RuntimeError(res["message"])
+        created.append((res["data"][0]["opportunity_id"], presales))
+
+    for opp_id, presales in created:
+        if rnd.random() < 0.6:
+            update_opportunity_stage_batch([opp_id], rnd.choice(stages[1:]), "Demo stage move",
+                                           datetime.now(), presales)
+    take_pipeline_snapshot()
+    return len(created)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create (and optionally seed) a local SQLite database for backend.py")
+    parser.add_argument("path", nargs="?", default=DEFAULT_DB_PATH)
+    parser.add_argument("--seed", type=int, default=0, help="number of demo opportunities to create")
+    args = parser.parse_args(argv)
+
+    swapped = db.storage_backend() == "sqlite"
+    os.environ["PRESALES_STORAGE"] = f"sqlite:///{args.path}"
+    if not swapped:
+        # backend ter-import sebelum env di-set (storage Postgres): import ulang supaya fungsi
+        # SQLite dipasang lalu dibungkus wrapper resilience, sama seperti import biasa
+        importlib.reload(db)
+    get_conn()  # schema dibuat di koneksi pertama
+    seed_master_data()
+    if args.seed:
+        started = time.perf_counter()
+        seed_opportunities(args.seed)
+        print(f"Seeded {args.seed} opportunities in {time.perf_counter() - started:.1f}s")
+    print(f"SQLite database ready: {args.path}  (PRESALES_STORAGE=sqlite:///{args.path})")
+
+
+# Di akhir modul: backend memasang fungsi dari __all__ saat di-import, jadi semua fungsi di atas
+# harus sudah ada walau modul ini yang di-import duluan (backend.py hanya dipakai saat runtime).
+import backend as db  # noqa: E402
+
+
+if __name__ == "__main__":
+    # Jalankan lewat modul backend_sqlite (bukan __main__) supaya fungsi yang dipasang backend sama
+    import backend_sqlite
+    backend_sqlite.main()
@@ -0,0 +1,64 @@
+"""
+Cek cold-start: waktu import modul app dan modul berat yang tidak boleh ikut ter-import di awal.
+
+Jalankan dari root project (misal di CI setelah pip install -r requirements.txt):
+    python check_importtime.py                 # budget default
+    python check_importtime.py --budget-ms 800
+
+Memakai `python -X importtime`; streamlit di-import duluan supaya yang diukur hanya
+biaya modul app sendiri (pandas, backend, utils, ...).
+Exit code 1 jika budget terlampaui atau ada modul berat yang ter-import saat startup.
+"""
+import argparse
+import re
+import subprocess
+import sys
+
+TARGETS = ["backend", "utils"]
+DEFAULT_BUDGET_MS = 1500
+
+# Modul yang hanya boleh di-import saat pertama dipakai (koneksi DB, email, export, import).
+# pyarrow tidak masuk daftar: pandas sendiri meng-import-nya jika ter-install.
+DEFERRED_MODULES = ["sqlalchemy", "smtplib", "email.mime", "openpyxl", "export", "importer"]
+
+_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+def measure(module):
+    """Return (cumulative_ms, set nama modul yang ter-import) untuk `import module`."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import streamlit; import {module}"],
+        capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+
+    # Baris setelah 'streamlit' selesai = modul yang dibawa oleh import target
+    lines = [m for m in map(_LINE.match, proc.stderr.splitlines()) if m]
+    top_streamlit = max((i for i, m in enumerate(lines) if m.group(4) == "streamlit" and len(m.group(3)) == 1), default=-1)
+    after = lines[top_streamlit + 1:]
+    loaded = {m.group(4) for m in after}
+    total_us = sum(int(m.group(2)) for m in after if len(m.group(3)) == 1)
+    return total_us / 1000, loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check cold-start import time of the app modules")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module in TARGETS:
+        ms, loaded = measure(module)
+        eager = sorted(d for d in DEFERRED_MODULES if any(m == d or m.startswith(d + ".") for m in loaded))
+        status = "OK"
+        if ms > args.budget_ms:
+            status, failed = f"OVER BUDGET ({args.budget_ms:.0f} ms)", True
+        if eager:
+            status, failed = f"EAGER IMPORT: {', '.join(eager)}", True
+        print(f"import {module:<10} {ms:8.1f} ms  {status}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
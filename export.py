@@ -0,0 +1,187 @@
+"""
+Streaming export (CSV / XLSX / Parquet) langsung dari database.
+
+Data dibaca per chunk memakai server-side cursor lalu ditulis ke file sementara,
+jadi pemakaian memori tergantung ukuran chunk, bukan jumlah baris hasil filter.
+File sementara ada di EXPORT_DIR dan dihapus oleh export_query() berikutnya (sesi mana pun)
+setelah EXPORT_MAX_AGE_MINUTES, termasuk milik sesi yang sudah ditutup.
+"""
+import os
+import tempfile
+import time
+from decimal import Decimal
+
+import pandas as pd
+from sqlalchemy import text
+
+import backend as db
+
+CHUNK_SIZE = 5000
+EXCEL_MAX_ROWS = 1_048_575  # batas baris sheet Excel dikurangi header
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), "presales_exports")
+EXPORT_MAX_AGE_MINUTES = 30
+
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Excel (XLSX)": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+
+# Kolom export opportunities (urutan sama dengan clean_data_for_display)
+OPPORTUNITY_EXPORT_COLUMNS = [
+    'uid', 'opportunity_id', 'presales_name', 'responsible_name', 'salesgroup_id', 'sales_name',
+    'company_name', 'vertical_industry', 'opportunity_name', 'start_date', 'pillar', 'solution',
+    'service', 'brand', 'channel', 'distributor_name', 'cost', 'stage', 'notes', 'sales_notes',
+    'created_at', 'updated_at'
+]
+
+
+# 1. QUERY BUILDERS
+
+def build_opportunity_query(filters, start_date=None, end_date=None):
+    """Filter sama dengan tab3 (backend.build_opportunity_filter)."""
+    where_sql, params = db.build_opportunity_filter(filters, start_date, end_date)
+    sql = f"SELECT {', '.join(OPPORTUNITY_EXPORT_COLUMNS)} FROM opportunities{where_sql}"
+    return sql + " ORDER BY created_at DESC, uid", params
+
+def build_activity_log_query(opportunity_name=None):
+    sql = """
+        SELECT timestamp AS "Timestamp", opportunity_name AS "OpportunityName", user_name AS "User",
+               action AS "Action", field AS "Field", old_value AS "OldValue", new_value AS "NewValue",
+               source_table AS "SourceTable", record_key AS "RecordKey"
+        FROM activity_logs
+        WHERE (CAST(:opp AS text) IS NULL OR COALESCE(opportunity_name, 'Unknown') = CAST(:opp AS text))
+        ORDER BY timestamp DESC
+    """
+    return sql, {"opp": opportunity_name}
+
+
+# 2. STREAMING READER
+
+def iter_chunks(sql, params=None, chunk_size=CHUNK_SIZE):
+    """Yield DataFrame per chunk dari server-side cursor (stream_results), lewat pool long (replica jika ada)."""
+    with db.get_read_conn(long=True).engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(
+            text(sql), params or {}
+        )
+        columns = list(result.keys())
+        for rows in result.partitions(chunk_size):
+            yield _normalize_chunk(pd.DataFrame(rows, columns=columns))
+
+def _normalize_chunk(df):
+    # Decimal -> float dan timestamp tz-aware -> waktu Jakarta tanpa tz (aman untuk Excel/Parquet)
+    for col in df.columns:
+        sample = df[col].dropna()
+        if sample.empty:
+            continue
+        first = sample.iloc[0]
+        if isinstance(first, Decimal):
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+        elif getattr(first, 'tzinfo', None) is not None:
+            ts = pd.to_datetime(df[col], errors='coerce', utc=True)
+            df[col] = ts.dt.tz_convert('Asia/Jakarta').dt.tz_localize(None)
+    return df
+
+
+# 3. WRITERS (CSV / XLSX / PARQUET)
+
+def _write_csv(chunks, path):
+    rows = 0
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        for i, chunk in enumerate(chunks):
+            chunk.to_csv(f, index=False, header=(i == 0))
+            rows += len(chunk)
+    return rows
+
+def _write_xlsx(chunks, path, sheet_name="Data"):
+    from openpyxl import Workbook
+
+    # write_only: baris langsung di-flush, tidak disimpan sebagai object cell
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+    rows = 0
+    for i, chunk in enumerate(chunks):
+        if i == 0:
+            ws.append(list(chunk.columns))
+        if rows + len(chunk) > EXCEL_MAX_ROWS:
+            raise ValueError(f"Result exceeds Excel's {EXCEL_MAX_ROWS:,} row limit. Use CSV or Parquet.")
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        for record in chunk.itertuples(index=False, name=None):
+            ws.append(list(record))
+        rows += len(chunk)
+    wb.save(path)
+    return rows
+
+def _write_parquet(chunks, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer, schema, text_cols, rows = None, None, [], 0
+    try:
+        for chunk in chunks:
+            if writer is None:
+                # Schema dari chunk pertama; kolom yang masih kosong semua dijadikan string
+                inferred = pa.Schema.from_pandas(chunk, preserve_index=False)
+                text_cols = [f.name for f in inferred if pa.types.is_null(f.type)]
+                schema = pa.schema([pa.field(f.name, pa.string()) if f.name in text_cols else f for f in inferred])
+                writer = pq.ParquetWriter(path, schema, compression="snappy")
+            for col in text_cols:
+                chunk[col] = chunk[col].map(lambda v: None if v is None or v is pd.NaT else str(v))
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+# 4. ENTRY POINTS
+
+def cleanup_old_exports(max_age_minutes=EXPORT_MAX_AGE_MINUTES):
+    """Hapus file di EXPORT_DIR yang lebih tua dari max_age_minutes. Return jumlah file yang dihapus."""
+    cutoff = time.time() - max_age_minutes * 60
+    removed = 0
+    if not os.path.isdir(EXPORT_DIR):
+        return removed
+    with os.scandir(EXPORT_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                pass  # sudah dihapus proses lain
+    return removed
+
+def export_query(sql, params, fmt, prefix="export"):
+    """
+    Tulis hasil query ke file sementara dengan format fmt (key dari EXPORT_FORMATS).
+    Return dict status seperti backend: data berisi path, file_name, mime dan jumlah rows.
+    """
+    if fmt not in EXPORT_FORMATS:
+        return {"status": 400, "message": f"Unsupported format: {fmt}"}
+    ext, mime = EXPORT_FORMATS[fmt]
+    cleanup_old_exports()
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=f"{prefix}_", suffix=f".{ext}", dir=EXPORT_DIR)
+    os.close(fd)
+
+    writer = {"csv": _write_csv, "xlsx": _write_xlsx, "parquet": _write_parquet}[ext]
+    try:
+        rows = writer(iter_chunks(sql, params), path)
+    except Exception as e:
+        os.remove(path)
+        return {"status": 500, "message": str(e)}
+    if rows == 0:
+        os.remove(path)
+        return {"status": 404, "message": "No data matches the current filter."}
+    file_name = f"{prefix}_{pd.Timestamp.now():%Y%m%d_%H%M%S}.{ext}"
+    return {"status": 200, "data": {"path": path, "file_name": file_name, "mime": mime, "rows": rows}}
+
+def export_opportunities(filters, start_date=None, end_date=None, fmt="CSV"):
+    sql, params = build_opportunity_query(filters, start_date, end_date)
+    return export_query(sql, params, fmt, prefix="opportunities")
+
+def export_activity_log(opportunity_name=None, fmt="CSV"):
+    sql, params = build_activity_log_query(opportunity_name)
+    return export_query(sql, params, fmt, prefix="activity_log")
@@ -0,0 +1,134 @@
+"""
+Bulk import opportunity dari CSV / Excel.
+
+Alur: read_upload() -> validate_import() (vectorized, terhadap master data)
+-> backend.bulk_import_opportunities() (COPY ke staging + merge dalam satu transaksi).
+Satu baris file = satu solution line. Line dengan opportunity_name yang sama
+digabung menjadi satu opportunity (satu rows_id / opportunity_id).
+"""
+import io
+
+import pandas as pd
+
+import backend as db
+
+# Kolom header (harus sama untuk semua line dalam satu opportunity_name)
+HEADER_COLUMNS = [
+    'opportunity_name', 'presales_name', 'responsible_name', 'salesgroup_id', 'sales_name',
+    'company_name', 'vertical_industry', 'start_date', 'stage'
+]
+REQUIRED_COLUMNS = [
+    'opportunity_name', 'presales_name', 'responsible_name', 'salesgroup_id', 'sales_name',
+    'company_name', 'vertical_industry', 'start_date', 'pillar', 'solution', 'service', 'brand', 'cost'
+]
+OPTIONAL_COLUMNS = ['channel', 'distributor_name', 'notes', 'stage', 'stage_notes']
+DEFAULT_STAGE = 'Open'
+# start_date: ISO (2025-03-25) atau hari/bulan/tahun (25/03/2025), dicoba per baris dengan format
+# eksplisit. Tanpa format pandas menebak dari baris pertama, jadi 05/03/2025 bisa terbaca 3 Mei
+# atau 5 Maret tergantung urutan baris. Sel tanggal Excel sudah berupa datetime dan langsung dipakai.
+START_DATE_FORMATS = ['%Y-%m-%d', '%d/%m/%Y']
+START_DATE_HINT = "start_date: YYYY-MM-DD (2025-03-25) or DD/MM/YYYY (25/03/2025)"
+
+
+def template_csv():
+    """
+    Header kosong untuk di-download sebagai template import. Format start_date yang diterima
+    lihat START_DATE_FORMATS / START_DATE_HINT (ditampilkan di samping tombol download).
+    """
+    return ",".join(REQUIRED_COLUMNS + OPTIONAL_COLUMNS).encode("utf-8-sig")
+
+def read_upload(uploaded_file):
+    name = getattr(uploaded_file, "name", "").lower()
+    try:
+        if name.endswith((".xlsx", ".xls")):
+            df = pd.read_excel(uploaded_file, dtype=object)
+        else:
+            df = pd.read_csv(uploaded_file, dtype=object, encoding="utf-8-sig")
+    except Exception as e:
+        return {"status": 400, "message": f"Cannot read file: {e}"}
+    # Normalisasi nama kolom: "Opportunity Name" -> opportunity_name
+    df.columns = [str(c).strip().lower().replace(" ", "_") for c in df.columns]
+    return {"status": 200, "data": df}
+
+def _parse_start_date(values):
+    """Kolom start_date -> date per baris dengan START_DATE_FORMATS; format lain -> NaT."""
+    values = values.map(lambda v: v.strip() if isinstance(v, str) else v)
+    parsed = pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns]")
+    for fmt in START_DATE_FORMATS:
+        parsed = parsed.fillna(pd.to_datetime(values, format=fmt, errors='coerce'))
+    return parsed.dt.date
+
+def _master_index(action, columns):
+    master = pd.DataFrame(db.get_master_presales(action))
+    if master.empty or not set(columns).issubset(master.columns):
+        return pd.MultiIndex.from_arrays([[]] * len(columns))
+    return pd.MultiIndex.from_frame(master[columns].astype(str))
+
+def validate_import(df):
+    """
+    Validasi seluruh file sekaligus (tanpa loop per baris).
+    Return data: {"valid": DataFrame siap import, "errors": DataFrame baris yang ditolak + alasan}
+    """
+    missing = [c for c in REQUIRED_COLUMNS if c not in df.columns]
+    if missing:
+        return {"status": 400, "message": f"Missing columns: {', '.join(missing)}"}
+
+    df = df.copy()
+    for col in OPTIONAL_COLUMNS:
+        if col not in df.columns:
+            df[col] = None
+    df = df[REQUIRED_COLUMNS + OPTIONAL_COLUMNS]
+    # Nomor baris sesuai spreadsheet (baris 1 = header)
+    df.insert(0, 'row_no', range(2, len(df) + 2))
+
+    text_cols = [c for c in df.columns if c not in ('row_no', 'cost', 'start_date')]
+    for col in text_cols:
+        df[col] = df[col].astype("string").str.strip().replace("", pd.NA)
+
+    errors = pd.Series("", index=df.index, dtype=object)
+
+    def flag(mask, message):
+        errors[mask.fillna(True).astype(bool)] += message + "; "
+
+    # 1. Wajib isi
+    for col in REQUIRED_COLUMNS:
+        flag(df[col].isna(), f"{col} is required")
+
+    # 2. Tipe data
+    df['cost'] = pd.to_numeric(df['cost'], errors='coerce')
+    flag(df['cost'].isna() | (df['cost'] < 0), "cost must be a non-negative number")
+    df['start_date'] = _parse_start_date(df['start_date'])
+    flag(df['start_date'].isna(), "start_date is not a valid date (use YYYY-MM-DD or DD/MM/YYYY)")
+    df['stage'] = df['stage'].fillna(DEFAULT_STAGE)
+
+    # 3. Master data
+    combo = pd.MultiIndex.from_frame(df[['pillar', 'solution', 'service']].astype(str))
+    flag(pd.Series(~combo.isin(_master_index('getPillars', ['Pillar', 'Solution', 'Service'])), index=df.index),
+         "pillar/solution/service not found in master")
+    flag(~df['brand'].astype(str).isin(_master_index('getBrands', ['Brand']).get_level_values(0)),
+         "brand not found in master")
+    sales = pd.MultiIndex.from_frame(df[['salesgroup_id', 'sales_name']].astype(str))
+    flag(pd.Series(~sales.isin(_master_index('getSalesNames', ['SalesGroup', 'SalesName'])), index=df.index),
+         "sales_name does not belong to salesgroup_id")
+    stages = set(_master_index('getPresalesStages', ['Stage']).get_level_values(0)) | {DEFAULT_STAGE}
+    flag(~df['stage'].astype(str).isin(stages), "stage not found in presales stages")
+
+    # 4. Header harus konsisten antar line dalam satu opportunity
+    header_key = df[HEADER_COLUMNS].astype(str)
+    inconsistent = header_key.groupby(header_key['opportunity_name'])[HEADER_COLUMNS[1:]] \
+                             .transform('nunique').gt(1).any(axis=1)
+    flag(inconsistent, "header fields differ between lines of the same opportunity")
+
+    # 5. Satu line gagal -> seluruh opportunity ditolak (tidak ada opportunity setengah jadi)
+    bad_names = df.loc[errors != "", 'opportunity_name'].dropna().unique()
+    flag(df['opportunity_name'].isin(bad_names) & (errors == ""), "another line of this opportunity is invalid")
+
+    rejected = errors != ""
+    errors_df = df[rejected].copy()
+    errors_df.insert(1, 'error', errors[rejected].str.rstrip("; "))
+    return {"status": 200, "data": {"valid": df[~rejected].reset_index(drop=True), "errors": errors_df}}
+
+def errors_csv(errors_df):
+    buf = io.StringIO()
+    errors_df.to_csv(buf, index=False)
+    return buf.getvalue().encode("utf-8-sig")
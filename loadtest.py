@@ -0,0 +1,237 @@
+"""
+Load test: N sesi presales simultan menjalankan skenario realistis terhadap app.py,
+memakai Streamlit AppTest + database stand-in SQLite (backend_sqlite.py), tanpa Postgres.
+
+Jalankan dari root project:
+    python loadtest.py                                        # semua skenario, 10 sesi
+    python loadtest.py --sessions 25 --iterations 5 --scenario kanban --scenario tab1_submit
+    python loadtest.py --db loadtest.db --seed 1000 --json loadtest_result.json
+
+Skenario:
+    kanban        buka app (semua tab dirender), buka detail satu kartu Kanban, kembali
+    tab3_filters  toggle slicer Stage / Pillar / Sales Group di tab3, lalu reset
+    tab1_submit   isi form Add Opportunity (1-3 solusi) lalu submit
+    tab4_update   load line satu opportunity, lalu pindahkan stage-nya
+
+Setiap sesi = satu proses (AppTest memakai state global Streamlit, jadi tidak bisa paralel
+dalam satu proses); semua sesi mulai bersamaan dan berbagi file database yang sama.
+Cache backend & st.cache_data per proses, jadi angka ini mendekati skenario "cache dingin"
+per worker. Yang dilaporkan per skenario:
+    p50/p95/p99 latency rerun (ms), throughput (rerun/detik), peak RSS per sesi (MB),
+    jumlah query DB (total & per rerun), rerun yang error.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import random
+import resource
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+DEFAULT_DB_PATH = "loadtest.db"
+DEFAULT_SEED_OPPORTUNITIES = 300
+RERUN_TIMEOUT_S = 120
+BARRIER_TIMEOUT_S = 600  # warm-up semua sesi (import + koneksi) harus selesai dalam waktu ini
+
+SCENARIOS = {}
+
+def scenario(fn):
+    SCENARIOS[fn.__name__] = fn
+    return fn
+
+
+# ==============================================================================
+# 1. SKENARIO (dijalankan di proses worker)
+# ==============================================================================
+def _first(elements, label):
+    return next(e for e in elements if e.label == label)
+
+@scenario
+def kanban(step, rnd, opp_ids):
+    at = step("open app", None)
+    cards = [b for b in at.button if (b.key or "").startswith("btn_")]
+    if cards:
+        step("open kanban detail", rnd.choice(cards).click())
+        step("back to kanban", _first(at.button, "⬅️ Back to Kanban View").click())
+
+@scenario
+def tab3_filters(step, rnd, opp_ids):
+    at = step("open app", None)
+    for label in ("Stage", "Pillar", "Sales Group"):
+        widget = _first(at.multiselect, label)
+        if widget.options:
+            step(f"filter {label}", widget.select(rnd.choice(widget.options)))
+    for label in ("Stage", "Pillar", "Sales Group"):
+        widget = _first(at.multiselect, label)
+        if widget.value:
+            step(f"clear {label}", widget.set_value([]))
+
+@scenario
+def tab1_submit(step, rnd, opp_ids):
+    at = step("open app", None)
+    for _ in range(rnd.randint(0, 2)):
+        step("add solution", _first(at.button, "➕ Add Another Solution").click())
+    opp_name = at.selectbox(key="parent_opportunity_name")
+    opp_name.select(rnd.choice(opp_name.options))
+    for ni in at.number_input:
+        if (ni.key or "").startswith("cost_"):
+            ni.set_value(rnd.randrange(10, 5000) * 1_000_000)
+    step("submit opportunity", _first(at.button, "Submit Opportunity and All Solutions").click())
+
+@scenario
+def tab4_update(step, rnd, opp_ids):
+    at = step("open app", None)
+    opp_id = rnd.choice(opp_ids)
+    at.text_input(key="sol_edit_opp_id").input(opp_id)
+    step("load solution lines", _first(at.button, "Get Solution Data").click())
+
+    step("switch to stage mode", _first(at.radio, "Select Update Type:").set_value("📈 Update Stage (Business Progression)"))
+    at.text_input(key="oid_update_stg").input(opp_id)
+    step("get opportunity status", _first(at.button, "Get Opportunity Status").click())
+    new_stage = at.selectbox(key="single_new_stage")
+    step("choose stage", new_stage.select(rnd.choice(new_stage.options)))
+    step("update stage", _first(at.button, "🚀 Update Stage Progression").click())
+
+
+def _worker(name, session_no, iterations, db_path, opp_ids, barrier, results):
+    os.environ["PRESALES_STORAGE"] = f"sqlite:///{db_path}"
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from streamlit.testing.v1 import AppTest
+
+    queries = [0]
+    event.listen(Engine, "before_cursor_execute", lambda *args: queries.__setitem__(0, queries[0] + 1))
+
+    # Import modul app & koneksi DB di luar pengukuran, lalu semua sesi mulai bersamaan
+    AppTest.from_file("app.py", default_timeout=RERUN_TIMEOUT_S).run()
+    barrier.wait(timeout=BARRIER_TIMEOUT_S)
+
+    samples, errors = [], []
+
+    def step(label, target):
+        """Satu rerun: target = widget yang sudah di-set / di-klik, None = sesi baru. Catat latency & query."""
+        at = AppTest.from_file("app.py", default_timeout=RERUN_TIMEOUT_S) if target is None else target
+        q0, t0 = queries[0], time.perf_counter()
+        err = None
+        try:
+            at = at.run()
+            err = "; ".join(str(e.value) for e in at.exception) or None
+        except Exception as e:
+            err = f"{type(e).__name__}: {e}"
+        samples.append({"step": label, "ms": (time.perf_counter() - t0) * 1000, "queries": queries[0] - q0})
+        if err:
+            errors.append(f"{label}: {err}")
+        return at
+
+    rnd = random.Random(f"{name}-{session_no}")
+    started = time.perf_counter()
+    for _ in range(iterations):
+        try:
+            SCENARIOS[name](step, rnd, opp_ids)
+        except Exception as e:
+            # Widget yang dicari tidak ada (misal karena rerun sebelumnya error)
+            errors.append(f"script: {type(e).__name__}: {e}")
+    results.put({
+        "session": session_no,
+        "samples": samples,
+        "errors": errors,
+        "elapsed_s": time.perf_counter() - started,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+# ==============================================================================
+# 2. RUNNER & LAPORAN
+# ==============================================================================
+def prepare_db(db_path, seed_n):
+    """Buat & isi database stand-in jika belum ada opportunity, return daftar opportunity_id."""
+    import backend_sqlite
+
+    backend_sqlite.main([db_path, "--seed", "0"])
+    with sqlite3.connect(db_path) as con:
+        if not con.execute("SELECT COUNT(*) FROM opportunities").fetchone()[0]:
+            backend_sqlite.seed_opportunities(seed_n)
+        return [r[0] for r in con.execute("SELECT DISTINCT opportunity_id FROM opportunities")]
+
+def run_scenario(name, sessions, iterations, db_path, opp_ids):
+    ctx = mp.get_context("spawn")
+    barrier, results = ctx.Barrier(sessions + 1), ctx.Queue()
+    procs = [
+        ctx.Process(target=_worker, args=(name, i, iterations, db_path, opp_ids, barrier, results))
+        for i in range(sessions)
+    ]
+    for p in procs:
+        p.start()
+    barrier.wait(timeout=BARRIER_TIMEOUT_S)
+    started = time.perf_counter()
+    reports = [results.get() for _ in procs]
+    wall_s = time.perf_counter() - started
+    for p in procs:
+        p.join()
+
+    samples = [s for r in reports for s in r["samples"]]
+    ms = np.array([s["ms"] for s in samples]) if samples else np.zeros(1)
+    n_queries = sum(s["queries"] for s in samples)
+    by_step = {}
+    for s in samples:
+        by_step.setdefault(s["step"], []).append(s["ms"])
+    return {
+        "scenario": name,
+        "sessions": sessions,
+        "reruns": len(samples),
+        "errors": sum(len(r["errors"]) for r in reports),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "throughput_rps": len(samples) / wall_s if wall_s else 0.0,
+        "peak_rss_mb": max(r["peak_rss_mb"] for r in reports),
+        "queries": n_queries,
+        "queries_per_rerun": n_queries / len(samples) if samples else 0.0,
+        "steps": {k: {"count": len(v), "p50_ms": float(np.percentile(v, 50)), "p95_ms": float(np.percentile(v, 95))}
+                  for k, v in by_step.items()},
+        "error_samples": [e for r in reports for e in r["errors"]][:10],
+    }
+
+def print_report(rows):
+    header = f"{'scenario':<14}{'sess':>5}{'reruns':>8}{'err':>5}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}" \
+             f"{'rerun/s':>9}{'RSS MB':>8}{'queries':>9}{'q/rerun':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        print(f"{r['scenario']:<14}{r['sessions']:>5}{r['reruns']:>8}{r['errors']:>5}"
+              f"{r['p50_ms']:>9.0f}{r['p95_ms']:>9.0f}{r['p99_ms']:>9.0f}"
+              f"{r['throughput_rps']:>9.2f}{r['peak_rss_mb']:>8.0f}{r['queries']:>9}{r['queries_per_rerun']:>9.1f}")
+    for r in rows:
+        for e in r["error_samples"]:
+            print(f"  [{r['scenario']}] {e}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for the Streamlit app")
+    parser.add_argument("--sessions", type=int, default=10, help="simultaneous sessions per scenario")
+    parser.add_argument("--iterations", type=int, default=3, help="scenario runs per session")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="default: all scenarios")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="SQLite stand-in database file")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED_OPPORTUNITIES,
+                        help="demo opportunities to create when the database is empty")
+    parser.add_argument("--json", help="also write the full result (incl. per-step latency) to this file")
+    args = parser.parse_args(argv)
+
+    opp_ids = prepare_db(args.db, args.seed)
+    rows = []
+    for name in args.scenario or list(SCENARIOS):
+        print(f"Running {name}: {args.sessions} sessions x {args.iterations} iterations ...", flush=True)
+        rows.append(run_scenario(name, args.sessions, args.iterations, args.db, opp_ids))
+    print()
+    print_report(rows)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+    return 1 if any(r["errors"] for r in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+-- =============================================================================
+-- 001: FULL-TEXT SEARCH OPPORTUNITIES
+-- Dipakai oleh backend.search_opportunities()
+-- Jalankan sekali: psql "$DATABASE_URL" -f migrations/001_opportunity_search.sql
+-- =============================================================================
+
+-- Dokumen pencarian. Config 'simple' dipakai karena isi data campuran
+-- Bahasa Indonesia & Inggris (tanpa stemming, hanya lowercase).
+CREATE OR REPLACE FUNCTION opportunity_search_document(
+    p_opportunity_name text,
+    p_company_name text,
+    p_notes text,
+    p_stage_notes text,
+    p_closing_notes text
+) RETURNS tsvector
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT setweight(to_tsvector('simple', coalesce(p_opportunity_name, '')), 'A')
+        || setweight(to_tsvector('simple', coalesce(p_company_name, '')), 'A')
+        || setweight(to_tsvector('simple', coalesce(p_notes, '')), 'B')
+        || setweight(to_tsvector('simple', coalesce(p_stage_notes, '')), 'C')
+        || setweight(to_tsvector('simple', coalesce(p_closing_notes, '')), 'C')
+$$;
+
+-- Tabel terpisah agar "SELECT * FROM opportunities" (dashboard & kanban)
+-- tidak ikut membawa kolom tsvector ke pandas.
+CREATE TABLE IF NOT EXISTS opportunity_search (
+    uid            text PRIMARY KEY,
+    opportunity_id text,
+    search_vector  tsvector NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_opportunity_search_vector
+    ON opportunity_search USING GIN (search_vector);
+
+-- Sinkronisasi otomatis dari opportunities
+CREATE OR REPLACE FUNCTION opportunity_search_sync() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.uid IS DISTINCT FROM NEW.uid) THEN
+        DELETE FROM opportunity_search WHERE uid = OLD.uid;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO opportunity_search (uid, opportunity_id, search_vector)
+        VALUES (
+            NEW.uid,
+            NEW.opportunity_id,
+            opportunity_search_document(
+                NEW.opportunity_name, NEW.company_name, NEW.notes,
+                NEW.stage_notes, NEW.closing_notes
+            )
+        )
+        ON CONFLICT (uid) DO UPDATE
+            SET opportunity_id = EXCLUDED.opportunity_id,
+                search_vector  = EXCLUDED.search_vector;
+    END IF;
+
+    RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS trg_opportunity_search_ins_del ON opportunities;
+CREATE TRIGGER trg_opportunity_search_ins_del
+    AFTER INSERT OR DELETE ON opportunities
+    FOR EACH ROW EXECUTE FUNCTION opportunity_search_sync();
+
+-- Update hanya memicu sync jika kolom yang di-index berubah
+DROP TRIGGER IF EXISTS trg_opportunity_search_upd ON opportunities;
+CREATE TRIGGER trg_opportunity_search_upd
+    AFTER UPDATE OF uid, opportunity_id, opportunity_name, company_name,
+                    notes, stage_notes, closing_notes ON opportunities
+    FOR EACH ROW EXECUTE FUNCTION opportunity_search_sync();
+
+-- Backfill data lama
+INSERT INTO opportunity_search (uid, opportunity_id, search_vector)
+SELECT uid, opportunity_id,
+       opportunity_search_document(opportunity_name, company_name, notes, stage_notes, closing_notes)
+FROM opportunities
+ON CONFLICT (uid) DO NOTHING;
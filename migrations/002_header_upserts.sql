@@ -0,0 +1,86 @@
+-- =============================================================================
+-- 002: UNIQUE CONSTRAINT & SEQUENCE UNTUK HEADER UPSERT
+-- Dipakai oleh backend.add_multi_line_opportunity() (INSERT ... ON CONFLICT)
+-- =============================================================================
+
+-- Dedup sebelum unique index: alur lama (SELECT lalu INSERT) bisa membuat nama yang sama
+-- dua kali saat submit bersamaan. Per nama dipertahankan rows_id terkecil; opportunity_id
+-- ({salesgroup}{rows_id}) yang memakai rows_id duplikat dipindah ke rows_id tsb. uid line
+-- tidak diubah. Header Sales yang jadi dobel: yang paling lama dipertahankan.
+DO $$
+DECLARE
+    n_dupes integer;
+BEGIN
+    CREATE TEMP TABLE description_dupes ON COMMIT DROP AS
+    SELECT d.description, d.rows_id AS old_rows_id, k.keep_rows_id
+    FROM description d
+    JOIN (
+        SELECT description, (array_agg(rows_id ORDER BY length(rows_id), rows_id))[1] AS keep_rows_id
+        FROM description
+        GROUP BY description
+        HAVING count(*) > 1
+    ) k ON k.description = d.description AND d.rows_id <> k.keep_rows_id;
+
+    SELECT count(*) INTO n_dupes FROM description_dupes;
+    IF n_dupes = 0 THEN
+        RETURN;
+    END IF;
+    PERFORM set_config('app.actor', 'migration 002 dedup', true);
+
+    CREATE TEMP TABLE opportunity_id_remap ON COMMIT DROP AS
+    SELECT DISTINCT o.opportunity_id AS old_id,
+           left(o.opportunity_id, length(o.opportunity_id) - length(x.old_rows_id)) || x.keep_rows_id AS new_id
+    FROM opportunities o
+    JOIN description_dupes x
+      ON o.opportunity_name = x.description AND right(o.opportunity_id, length(x.old_rows_id)) = x.old_rows_id
+    UNION
+    SELECT DISTINCT s.opportunity_id,
+           left(s.opportunity_id, length(s.opportunity_id) - length(x.old_rows_id)) || x.keep_rows_id
+    FROM sales_opportunities s
+    JOIN description_dupes x
+      ON s.opportunity_name = x.description AND right(s.opportunity_id, length(x.old_rows_id)) = x.old_rows_id;
+
+    UPDATE opportunities o SET opportunity_id = r.new_id
+    FROM opportunity_id_remap r WHERE o.opportunity_id = r.old_id;
+    UPDATE sales_opportunities s SET opportunity_id = r.new_id
+    FROM opportunity_id_remap r WHERE s.opportunity_id = r.old_id;
+    IF to_regclass('opportunity_stage_history') IS NOT NULL THEN
+        UPDATE opportunity_stage_history h SET opportunity_id = r.new_id
+        FROM opportunity_id_remap r WHERE h.opportunity_id = r.old_id;
+    END IF;
+
+    DELETE FROM description d USING description_dupes x WHERE d.rows_id = x.old_rows_id;
+    RAISE NOTICE 'migration 002: merged % duplicate opportunity name(s), % opportunity_id(s) remapped',
+        n_dupes, (SELECT count(*) FROM opportunity_id_remap);
+END
+$$;
+
+-- Satu opportunity_id = satu header di Sales App (header dobel lama: yang paling awal dipertahankan)
+DELETE FROM sales_opportunities
+WHERE ctid IN (
+    SELECT ctid FROM (
+        SELECT ctid, row_number() OVER (PARTITION BY opportunity_id ORDER BY created_at NULLS LAST, ctid) AS rn
+        FROM sales_opportunities
+    ) x
+    WHERE rn > 1
+);
+
+-- Satu nama opportunity = satu rows_id
+CREATE UNIQUE INDEX IF NOT EXISTS uq_description_description
+    ON description (description);
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_sales_opportunities_opportunity_id
+    ON sales_opportunities (opportunity_id);
+
+-- Nomor urut rows_id (Q3xxxx). Menggantikan SELECT MAX(rows_id) yang rawan
+-- bentrok jika dua submit masuk bersamaan.
+CREATE SEQUENCE IF NOT EXISTS description_rows_id_seq MINVALUE 0 START 0;
+
+SELECT setval(
+    'description_rows_id_seq',
+    COALESCE(
+        (SELECT MAX(substring(rows_id FROM 3)::bigint) FROM description WHERE rows_id ~ '^Q3[0-9]+$') + 1,
+        0
+    ),
+    false
+);
@@ -0,0 +1,109 @@
+-- =============================================================================
+-- 003: AUDIT TRAIL DI LEVEL DATABASE (CHANGE DATA CAPTURE)
+-- Menggantikan INSERT activity_logs manual di backend.py.
+-- Actor diambil dari session variable `app.actor` yang di-set backend per
+-- transaksi: SELECT set_config('app.actor', '<nama user>', true)
+-- =============================================================================
+
+ALTER TABLE activity_logs ADD COLUMN IF NOT EXISTS source_table text;
+ALTER TABLE activity_logs ADD COLUMN IF NOT EXISTS record_key text;
+
+CREATE OR REPLACE FUNCTION audit_actor() RETURNS text
+LANGUAGE sql STABLE AS $$
+    SELECT COALESCE(NULLIF(current_setting('app.actor', true), ''), current_user::text)
+$$;
+
+-- UPDATE: satu baris log per field yang berubah (old -> new).
+-- TG_ARGV[0] = kolom kunci baris (disimpan ke record_key)
+CREATE OR REPLACE FUNCTION audit_capture_update() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    new_doc jsonb := to_jsonb(NEW);
+    old_doc jsonb := to_jsonb(OLD);
+BEGIN
+    INSERT INTO activity_logs (
+        timestamp, opportunity_name, user_name, action, field,
+        old_value, new_value, source_table, record_key
+    )
+    SELECT NOW(), new_doc ->> 'opportunity_name', audit_actor(), 'UPDATE',
+           initcap(replace(n.key, '_', ' ')),
+           o.value #>> '{}', n.value #>> '{}',
+           TG_TABLE_NAME, old_doc ->> TG_ARGV[0]
+    FROM jsonb_each(new_doc) n
+    JOIN jsonb_each(old_doc) o ON o.key = n.key
+    WHERE n.value IS DISTINCT FROM o.value
+      AND n.key NOT IN ('created_at', 'updated_at');
+    RETURN NULL;
+END
+$$;
+
+-- INSERT / DELETE: satu baris log per kelompok (mis. per opportunity_id),
+-- bukan per baris, memakai transition table `changed_rows`.
+-- TG_ARGV[0] = kolom pengelompokan, TG_ARGV[1] = label Field
+CREATE OR REPLACE FUNCTION audit_capture_statement() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO activity_logs (
+        timestamp, opportunity_name, user_name, action, field,
+        new_value, source_table, record_key
+    )
+    SELECT NOW(), g.opportunity_name, audit_actor(),
+           CASE TG_OP WHEN 'INSERT' THEN 'CREATE' ELSE 'DELETE' END,
+           TG_ARGV[1],
+           format('%s %s lines. ID: %s',
+                  CASE TG_OP WHEN 'INSERT' THEN 'Created' ELSE 'Deleted' END,
+                  g.line_count, g.group_key),
+           TG_TABLE_NAME, g.group_key
+    FROM (
+        SELECT to_jsonb(r) ->> TG_ARGV[0] AS group_key,
+               to_jsonb(r) ->> 'opportunity_name' AS opportunity_name,
+               count(*) AS line_count
+        FROM changed_rows r
+        GROUP BY 1, 2
+    ) g;
+    RETURN NULL;
+END
+$$;
+
+-- -----------------------------------------------------------------------------
+-- Pasang trigger ke tiga tabel utama
+-- -----------------------------------------------------------------------------
+
+-- opportunities (detail line presales)
+DROP TRIGGER IF EXISTS trg_audit_upd ON opportunities;
+CREATE TRIGGER trg_audit_upd AFTER UPDATE ON opportunities
+    FOR EACH ROW EXECUTE FUNCTION audit_capture_update('uid');
+DROP TRIGGER IF EXISTS trg_audit_ins ON opportunities;
+CREATE TRIGGER trg_audit_ins AFTER INSERT ON opportunities
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION audit_capture_statement('opportunity_id', 'Opportunity');
+DROP TRIGGER IF EXISTS trg_audit_del ON opportunities;
+CREATE TRIGGER trg_audit_del AFTER DELETE ON opportunities
+    REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION audit_capture_statement('opportunity_id', 'Opportunity');
+
+-- sales_opportunities (header Sales App)
+DROP TRIGGER IF EXISTS trg_audit_upd ON sales_opportunities;
+CREATE TRIGGER trg_audit_upd AFTER UPDATE ON sales_opportunities
+    FOR EACH ROW EXECUTE FUNCTION audit_capture_update('opportunity_id');
+DROP TRIGGER IF EXISTS trg_audit_ins ON sales_opportunities;
+CREATE TRIGGER trg_audit_ins AFTER INSERT ON sales_opportunities
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION audit_capture_statement('opportunity_id', 'Sales Header');
+DROP TRIGGER IF EXISTS trg_audit_del ON sales_opportunities;
+CREATE TRIGGER trg_audit_del AFTER DELETE ON sales_opportunities
+    REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION audit_capture_statement('opportunity_id', 'Sales Header');
+
+-- cps_opportunities
+DROP TRIGGER IF EXISTS trg_audit_upd ON cps_opportunities;
+CREATE TRIGGER trg_audit_upd AFTER UPDATE ON cps_opportunities
+    FOR EACH ROW EXECUTE FUNCTION audit_capture_update('uid');
+DROP TRIGGER IF EXISTS trg_audit_ins ON cps_opportunities;
+CREATE TRIGGER trg_audit_ins AFTER INSERT ON cps_opportunities
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION audit_capture_statement('cps_id', 'CPS Opportunity');
+DROP TRIGGER IF EXISTS trg_audit_del ON cps_opportunities;
+CREATE TRIGGER trg_audit_del AFTER DELETE ON cps_opportunities
+    REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION audit_capture_statement('cps_id', 'CPS Opportunity');
@@ -0,0 +1,30 @@
+-- =============================================================================
+-- 004: STATE MACHINE STAGE & STAGE HISTORY
+-- Dipakai oleh backend.update_opportunity_stage_batch()
+-- =============================================================================
+
+-- Daftar stage tujuan yang boleh dari stage ini.
+-- NULL = bebas (perilaku lama), contoh pengisian:
+--   UPDATE stage_pipeline SET allowed_next_stages = ARRAY['Proposal', 'Closed Lost']
+--   WHERE stage_type = 'PRESALES' AND stage_name = 'Open';
+ALTER TABLE stage_pipeline ADD COLUMN IF NOT EXISTS allowed_next_stages text[];
+
+-- Riwayat perpindahan stage (satu baris per opportunity per perpindahan)
+CREATE TABLE IF NOT EXISTS opportunity_stage_history (
+    id             bigserial PRIMARY KEY,
+    opportunity_id text        NOT NULL,
+    from_stage     text,
+    to_stage       text        NOT NULL,
+    changed_at     timestamptz NOT NULL DEFAULT NOW(),
+    actor          text,
+    reason         text
+);
+
+CREATE INDEX IF NOT EXISTS idx_stage_history_opp
+    ON opportunity_stage_history (opportunity_id, changed_at);
+CREATE INDEX IF NOT EXISTS idx_stage_history_to_stage
+    ON opportunity_stage_history (to_stage, changed_at);
+
+-- Lookup stage per opportunity_id (dipakai validasi transisi)
+CREATE INDEX IF NOT EXISTS idx_opportunities_opportunity_id
+    ON opportunities (opportunity_id);
@@ -0,0 +1,94 @@
+-- =============================================================================
+-- 005: METRIK FUNNEL (TIME-IN-STAGE, KONVERSI, WIN RATE)
+-- Agregat di-maintain incremental dari opportunity_stage_history (migrations/004).
+-- Dibaca oleh backend.get_pipeline_velocity()
+-- =============================================================================
+
+-- Satu baris per (pillar, sales group, from_stage -> to_stage).
+-- from_stage = '' untuk stage awal saat opportunity dibuat.
+-- total_seconds = total lama opportunity berada di from_stage sebelum pindah.
+-- pillar / salesgroup_id = '*' adalah baris rollup "semua": setiap opportunity dihitung SEKALI,
+-- berapa pun jumlah pillar-nya (baris per pillar menghitung opportunity multi-pillar per pillar).
+-- Pillar & sales group diambil dari line opportunity SAAT transisi terjadi; pillar yang
+-- ditambahkan belakangan tidak ikut menghitung transisi lama (kecuali lewat rebuild).
+CREATE TABLE IF NOT EXISTS stage_flow_stats (
+    pillar        text   NOT NULL,
+    salesgroup_id text   NOT NULL,
+    from_stage    text   NOT NULL,
+    to_stage      text   NOT NULL,
+    transitions   bigint NOT NULL DEFAULT 0,
+    total_seconds double precision NOT NULL DEFAULT 0,
+    PRIMARY KEY (pillar, salesgroup_id, from_stage, to_stage)
+);
+
+-- Hitung kontribusi sekumpulan baris history. Dipakai trigger & rebuild.
+-- Baris per pillar: opportunity dengan beberapa pillar dihitung sekali per pillar.
+-- Baris rollup '*': satu transisi dihitung sekali per grain (UNION membuang duplikat).
+CREATE OR REPLACE FUNCTION stage_flow_stats_delta(p_history_ids bigint[])
+RETURNS TABLE (pillar text, salesgroup_id text, from_stage text, to_stage text,
+               transitions bigint, total_seconds double precision)
+LANGUAGE sql STABLE AS $$
+    WITH t AS (
+        SELECT h.id, h.opportunity_id, COALESCE(h.from_stage, '') AS from_stage, h.to_stage,
+               CASE WHEN h.from_stage IS NULL THEN 0
+                    ELSE greatest(extract(epoch FROM h.changed_at - COALESCE(prev.entered_at, first_line.created_at, h.changed_at)), 0)
+               END AS seconds
+        FROM opportunity_stage_history h
+        LEFT JOIN LATERAL (
+            SELECT p.changed_at AS entered_at FROM opportunity_stage_history p
+            WHERE p.opportunity_id = h.opportunity_id AND p.id < h.id
+            ORDER BY p.id DESC
+            LIMIT 1
+        ) prev ON true
+        LEFT JOIN LATERAL (
+            SELECT min(o.created_at)::timestamptz AS created_at FROM opportunities o
+            WHERE o.opportunity_id = h.opportunity_id
+        ) first_line ON true
+        WHERE h.id = ANY(p_history_ids)
+    ),
+    d AS (
+        SELECT DISTINCT t.id, COALESCE(o.pillar, 'Unknown') AS pillar,
+                        COALESCE(o.salesgroup_id, 'Unknown') AS salesgroup_id
+        FROM t
+        JOIN opportunities o ON o.opportunity_id = t.opportunity_id
+    ),
+    grains AS (
+        SELECT id, pillar, salesgroup_id FROM d
+        UNION SELECT id, pillar, '*' FROM d
+        UNION SELECT id, '*', salesgroup_id FROM d
+        UNION SELECT id, '*', '*' FROM d
+    )
+    SELECT g.pillar, g.salesgroup_id, t.from_stage, t.to_stage, count(*), sum(t.seconds)
+    FROM grains g
+    JOIN t ON t.id = g.id
+    GROUP BY 1, 2, 3, 4
+$$;
+
+CREATE OR REPLACE FUNCTION stage_flow_stats_apply() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO stage_flow_stats AS s (pillar, salesgroup_id, from_stage, to_stage, transitions, total_seconds)
+    SELECT * FROM stage_flow_stats_delta(ARRAY(SELECT id FROM new_rows))
+    ON CONFLICT (pillar, salesgroup_id, from_stage, to_stage) DO UPDATE
+        SET transitions   = s.transitions + EXCLUDED.transitions,
+            total_seconds = s.total_seconds + EXCLUDED.total_seconds;
+    RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS trg_stage_flow_stats ON opportunity_stage_history;
+CREATE TRIGGER trg_stage_flow_stats AFTER INSERT ON opportunity_stage_history
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION stage_flow_stats_apply();
+
+-- Rebuild penuh (backfill / koreksi manual): SELECT stage_flow_stats_rebuild();
+CREATE OR REPLACE FUNCTION stage_flow_stats_rebuild() RETURNS void
+LANGUAGE plpgsql AS $$
+BEGIN
+    TRUNCATE stage_flow_stats;
+    INSERT INTO stage_flow_stats (pillar, salesgroup_id, from_stage, to_stage, transitions, total_seconds)
+    SELECT * FROM stage_flow_stats_delta(ARRAY(SELECT id FROM opportunity_stage_history));
+END
+$$;
+
+SELECT stage_flow_stats_rebuild();
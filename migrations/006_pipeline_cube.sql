@@ -0,0 +1,158 @@
+-- =============================================================================
+-- 006: PIPELINE CUBE (PILLAR x STAGE x SALES GROUP x START MONTH)
+-- Di-maintain incremental oleh trigger di tabel opportunities, sehingga semua
+-- write path backend.py (add, update, stage, full edit) otomatis ter-cover.
+-- Dibaca oleh backend.get_pipeline_cube()
+-- =============================================================================
+
+CREATE TABLE IF NOT EXISTS pipeline_cube (
+    pillar        text    NOT NULL,
+    stage         text    NOT NULL,
+    salesgroup_id text    NOT NULL,
+    start_month   date    NOT NULL,
+    total_cost    numeric NOT NULL DEFAULT 0,
+    line_count    bigint  NOT NULL DEFAULT 0,
+    opp_count     bigint  NOT NULL DEFAULT 0,
+    PRIMARY KEY (pillar, stage, salesgroup_id, start_month)
+);
+
+-- Jumlah line per opportunity di setiap sel cube. Dipakai untuk menjaga
+-- opp_count (distinct opportunity) tetap benar saat update incremental.
+CREATE TABLE IF NOT EXISTS pipeline_cube_members (
+    pillar         text   NOT NULL,
+    stage          text   NOT NULL,
+    salesgroup_id  text   NOT NULL,
+    start_month    date   NOT NULL,
+    opportunity_id text   NOT NULL,
+    line_count     bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (pillar, stage, salesgroup_id, start_month, opportunity_id)
+);
+
+-- Pembersihan sel kosong tetap murah (index hanya berisi baris <= 0)
+CREATE INDEX IF NOT EXISTS idx_pipeline_cube_members_empty
+    ON pipeline_cube_members (opportunity_id) WHERE line_count <= 0;
+CREATE INDEX IF NOT EXISTS idx_pipeline_cube_empty
+    ON pipeline_cube (pillar) WHERE line_count <= 0;
+
+-- Dimensi bulan: start_date, fallback created_at (sama seperti dashboard)
+CREATE OR REPLACE FUNCTION pipeline_cube_month(p_start_date date, p_created_at timestamp)
+RETURNS date LANGUAGE sql IMMUTABLE AS $$
+    SELECT COALESCE(date_trunc('month', COALESCE(p_start_date, p_created_at::date))::date, DATE '1970-01-01')
+$$;
+
+-- Terapkan delta [{pillar, stage, salesgroup_id, start_month, opportunity_id, cost, lines}, ...]
+CREATE OR REPLACE FUNCTION pipeline_cube_apply(p_delta jsonb) RETURNS void
+LANGUAGE plpgsql AS $$
+BEGIN
+    WITH d AS (
+        SELECT x.pillar, x.stage, x.salesgroup_id, x.start_month, x.opportunity_id,
+               SUM(x.cost) AS cost, SUM(x.lines) AS lines
+        FROM jsonb_to_recordset(p_delta) AS x(
+            pillar text, stage text, salesgroup_id text, start_month date,
+            opportunity_id text, cost numeric, lines bigint
+        )
+        GROUP BY 1, 2, 3, 4, 5
+        HAVING SUM(x.lines) <> 0 OR SUM(x.cost) <> 0
+    ),
+    m AS (
+        INSERT INTO pipeline_cube_members AS m (pillar, stage, salesgroup_id, start_month, opportunity_id, line_count)
+        SELECT pillar, stage, salesgroup_id, start_month, opportunity_id, lines FROM d
+        ON CONFLICT (pillar, stage, salesgroup_id, start_month, opportunity_id) DO UPDATE
+            SET line_count = m.line_count + EXCLUDED.line_count
+        RETURNING m.pillar, m.stage, m.salesgroup_id, m.start_month, m.opportunity_id, m.line_count
+    )
+    INSERT INTO pipeline_cube AS c (pillar, stage, salesgroup_id, start_month, total_cost, line_count, opp_count)
+    SELECT d.pillar, d.stage, d.salesgroup_id, d.start_month,
+           SUM(d.cost), SUM(d.lines),
+           -- +1 jika opportunity baru masuk sel ini, -1 jika keluar seluruhnya
+           SUM((m.line_count > 0)::int - ((m.line_count - d.lines) > 0)::int)
+    FROM d
+    JOIN m USING (pillar, stage, salesgroup_id, start_month, opportunity_id)
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (pillar, stage, salesgroup_id, start_month) DO UPDATE
+        SET total_cost = c.total_cost + EXCLUDED.total_cost,
+            line_count = c.line_count + EXCLUDED.line_count,
+            opp_count  = c.opp_count + EXCLUDED.opp_count;
+
+    DELETE FROM pipeline_cube_members WHERE line_count <= 0;
+    DELETE FROM pipeline_cube WHERE line_count <= 0;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION pipeline_cube_sync() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    delta jsonb := '[]'::jsonb;
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        delta := delta || COALESCE((
+            SELECT jsonb_agg(g) FROM (
+                SELECT COALESCE(pillar, 'Unknown') AS pillar,
+                       COALESCE(stage, 'Unknown') AS stage,
+                       COALESCE(salesgroup_id, 'Unknown') AS salesgroup_id,
+                       pipeline_cube_month(start_date::date, created_at::timestamp) AS start_month,
+                       COALESCE(opportunity_id, 'Unknown') AS opportunity_id,
+                       SUM(COALESCE(cost, 0)) AS cost,
+                       COUNT(*) AS lines
+                FROM new_rows
+                GROUP BY 1, 2, 3, 4, 5
+            ) g
+        ), '[]'::jsonb);
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        delta := delta || COALESCE((
+            SELECT jsonb_agg(g) FROM (
+                SELECT COALESCE(pillar, 'Unknown') AS pillar,
+                       COALESCE(stage, 'Unknown') AS stage,
+                       COALESCE(salesgroup_id, 'Unknown') AS salesgroup_id,
+                       pipeline_cube_month(start_date::date, created_at::timestamp) AS start_month,
+                       COALESCE(opportunity_id, 'Unknown') AS opportunity_id,
+                       -SUM(COALESCE(cost, 0)) AS cost,
+                       -COUNT(*) AS lines
+                FROM old_rows
+                GROUP BY 1, 2, 3, 4, 5
+            ) g
+        ), '[]'::jsonb);
+    END IF;
+
+    PERFORM pipeline_cube_apply(delta);
+    RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS trg_pipeline_cube_ins ON opportunities;
+CREATE TRIGGER trg_pipeline_cube_ins AFTER INSERT ON opportunities
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION pipeline_cube_sync();
+DROP TRIGGER IF EXISTS trg_pipeline_cube_upd ON opportunities;
+CREATE TRIGGER trg_pipeline_cube_upd AFTER UPDATE ON opportunities
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION pipeline_cube_sync();
+DROP TRIGGER IF EXISTS trg_pipeline_cube_del ON opportunities;
+CREATE TRIGGER trg_pipeline_cube_del AFTER DELETE ON opportunities
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION pipeline_cube_sync();
+
+-- Rebuild penuh (backfill / koreksi manual): SELECT pipeline_cube_rebuild();
+CREATE OR REPLACE FUNCTION pipeline_cube_rebuild() RETURNS void
+LANGUAGE plpgsql AS $$
+BEGIN
+    TRUNCATE pipeline_cube, pipeline_cube_members;
+
+    INSERT INTO pipeline_cube_members (pillar, stage, salesgroup_id, start_month, opportunity_id, line_count)
+    SELECT COALESCE(pillar, 'Unknown'), COALESCE(stage, 'Unknown'), COALESCE(salesgroup_id, 'Unknown'),
+           pipeline_cube_month(start_date::date, created_at::timestamp), COALESCE(opportunity_id, 'Unknown'), COUNT(*)
+    FROM opportunities
+    GROUP BY 1, 2, 3, 4, 5;
+
+    INSERT INTO pipeline_cube (pillar, stage, salesgroup_id, start_month, total_cost, line_count, opp_count)
+    SELECT COALESCE(pillar, 'Unknown'), COALESCE(stage, 'Unknown'), COALESCE(salesgroup_id, 'Unknown'),
+           pipeline_cube_month(start_date::date, created_at::timestamp),
+           SUM(COALESCE(cost, 0)), COUNT(*), COUNT(DISTINCT opportunity_id)
+    FROM opportunities
+    GROUP BY 1, 2, 3, 4;
+END
+$$;
+
+SELECT pipeline_cube_rebuild();
@@ -0,0 +1,153 @@
+-- =============================================================================
+-- 007: DAILY PIPELINE SNAPSHOTS (POINT-IN-TIME & TREND)
+-- opportunities hanya menyimpan state terkini. Job harian (snapshot_job.py)
+-- memanggil pipeline_snapshot_take() yang hanya menyimpan baris yang berubah
+-- sejak snapshot terakhir, dipartisi per bulan.
+-- Dibaca oleh backend.get_pipeline_as_of() dan backend.get_pipeline_trend()
+-- =============================================================================
+
+-- Versi per-line: satu baris per uid per tanggal HANYA jika berubah (atau dihapus)
+CREATE TABLE IF NOT EXISTS pipeline_snapshots (
+    snapshot_date  date    NOT NULL,
+    uid            text    NOT NULL,
+    opportunity_id text,
+    pillar         text,
+    stage          text,
+    salesgroup_id  text,
+    cost           numeric,
+    is_deleted     boolean NOT NULL DEFAULT false,
+    PRIMARY KEY (uid, snapshot_date)
+) PARTITION BY RANGE (snapshot_date);
+
+-- State terakhir yang sudah di-snapshot, supaya diff harian tidak perlu scan histori
+CREATE TABLE IF NOT EXISTS pipeline_snapshot_latest (
+    uid            text PRIMARY KEY,
+    snapshot_date  date    NOT NULL,
+    opportunity_id text,
+    pillar         text,
+    stage          text,
+    salesgroup_id  text,
+    cost           numeric,
+    is_deleted     boolean NOT NULL DEFAULT false
+);
+
+-- Ringkasan harian untuk chart trend (kecil, satu baris per kombinasi dimensi)
+CREATE TABLE IF NOT EXISTS pipeline_snapshot_daily (
+    snapshot_date date    NOT NULL,
+    pillar        text    NOT NULL,
+    stage         text    NOT NULL,
+    salesgroup_id text    NOT NULL,
+    total_cost    numeric NOT NULL DEFAULT 0,
+    line_count    bigint  NOT NULL DEFAULT 0,
+    opp_count     bigint  NOT NULL DEFAULT 0,
+    PRIMARY KEY (snapshot_date, pillar, stage, salesgroup_id)
+);
+
+-- Partisi bulanan dibuat on-demand: pipeline_snapshots_y2025m03, dst.
+CREATE OR REPLACE FUNCTION pipeline_snapshot_ensure_partition(p_date date) RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    m_start date := date_trunc('month', p_date)::date;
+    part    text := format('pipeline_snapshots_y%sm%s', to_char(m_start, 'YYYY'), to_char(m_start, 'MM'));
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF pipeline_snapshots FOR VALUES FROM (%L) TO (%L)',
+        part, m_start, (m_start + interval '1 month')::date
+    );
+END
+$$;
+
+-- Ambil snapshot untuk p_date. Aman dijalankan ulang di hari yang sama.
+-- Snapshot selalu berisi state opportunities SAAT INI, jadi tidak bisa backfill: tanggal
+-- sebelum snapshot terakhir (atau di masa depan) ditolak, supaya history tidak terisi data palsu.
+-- Return: jumlah baris (berubah + dihapus) yang ditulis.
+CREATE OR REPLACE FUNCTION pipeline_snapshot_take(p_date date DEFAULT CURRENT_DATE) RETURNS integer
+LANGUAGE plpgsql AS $$
+DECLARE
+    written integer;
+    last_date date;
+BEGIN
+    SELECT max(snapshot_date) INTO last_date FROM pipeline_snapshots;
+    IF p_date < last_date THEN
+        RAISE EXCEPTION 'Cannot snapshot %: latest snapshot is % and snapshots can only record the current state (no backfill)',
+            p_date, last_date;
+    END IF;
+    IF p_date > CURRENT_DATE THEN
+        RAISE EXCEPTION 'Cannot snapshot %: date is in the future', p_date;
+    END IF;
+
+    PERFORM pipeline_snapshot_ensure_partition(p_date);
+
+    WITH cur AS (
+        SELECT uid, opportunity_id, pillar, stage, salesgroup_id, cost, false AS is_deleted
+        FROM opportunities
+        WHERE uid IS NOT NULL
+    ),
+    changed AS (
+        -- Baris baru / berubah
+        SELECT c.* FROM cur c
+        LEFT JOIN pipeline_snapshot_latest l ON l.uid = c.uid
+        WHERE l.uid IS NULL OR l.is_deleted
+           OR (l.opportunity_id, l.pillar, l.stage, l.salesgroup_id, l.cost)
+              IS DISTINCT FROM (c.opportunity_id, c.pillar, c.stage, c.salesgroup_id, c.cost)
+        UNION ALL
+        -- Baris yang sudah tidak ada (tombstone, nilai terakhir dipertahankan)
+        SELECT l.uid, l.opportunity_id, l.pillar, l.stage, l.salesgroup_id, l.cost, true
+        FROM pipeline_snapshot_latest l
+        WHERE NOT l.is_deleted AND NOT EXISTS (SELECT 1 FROM cur c WHERE c.uid = l.uid)
+    ),
+    snap AS (
+        INSERT INTO pipeline_snapshots AS s
+            (snapshot_date, uid, opportunity_id, pillar, stage, salesgroup_id, cost, is_deleted)
+        SELECT p_date, uid, opportunity_id, pillar, stage, salesgroup_id, cost, is_deleted FROM changed
+        ON CONFLICT (uid, snapshot_date) DO UPDATE
+            SET opportunity_id = EXCLUDED.opportunity_id, pillar = EXCLUDED.pillar,
+                stage = EXCLUDED.stage, salesgroup_id = EXCLUDED.salesgroup_id,
+                cost = EXCLUDED.cost, is_deleted = EXCLUDED.is_deleted
+        RETURNING 1
+    ),
+    latest AS (
+        INSERT INTO pipeline_snapshot_latest AS l
+            (uid, snapshot_date, opportunity_id, pillar, stage, salesgroup_id, cost, is_deleted)
+        SELECT uid, p_date, opportunity_id, pillar, stage, salesgroup_id, cost, is_deleted FROM changed
+        ON CONFLICT (uid) DO UPDATE
+            SET snapshot_date = EXCLUDED.snapshot_date, opportunity_id = EXCLUDED.opportunity_id,
+                pillar = EXCLUDED.pillar, stage = EXCLUDED.stage,
+                salesgroup_id = EXCLUDED.salesgroup_id, cost = EXCLUDED.cost,
+                is_deleted = EXCLUDED.is_deleted
+        RETURNING 1
+    )
+    SELECT COUNT(*) INTO written FROM snap;
+
+    -- Ringkasan harian dihitung ulang dari state terkini
+    DELETE FROM pipeline_snapshot_daily WHERE snapshot_date = p_date;
+    INSERT INTO pipeline_snapshot_daily (snapshot_date, pillar, stage, salesgroup_id, total_cost, line_count, opp_count)
+    SELECT p_date, COALESCE(pillar, 'Unknown'), COALESCE(stage, 'Unknown'), COALESCE(salesgroup_id, 'Unknown'),
+           SUM(COALESCE(cost, 0)), COUNT(*), COUNT(DISTINCT opportunity_id)
+    FROM pipeline_snapshot_latest
+    WHERE NOT is_deleted
+    GROUP BY 1, 2, 3, 4;
+
+    RETURN written;
+END
+$$;
+
+-- State per-line pada tanggal tertentu: versi terakhir <= p_date yang belum dihapus
+CREATE OR REPLACE FUNCTION pipeline_snapshot_as_of(p_date date)
+RETURNS TABLE (uid text, opportunity_id text, pillar text, stage text, salesgroup_id text,
+               cost numeric, snapshot_date date)
+LANGUAGE sql STABLE AS $$
+    SELECT v.uid, v.opportunity_id, v.pillar, v.stage, v.salesgroup_id, v.cost, v.snapshot_date
+    FROM (
+        SELECT DISTINCT ON (s.uid) s.*
+        FROM pipeline_snapshots s
+        WHERE s.snapshot_date <= p_date
+        ORDER BY s.uid, s.snapshot_date DESC
+    ) v
+    WHERE NOT v.is_deleted
+$$;
+
+-- Snapshot awal (hari ini). Jadwal harian: python snapshot_job.py (cron),
+-- atau jika pg_cron tersedia:
+--   SELECT cron.schedule('pipeline-snapshot', '5 0 * * *', 'SELECT pipeline_snapshot_take()');
+SELECT pipeline_snapshot_take();
@@ -0,0 +1,12 @@
+-- =============================================================================
+-- 008: INDEX UNTUK GRID DETAILED DATA (PAGINATION SERVER-SIDE)
+-- Dipakai oleh backend.get_opportunities_page() (ORDER BY ... LIMIT/OFFSET)
+-- =============================================================================
+
+-- Urutan default grid: created_at terbaru dulu, uid sebagai tie-breaker
+CREATE INDEX IF NOT EXISTS idx_opportunities_created_at_uid
+    ON opportunities (created_at DESC NULLS LAST, uid DESC);
+
+-- Sort & filter rentang Start Date
+CREATE INDEX IF NOT EXISTS idx_opportunities_start_date
+    ON opportunities (start_date);
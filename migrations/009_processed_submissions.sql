@@ -0,0 +1,19 @@
+-- =============================================================================
+-- 009: SUBMISSION YANG SUDAH DIPROSES (IDEMPOTENT REPLAY)
+-- Dipakai oleh add_multi_line_opportunity() & add_cps_opportunity() jika dipanggil
+-- dengan submission_id (form tab1, antrian write lokal write_queue.py, API).
+-- Baris di-insert dalam transaksi yang sama dengan data opportunity-nya, jadi submit
+-- ulang dengan submission_id yang sama tidak membuat opportunity dobel.
+-- =============================================================================
+
+CREATE TABLE IF NOT EXISTS processed_submissions (
+    submission_id text PRIMARY KEY,
+    kind          text        NOT NULL,
+    result        text,                    -- JSON response yang dikembalikan ke pemanggil pertama
+    processed_at  timestamptz NOT NULL DEFAULT now()
+);
+
+-- Pembersihan berkala (opsional), antrian lokal tidak pernah menyimpan submission selama ini:
+-- DELETE FROM processed_submissions WHERE processed_at < now() - interval '90 days';
+CREATE INDEX IF NOT EXISTS idx_processed_submissions_processed_at
+    ON processed_submissions (processed_at);
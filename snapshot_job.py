@@ -0,0 +1,30 @@
+"""
+Job harian snapshot pipeline (lihat migrations/007_pipeline_snapshots.sql).
+
+Jalankan dari root project (butuh .streamlit/secrets.toml yang sama dengan app):
+    python snapshot_job.py               # snapshot hari ini (aman dijalankan ulang di hari yang sama)
+
+"Hari ini" = CURRENT_DATE di database (timezone server DB), bukan tanggal lokal host app: dengan
+host UTC+7 dan DB UTC, date.today() di host bisa sudah besok menurut DB dan ditolak sebagai
+tanggal masa depan.
+
+Snapshot merekam state opportunities saat job berjalan, jadi tanggal yang terlewat tidak bisa
+di-backfill; get_pipeline_as_of() untuk tanggal tsb memakai snapshot terakhir sebelumnya.
+
+Contoh cron (00:05 setiap hari):
+    5 0 * * * cd /path/to/app && python snapshot_job.py >> snapshot_job.log 2>&1
+"""
+import sys
+from datetime import datetime
+
+import backend as db
+
+
+def main():
+    res = db.take_pipeline_snapshot()  # None -> CURRENT_DATE database
+    print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] {res['message']}")
+    return 0 if res['status'] == 200 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""
+Fixture bersama: backend.py berjalan di atas stand-in SQLite (backend_sqlite.py) di folder
+sementara, jadi test tidak butuh server Postgres. Jalankan dari root project:
+    python -m pytest -q
+"""
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def db_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp("storage") / "presales.db"
+    # Harus di-set sebelum backend di-import: storage dipilih saat import (SECTION 5 backend.py)
+    os.environ["PRESALES_STORAGE"] = f"sqlite:///{path}"
+    os.environ["PRESALES_WRITE_QUEUE"] = str(path.with_name("write_queue.db"))
+    return path
+
+
+@pytest.fixture(scope="session")
+def db(db_path):
+    import backend
+    import backend_sqlite
+
+    assert backend.storage_backend() == "sqlite"
+    backend_sqlite.seed_master_data()
+    return backend
+
+
+@pytest.fixture(autouse=True)
+def closed_circuit(db):
+    """Setiap test mulai dengan circuit breaker tertutup."""
+    db._breaker.record_success()
+    yield
+    db._breaker.record_success()
+
+
+@pytest.fixture
+def sql(db_path):
+    """Query langsung ke file database (di luar backend), return list of dict."""
+    def run(query, params=()):
+        with sqlite3.connect(db_path) as con:
+            con.row_factory = sqlite3.Row
+            return [dict(r) for r in con.execute(query, params).fetchall()]
+    return run
+
+
+@pytest.fixture
+def opportunity():
+    """Payload form tab1 dengan master data contoh; nama opportunity dibuat unik per test."""
+    def make(name=None, lines=1, **parent):
+        parent_data = {
+            "presales_name": "Andi", "responsible_name": "Dewi", "salesgroup_id": "ENT1",
+            "sales_name": "Fajar", "opportunity_name": name or f"Test Opportunity {os.urandom(4).hex()}",
+            "start_date": "2026-01-15", "company_name": "PT Bank Contoh", "vertical_industry": "Banking",
+            "stage": "Open", "stage_notes": "", **parent
+        }
+        product_lines = [
+            {
+                "pillar": "Network", "solution": "Campus LAN", "service": "Implementation",
+                "brand": "Cisco", "channel": "Distributor", "distributor_name": "Metrodata",
+                "cost": 1_000_000 * (i + 1), "notes": f"line {i}"
+            }
+            for i in range(lines)
+        ]
+        return parent_data, product_lines
+    return make
@@ -0,0 +1,284 @@
+"""
+Kontrak write path backend.py di atas stand-in SQLite: ID, return value, audit log, riwayat
+stage & submission_id. Jika salah satu backend berubah, test ini yang menangkap bedanya.
+"""
+import os
+import re
+import subprocess
+import sys
+from datetime import date, datetime, timedelta
+
+
+# ==============================================================================
+# 1. ADD OPPORTUNITY
+# ==============================================================================
+def test_add_opportunity_returns_uids_in_form_order(db, sql, opportunity):
+    parent, lines = opportunity(lines=3)
+    res = db.add_multi_line_opportunity(parent, lines)
+
+    assert res["status"] == 200
+    assert len(res["data"]) == 3
+    opp_id = res["data"][0]["opportunity_id"]
+    assert re.fullmatch(r"ENT1Q3\d{4,}", opp_id)
+    assert {r["opportunity_id"] for r in res["data"]} == {opp_id}
+    for i, row in enumerate(res["data"]):
+        assert row["uid"].startswith(f"{opp_id}-NW1S1CSC-")
+        assert row["uid"].endswith(str(i))
+
+    stored = sql("SELECT uid, cost, notes FROM opportunities WHERE opportunity_id = ? ORDER BY cost", (opp_id,))
+    assert [r["uid"] for r in stored] == [r["uid"] for r in res["data"]]
+    assert [r["notes"] for r in stored] == ["line 0", "line 1", "line 2"]
+
+def test_add_opportunity_writes_header_history_and_audit(db, sql, opportunity):
+    parent, lines = opportunity(lines=2)
+    opp_id = db.add_multi_line_opportunity(parent, lines)["data"][0]["opportunity_id"]
+
+    header = sql("SELECT * FROM sales_opportunities WHERE opportunity_id = ?", (opp_id,))
+    assert len(header) == 1
+    assert header[0]["opportunity_name"] == parent["opportunity_name"]
+    assert header[0]["stage"] == "Open"
+
+    history = sql("SELECT from_stage, to_stage, actor FROM opportunity_stage_history WHERE opportunity_id = ?", (opp_id,))
+    assert history == [{"from_stage": None, "to_stage": "Open", "actor": "Andi"}]
+
+    logs = sql("""
+        SELECT source_table, user_name, new_value FROM activity_logs
+        WHERE record_key = ? AND action = 'CREATE' ORDER BY source_table
+    """, (opp_id,))
+    assert logs == [
+        {"source_table": "opportunities", "user_name": "Andi", "new_value": f"Created 2 lines. ID: {opp_id}"},
+        {"source_table": "sales_opportunities", "user_name": "Andi", "new_value": f"Created 1 lines. ID: {opp_id}"},
+    ]
+
+def test_same_opportunity_name_reuses_rows_id(db, opportunity):
+    parent, lines = opportunity()
+    first = db.add_multi_line_opportunity(parent, lines)["data"][0]["opportunity_id"]
+    again = db.add_multi_line_opportunity(parent, lines)["data"][0]["opportunity_id"]
+    other_group = db.add_multi_line_opportunity({**parent, "salesgroup_id": "GOV3"}, lines)["data"][0]["opportunity_id"]
+    new_name = db.add_multi_line_opportunity(*opportunity())["data"][0]["opportunity_id"]
+
+    assert again == first
+    assert other_group == "GOV3" + first[len("ENT1"):]
+    assert int(new_name[len("ENT1Q3"):]) > int(first[len("ENT1Q3"):])
+
+def test_same_lines_submitted_twice_in_one_second_get_distinct_uids(db, sql, opportunity):
+    parent, lines = opportunity()
+    a = db.add_multi_line_opportunity(parent, lines, submission_id="uid-a")
+    b = db.add_multi_line_opportunity(parent, lines, submission_id="uid-b")
+
+    assert a["status"] == b["status"] == 200
+    assert a["data"][0]["uid"] != b["data"][0]["uid"]
+    assert len(sql("SELECT uid FROM opportunities WHERE opportunity_id = ?", (a["data"][0]["opportunity_id"],))) == 2
+
+
+# ==============================================================================
+# 2. SUBMISSION DEDUP
+# ==============================================================================
+def test_resubmitting_same_submission_id_does_not_duplicate(db, sql, opportunity):
+    parent, lines = opportunity(lines=2)
+    first = db.add_multi_line_opportunity(parent, lines, submission_id="dedup-opp")
+    second = db.add_multi_line_opportunity(parent, lines, submission_id="dedup-opp")
+
+    assert first["status"] == 200
+    assert second["status"] == 200
+    assert second["duplicate"] is True
+    assert second["data"] == first["data"]
+    opp_id = first["data"][0]["opportunity_id"]
+    assert len(sql("SELECT uid FROM opportunities WHERE opportunity_id = ?", (opp_id,))) == 2
+    assert len(sql("SELECT 1 FROM processed_submissions WHERE submission_id = 'dedup-opp'")) == 1
+
+def test_failed_submission_does_not_claim_submission_id(db, sql, opportunity):
+    parent, lines = opportunity()
+    del parent["sales_name"]
+    assert db.add_multi_line_opportunity(parent, lines, submission_id="dedup-failed")["status"] == 500
+    assert sql("SELECT 1 FROM processed_submissions WHERE submission_id = 'dedup-failed'") == []
+
+def test_cps_submission_dedup(db, sql, opportunity):
+    parent, _ = opportunity()
+    cps_lines = [{
+        "managed_service": "Easy Access", "service_offering": "Full Stack", "package": "Growth",
+        "sla_level": "Pro", "service_execution": "Internal", "cost": 5_000_000, "notes": "cps"
+    }] * 2
+    first = db.add_cps_opportunity(parent, cps_lines, submission_id="dedup-cps")
+    second = db.add_cps_opportunity(parent, cps_lines, submission_id="dedup-cps")
+
+    assert first["status"] == 200
+    cps_id = re.search(r"CPS-ENT1\d+", first["message"]).group(0)
+    assert second == {**first, "duplicate": True}
+    rows = sql("SELECT uid, cps_product_id FROM cps_opportunities WHERE cps_id = ?", (cps_id,))
+    assert len(rows) == 2
+    assert {r["cps_product_id"] for r in rows} == {"MS1-S2-P2-SLA2-SE1"}
+
+
+# ==============================================================================
+# 3. UPDATE & AUDIT
+# ==============================================================================
+def test_update_lead_writes_one_audit_row_per_changed_field(db, sql, opportunity):
+    uid = db.add_multi_line_opportunity(*opportunity())["data"][0]["uid"]
+    assert db.get_single_lead({"uid": uid})["data"][0]["cost"] == 1_000_000
+
+    res = db.update_lead({"uid": uid, "cost": 2_500_000, "notes": "revised", "user": "Budi"})
+
+    assert res == {"status": 200, "message": "Updated successfully"}
+    logs = sql("""
+        SELECT user_name, action, field, old_value, new_value, source_table FROM activity_logs
+        WHERE record_key = ? AND action = 'UPDATE' ORDER BY field
+    """, (uid,))
+    assert [(r["field"], r["user_name"], r["source_table"]) for r in logs] == [
+        ("Cost", "Budi", "opportunities"), ("Notes", "Budi", "opportunities")
+    ]
+    assert float(logs[0]["old_value"]) == 1_000_000 and float(logs[0]["new_value"]) == 2_500_000
+    assert (logs[1]["old_value"], logs[1]["new_value"]) == ("line 0", "revised")
+    # Write-through: pembaca berikutnya langsung melihat nilai baru
+    assert db.get_single_lead({"uid": uid})["data"][0]["cost"] == 2_500_000
+
+def test_update_lead_unknown_uid(db):
+    assert db.update_lead({"uid": "does-not-exist", "cost": 1, "notes": "", "user": "Budi"})["status"] == 404
+
+def test_update_leads_batch_skips_unchanged_values(db, sql, opportunity):
+    uids = [r["uid"] for r in db.add_multi_line_opportunity(*opportunity(lines=2))["data"]]
+    res = db.update_leads_batch([
+        {"uid": uids[0], "cost": 7_000_000, "notes": "line 0"},
+        {"uid": uids[1], "cost": 2_000_000, "notes": "line 1"},
+    ], "Citra")
+
+    assert res["status"] == 200
+    logs = sql("SELECT record_key, field FROM activity_logs WHERE action = 'UPDATE' AND record_key IN (?, ?)", tuple(uids))
+    assert logs == [{"record_key": uids[0], "field": "Cost"}]
+
+
+# ==============================================================================
+# 4. STAGE BATCH
+# ==============================================================================
+def test_stage_batch_updates_lines_header_and_history(db, sql, opportunity):
+    moved = db.add_multi_line_opportunity(*opportunity(lines=2))["data"][0]["opportunity_id"]
+    same = db.add_multi_line_opportunity(*opportunity())["data"][0]["opportunity_id"]
+    db.update_opportunity_stage_batch([same], "Proposal", "", datetime.now(), "Andi")
+
+    res = db.update_opportunity_stage_batch([moved, same, "ENT1Q3999999"], "Proposal", "sent BoQ", datetime.now(), "Budi")
+
+    assert res["status"] == 200
+    assert res["message"] == "Stage updated for 2 of 3 opportunities."
+    assert res["data"] == [
+        {"opportunity_id": moved, "from_stage": "Open", "lines_updated": 2, "header_updated": True, "status": "Updated"},
+        {"opportunity_id": same, "from_stage": "Proposal", "lines_updated": 1, "header_updated": True, "status": "Updated"},
+        {"opportunity_id": "ENT1Q3999999", "from_stage": None, "lines_updated": 0, "header_updated": False, "status": "Not Found"},
+    ]
+    assert {r["stage"] for r in sql("SELECT stage FROM opportunities WHERE opportunity_id = ?", (moved,))} == {"Proposal"}
+    assert sql("SELECT stage FROM sales_opportunities WHERE opportunity_id = ?", (moved,)) == [{"stage": "Proposal"}]
+    history = sql("SELECT from_stage, to_stage, actor FROM opportunity_stage_history WHERE opportunity_id = ? ORDER BY id", (moved,))
+    assert history[-1] == {"from_stage": "Open", "to_stage": "Proposal", "actor": "Budi"}
+    # Stage yang tidak berubah tidak menambah riwayat
+    assert len(sql("SELECT 1 FROM opportunity_stage_history WHERE opportunity_id = ?", (same,))) == 2
+
+def test_stage_batch_rejects_disallowed_transition(db, sql, opportunity):
+    opp_id = db.add_multi_line_opportunity(*opportunity())["data"][0]["opportunity_id"]
+    with db.get_conn().session as session:
+        session.execute(db.text(
+            "UPDATE stage_pipeline SET allowed_next_stages = '[\"Proposal\"]' WHERE stage_name = 'Open'"
+        ))
+        session.commit()
+    try:
+        res = db.update_opportunity_stage_batch([opp_id], "Closed Won", "", datetime.now(), "Budi")
+    finally:
+        with db.get_conn().session as session:
+            session.execute(db.text("UPDATE stage_pipeline SET allowed_next_stages = NULL WHERE stage_name = 'Open'"))
+            session.commit()
+
+    assert res["data"][0]["status"] == "Invalid Transition"
+    assert sql("SELECT stage FROM sales_opportunities WHERE opportunity_id = ?", (opp_id,)) == [{"stage": "Open"}]
+
+def test_stage_batch_without_ids(db):
+    assert db.update_opportunity_stage_batch([], "Proposal", "", None, "Budi")["status"] == 400
+
+
+# ==============================================================================
+# 5. SNAPSHOT & ANTRIAN WRITE
+# ==============================================================================
+def test_snapshot_rejects_backfill(db):
+    assert db.take_pipeline_snapshot()["status"] == 200
+    assert db.take_pipeline_snapshot()["status"] == 200  # aman diulang di hari yang sama
+    res = db.take_pipeline_snapshot(date.today() - timedelta(days=1))
+    assert res["status"] == 500
+    assert "no backfill" in res["message"]
+
+def test_queued_submissions_replay_without_collisions(db, sql, opportunity):
+    import write_queue
+
+    parent, lines = opportunity()
+    for _ in range(db.BREAKER_FAILURE_THRESHOLD):
+        db._breaker.record_failure()
+    queued = [write_queue.submit("add_multi_line_opportunity", parent, lines) for _ in range(2)]
+    assert [q["status"] for q in queued] == [202, 202]
+
+    db._breaker.record_success()
+    res = write_queue.replay()
+
+    assert res["data"] == {"saved": 2, "rejected": 0, "pending": 0}
+    assert len(sql("SELECT 1 FROM opportunities WHERE opportunity_name = ?", (parent["opportunity_name"],))) == 2
+
+def test_rejected_queued_submission_keeps_payload(db, opportunity):
+    import write_queue
+
+    parent, lines = opportunity()
+    del parent["sales_name"]
+    for _ in range(db.BREAKER_FAILURE_THRESHOLD):
+        db._breaker.record_failure()
+    submission_id = write_queue.submit("add_multi_line_opportunity", parent, lines)["data"]["submission_id"]
+
+    db._breaker.record_success()
+    assert write_queue.replay()["data"]["rejected"] == 1
+
+    rejected = {r["submission_id"]: r for r in write_queue.get_rejected()}
+    assert rejected[submission_id]["payload"] == {"parent_data": parent, "lines": lines}
+    write_queue.dismiss(submission_id)
+    assert submission_id not in {r["submission_id"] for r in write_queue.get_rejected()}
+
+
+# ==============================================================================
+# 6. CIRCUIT BREAKER
+# ==============================================================================
+def test_cache_hit_is_not_a_db_round_trip(db, opportunity):
+    uid = db.add_multi_line_opportunity(*opportunity())["data"][0]["uid"]
+    db._invalidate_opportunities()
+    assert db.get_single_lead({"uid": uid})["status"] == 200
+    assert db.last_read_from_db() is True
+
+    for _ in range(db.BREAKER_FAILURE_THRESHOLD - 1):
+        db._breaker.record_failure()
+    assert db.get_single_lead({"uid": uid})["status"] == 200  # dari _lead_cache
+    assert db.last_read_from_db() is False
+    assert db._breaker.failures == db.BREAKER_FAILURE_THRESHOLD - 1
+
+    # Half-open: hit cache tidak menutup circuit dan tidak memakai jatah percobaan
+    db._breaker.record_failure()
+    db._breaker.opened_at -= db.BREAKER_RESET_SECONDS
+    assert db.get_single_lead({"uid": uid})["status"] == 200
+    assert db._breaker.state() == "half_open"
+    assert db._breaker.trial_running is False
+
+    db._invalidate_opportunities()
+    assert db.get_single_lead({"uid": uid})["status"] == 200  # query ke DB -> circuit tertutup
+    assert db._breaker.state() == "closed"
+
+
+# ==============================================================================
+# 7. STORAGE ADAPTER
+# ==============================================================================
+def test_sqlite_functions_installed_before_resilience_wrappers(db):
+    import backend_sqlite
+
+    assert db.add_multi_line_opportunity.__wrapped__ is backend_sqlite.add_multi_line_opportunity
+    assert db.get_pipeline_velocity.__wrapped__ is backend_sqlite.get_pipeline_velocity
+    assert db.get_conn is backend_sqlite.get_conn
+
+def test_storage_adapter_does_not_depend_on_import_order(db_path):
+    # Proses baru: di sesi test ini backend sudah ter-import
+    check = (
+        "import backend_sqlite, backend; "
+        "assert backend.add_multi_line_opportunity.__wrapped__ is backend_sqlite.add_multi_line_opportunity; "
+        "assert backend.get_conn is backend_sqlite.get_conn"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run([sys.executable, "-c", check], cwd=root, env=os.environ.copy(), capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
@@ -0,0 +1,39 @@
+"""
+Export streaming (export.py) di atas stand-in SQLite: file sementara & pembersihannya.
+"""
+import os
+import time
+
+
+def test_export_writes_into_export_dir(db, opportunity, tmp_path, monkeypatch):
+    import export
+
+    monkeypatch.setattr(export, "EXPORT_DIR", str(tmp_path / "exports"))
+    opp_id = db.add_multi_line_opportunity(*opportunity(lines=2))["data"][0]["opportunity_id"]
+
+    res = export.export_opportunities({}, fmt="CSV")
+
+    assert res["status"] == 200, res
+    assert os.path.dirname(res["data"]["path"]) == export.EXPORT_DIR
+    with open(res["data"]["path"], encoding="utf-8-sig") as f:
+        assert opp_id in f.read()
+
+def test_old_exports_are_removed_on_next_export(db, opportunity, tmp_path, monkeypatch):
+    import export
+
+    monkeypatch.setattr(export, "EXPORT_DIR", str(tmp_path / "exports"))
+    os.makedirs(export.EXPORT_DIR)
+    abandoned = os.path.join(export.EXPORT_DIR, "opportunities_abandoned.csv")
+    recent = os.path.join(export.EXPORT_DIR, "opportunities_recent.csv")
+    for path in (abandoned, recent):
+        open(path, "w").close()
+    old = time.time() - (export.EXPORT_MAX_AGE_MINUTES + 1) * 60
+    os.utime(abandoned, (old, old))
+    db.add_multi_line_opportunity(*opportunity())
+
+    res = export.export_opportunities({}, fmt="CSV")
+
+    assert res["status"] == 200
+    assert not os.path.exists(abandoned)
+    assert os.path.exists(recent)
+    assert os.path.exists(res["data"]["path"])
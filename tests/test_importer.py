@@ -0,0 +1,40 @@
+"""
+Validasi bulk import (importer.py) terhadap master data contoh di stand-in SQLite.
+"""
+from datetime import date
+
+import pandas as pd
+import pytest
+
+
+def _upload(dates):
+    return pd.DataFrame([{
+        "opportunity_name": f"Import {i}", "presales_name": "Andi", "responsible_name": "Dewi",
+        "salesgroup_id": "ENT1", "sales_name": "Fajar", "company_name": "PT Bank Contoh",
+        "vertical_industry": "Banking", "start_date": d, "pillar": "Network", "solution": "Campus LAN",
+        "service": "Implementation", "brand": "Cisco", "cost": "1000000",
+    } for i, d in enumerate(dates)], dtype=object)
+
+
+@pytest.mark.parametrize("dates", [
+    ["05/03/2025", "25/03/2025", "2025-03-25"],
+    ["25/03/2025", "05/03/2025", "2025-03-25"],
+])
+def test_start_date_does_not_depend_on_row_order(db, dates):
+    import importer
+
+    res = importer.validate_import(_upload(dates))
+
+    assert res["data"]["errors"].empty
+    parsed = dict(zip(res["data"]["valid"]["opportunity_name"], res["data"]["valid"]["start_date"]))
+    expected = {"05/03/2025": date(2025, 3, 5), "25/03/2025": date(2025, 3, 25), "2025-03-25": date(2025, 3, 25)}
+    assert parsed == {f"Import {i}": expected[d] for i, d in enumerate(dates)}
+
+def test_start_date_in_other_format_is_rejected(db):
+    import importer
+
+    res = importer.validate_import(_upload(["2025-03-25", "03-25-2025", "2025-02-30"]))
+
+    errors = res["data"]["errors"]
+    assert list(errors["opportunity_name"]) == ["Import 1", "Import 2"]
+    assert errors["error"].str.contains("start_date is not a valid date").all()
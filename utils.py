@@ -1,16 +1,13 @@
 import streamlit as st
 import pandas as pd
-import time
-
-
-st.set_page_config(
-    page_title="Presales App - SISINDOKOM",
-    page_icon=":clipboard:",
-    initial_sidebar_state="expanded",
-    layout="wide"
-)
+import asyncio
+import os
+from datetime import datetime, timedelta
 
 import backend as db
+import backend_async as adb
+import write_queue
+# export (openpyxl / pyarrow) & importer di-import di fungsi yang memakainya, bukan saat startup
 
 def format_number(number):
     """Mengubah angka menjadi string dengan pemisah titik."""
@@ -20,10 +17,43 @@ def format_number(number):
     except (ValueError, TypeError):
         return "0"
 
+class _MasterDataUnavailable(Exception):
+    """Hasil get_master yang tidak boleh di-cache (DB down / stale / hit cache backend); args[0] = data yang dipakai."""
+
 @st.cache_data(ttl=900)
+def _get_master_cached(action: str):
+    data = db.get_master_presales(action)
+    if not db.last_read_from_db():
+        # st.cache_data tidak menyimpan exception: dropdown terisi lagi begitu DB kembali
+        raise _MasterDataUnavailable(data)
+    return data
+
 def get_master(action: str):
     """Mengambil data master dari Backend Python Langsung."""
-    return db.get_master_presales(action)
+    try:
+        return _get_master_cached(action)
+    except _MasterDataUnavailable as e:
+        return e.args[0]
+
+# Master data yang dibutuhkan form tab1 / tab5 sebelum bisa dipakai
+MASTER_PREFETCH_ACTIONS = [
+    'getPresales', 'getPAMMapping', 'getResponsibles', 'getSalesGroups', 'getSalesNames',
+    'getPresalesStages', 'getOpportunities', 'getCompanies', 'getBrands', 'getPillars', 'getDistributors'
+]
+
+def prefetch_master_data():
+    """
+    Isi cache get_master() untuk semua master sekaligus secara paralel (thread pool
+    backend_async, context sesi ikut dibawa). Waktu tunggu = query master paling lambat,
+    bukan jumlah semuanya. Dipanggil sekali per sesi dari app.py.
+    """
+    async def load_all():
+        return await asyncio.gather(
+            *(adb.run_in_pool(get_master, action) for action in MASTER_PREFETCH_ACTIONS),
+            return_exceptions=True
+        )
+    # Error per master tidak menghentikan app; widget akan memanggil ulang get_master() sendiri
+    adb.run(load_all())
 
 def get_pam_mapping_dict():
     data = get_master('getPAMMapping')
@@ -126,10 +156,149 @@ def clean_data_for_display(data):
 
     return df
 
+CLOSED_WON_REASONS = [
+    "Commercial / Price Strategy",
+    "Technical Solution Fit",
+    "Relationship / Trust",
+    "Delivery / Timeline",
+    "After-Sales Service",
+    "Other Winning Factors"
+]
+
+CLOSED_LOST_REASONS = [
+    "Price / Budget Constraint",
+    "Competitor - Technical",
+    "Competitor - Price",
+    "Feature Gap / Spec Mismatch",
+    "Late Proposal Submission",
+    "Project Cancelled",
+    "Lost to Incumbent",
+    "No Decision"
+]
+
+def parse_id_list(raw_text):
+    """Memecah ID yang di-paste (dipisah koma, spasi, atau baris baru) menjadi list unik."""
+    parts = [p.strip() for p in raw_text.replace(",", " ").replace(";", " ").split()] if raw_text else []
+    return list(dict.fromkeys(p for p in parts if p))
+
+def stage_update_form(key_prefix, current_stage=None):
+    """
+    Form pilihan stage baru + tanggal + closing reason/notes.
+    Dipakai Update Stage (satu opportunity) dan Bulk Stage Update.
+    Return: (new_stage, manual_date, closing_reason, notes)
+    """
+    c_form1, c_form2 = st.columns(2)
+    
+    with c_form1:
+        # 1. Logic Dropdown Stage (Inject Closed Won/Lost)
+        stage_raw = get_master('getPresalesStages')
+        stage_opts = [s['Stage'] for s in stage_raw]
+        
+        # Manual Injection: Paksa munculkan opsi Closed
+        for s in ["Closed Won", "Closed Lost"]:
+            if s not in stage_opts:
+                stage_opts.append(s)
+        stage_opts = sorted(stage_opts)
+
+        # Set Default Index
+        try: curr_idx = stage_opts.index(current_stage)
+        except: curr_idx = 0    
+        
+        new_stage_val = st.selectbox("New Stage", stage_opts, index=curr_idx, key=f"{key_prefix}_new_stage")
+
+    with c_form2:
+        # 2. Tanggal Manual
+        manual_date = st.date_input("Stage Changed Date", value="today", key=f"{key_prefix}_stage_date")
+
+    # --- LOGIC CLOSING CATEGORY (WON vs LOST) ---
+    closing_reason_val = None 
+    
+    # Jika user memilih stage Closed Won atau Closed Lost
+    if new_stage_val in ["Closed Won", "Closed Lost"]:
+        st.markdown("---")
+        
+        if new_stage_val == "Closed Won":
+            st.success(f"🎉 Closing Deal: **{new_stage_val}**")
+            reason_opts = CLOSED_WON_REASONS
+            label_text = "Winning Factor (Why did we win?)"
+        else:
+            st.error(f"💀 Closing Deal: **{new_stage_val}**")
+            reason_opts = CLOSED_LOST_REASONS
+            label_text = "Loss Reason (Why did we lose?)"
+
+        # Dropdown Kategori (Full Width)
+        closing_reason_val = st.selectbox(label_text, reason_opts, key=f"{key_prefix}_close_reason_cat")
+        
+        # Text Area untuk Detail
+        new_stage_notes = st.text_area(
+            "Closing Remarks / Post-Mortem", 
+            placeholder="Ceritakan detail, kendala teknis, atau feedback user (tanpa perlu menyebut detail kompetitor jika tidak tahu)...",
+            height=150,
+            key=f"{key_prefix}_closing_notes"
+        )
+
+    else:
+        # Jika Stage Masih Berjalan (Open, Proposal, dll)
+        new_stage_notes = st.text_area(
+            "Stage Context / Reason", 
+            placeholder="Example: Client approved BoQ on meeting yesterday...",
+            height=100,
+            key=f"{key_prefix}_stage_notes"
+        )
+
+    return new_stage_val, manual_date, closing_reason_val, new_stage_notes
+
+def bulk_import_section():
+    """Upload CSV / Excel -> validasi -> import sekaligus (lihat importer.py)."""
+    import importer
+
+    with st.expander("📥 Bulk Import from CSV / Excel"):
+        st.caption("One row per solution line. Rows with the same opportunity_name become one opportunity. "
+                   "If any line of an opportunity is invalid, the whole opportunity is skipped. "
+                   f"{importer.START_DATE_HINT}.")
+        st.download_button("Download Template", importer.template_csv(),
+                           file_name="opportunity_import_template.csv", mime="text/csv", key="import_template")
+
+        uploaded = st.file_uploader("Upload file", type=["csv", "xlsx"], key="import_file")
+        if not uploaded:
+            return
+
+        res_read = importer.read_upload(uploaded)
+        if res_read['status'] != 200:
+            st.error(res_read['message'])
+            return
+        res_val = importer.validate_import(res_read['data'])
+        if res_val['status'] != 200:
+            st.error(res_val['message'])
+            return
+
+        valid, errors = res_val['data']['valid'], res_val['data']['errors']
+        v1, v2, v3 = st.columns(3)
+        v1.metric("Valid Lines", len(valid))
+        v2.metric("Opportunities", valid['opportunity_name'].nunique())
+        v3.metric("Rejected Lines", len(errors))
+
+        if not errors.empty:
+            st.dataframe(errors.head(100), use_container_width=True, hide_index=True)
+            st.download_button("⬇️ Download Error Report", importer.errors_csv(errors),
+                               file_name="import_errors.csv", mime="text/csv", key="import_errors")
+
+        presales_names = [p.get("PresalesName", "") for p in get_master('getPresales')]
+        imported_by = st.selectbox("Imported by", presales_names, key="import_user")
+        if st.button(f"🚀 Import {len(valid)} valid lines", type="primary", disabled=valid.empty, key="import_submit"):
+            with st.spinner("Importing..."):
+                res = db.bulk_import_opportunities(valid, imported_by)
+            if res['status'] == 200:
+                st.success(res['message'])
+            else:
+                st.error(res['message'])
+
 @st.fragment
 def tab1():
     st.header("Add New Opportunity (Multi-Solution)")
     st.info("Fill out the main details once, then add one or more solutions below.")
+
+    bulk_import_section()
     
     # Load Helper Data
     inputter_to_pam_map = get_pam_mapping_dict()
@@ -180,7 +349,8 @@ def tab1():
         selected_stage = st.selectbox(
             "Current Stage", 
             stage_options, 
-            index=default_idx,
+            # Default hanya jika belum di-set lewat session_state (misal dari "Edit in form" antrian)
+            index=None if "parent_stage_select" in st.session_state else default_idx,
             key="parent_stage_select"
         )
 
@@ -279,7 +449,8 @@ def tab1():
                     note_message += " For Cisco only: First, apply a 50% discount to the price, then multiply by the IDR exchange rate."
                 st.info(note_message)
                 
-                is_via = st.radio("Via Distributor?", ("Yes", "No"), index=1, key=f"is_via_{line['id']}", horizontal=True)
+                is_via = st.radio("Via Distributor?", ("Yes", "No"), key=f"is_via_{line['id']}", horizontal=True,
+                                  index=None if f"is_via_{line['id']}" in st.session_state else 1)
                 if is_via == "Yes":
                     line['distributor_name'] = st.selectbox("Distributor", dist_list, key=f"dist_{line['id']}")
                 else:
@@ -299,6 +470,10 @@ def tab1():
     email_map = {p['PresalesName']: p['Email'] for p in presales_list if p.get('Email')}
     selected_emails = st.multiselect("Tag Presales for Notification (Optional)", sorted(email_map.keys()))
     
+    # Satu submission_id per isian form: submit ulang / replay antrian tidak membuat data dobel
+    if 'opp_submission_id' not in st.session_state:
+        st.session_state.opp_submission_id = write_queue.new_submission_id()
+
     if st.button("Submit Opportunity and All Solutions", type="primary"):
         if not opportunity_name or not company_name_final:
             st.error("Opportunity Name and Company are required.")
@@ -317,9 +492,18 @@ def tab1():
             }
             
             with st.spinner("Submitting to Database..."):
-                res = db.add_multi_line_opportunity(parent_data, st.session_state.product_lines)
+                res = write_queue.submit(
+                    "add_multi_line_opportunity", parent_data, st.session_state.product_lines,
+                    st.session_state.opp_submission_id
+                )
                 
-                if res['status'] == 200:
+                if res['status'] == 202:
+                    # DB down: form aman di antrian lokal, disimpan otomatis saat DB kembali
+                    st.session_state.queued_message = res['message']
+                    st.session_state.product_lines = [{"id": 0}]
+                    del st.session_state.opp_submission_id
+                    st.rerun()
+                elif res['status'] == 200:
                     st.session_state.submission_message = res['message']
                     st.session_state.new_uids = [x['uid'] for x in res['data']]
                     
@@ -337,10 +521,14 @@ def tab1():
                         st.session_state.submission_message += f" | Emails sent to {count_sent} recipient(s)."
                     
                     st.session_state.product_lines = [{"id": 0}]
+                    del st.session_state.opp_submission_id
                     st.rerun()
                 else:
                     st.error(f"Failed to submit: {res['message']}")
 
+    if st.session_state.get('queued_message'):
+        st.warning(st.session_state.pop('queued_message'))
+
     if st.session_state.submission_message:
         st.success(st.session_state.submission_message)
         if st.session_state.new_uids: 
@@ -348,9 +536,132 @@ def tab1():
         st.session_state.submission_message = None
         st.session_state.new_uids = None
 
+def render_write_queue_status():
+    """Sidebar: submission yang diantrekan saat DB down (write_queue.py), replay otomatis saat DB kembali."""
+    res = write_queue.replay_if_due()
+    if res and res['data']['saved'] + res['data']['rejected']:
+        st.sidebar.success(res['message'])
+
+    pending = write_queue.get_pending()
+    processed = write_queue.get_processed(limit=10)
+    if not pending and not processed:
+        return
+    with st.sidebar.expander(f"📮 Queued Submissions ({len(pending)} pending)", expanded=bool(pending)):
+        if pending:
+            st.caption("Saved locally while the database was unavailable. They are replayed in order automatically.")
+            st.dataframe(
+                pd.DataFrame(pending)[['seq', 'label', 'submitted_by', 'queued_at', 'attempts', 'last_error']],
+                hide_index=True, use_container_width=True
+            )
+            if st.button("🔁 Retry now", key="write_queue_retry"):
+                st.toast(write_queue.replay()['message'])
+                st.rerun()
+        if processed:
+            st.caption("Recently replayed")
+            df_done = pd.DataFrame(processed)
+            df_done['result'] = df_done['status'].map(lambda x: "✅ Saved" if x == 200 else "❌ Rejected")
+            st.dataframe(df_done[['seq', 'label', 'result', 'processed_at', 'message']],
+                         hide_index=True, use_container_width=True)
+
+    # Ditolak DB saat replay: payload tetap disimpan, user bisa muat ke form & submit ulang
+    for item in write_queue.get_rejected():
+        with st.sidebar.expander(f"❌ Rejected #{item['seq']}: {item['label'] or '-'}", expanded=True):
+            st.error(item['message'])
+            st.json(item['payload'], expanded=False)
+            c1, c2 = st.columns(2)
+            if item['kind'] == "add_multi_line_opportunity":
+                c1.button("✏️ Edit in form", key=f"wq_edit_{item['submission_id']}",
+                          on_click=_load_submission_into_form, args=(item,),
+                          help="Load this submission into 'Add Opportunity' to fix and submit it again.")
+            c2.button("Dismiss", key=f"wq_dismiss_{item['submission_id']}",
+                      on_click=write_queue.dismiss, args=(item['submission_id'],))
+
+def _load_submission_into_form(item):
+    """
+    Callback: isi form tab1 dengan payload submission yang ditolak, lalu sembunyikan dari sidebar.
+    Pilihan dropdown hanya di-set jika nilainya masih ada di master data; sisanya tetap default.
+    """
+    parent, lines = item['payload']['parent_data'], item['payload']['lines']
+
+    def set_choice(key, value, options):
+        if value in options:
+            st.session_state[key] = value
+
+    set_choice("parent_presales_name",
+               next((p for p in get_master('getPresales') if p.get('PresalesName') == parent.get('presales_name')), None),
+               get_master('getPresales'))
+    set_choice("pam_flexible_choice", {"Responsible": parent.get('responsible_name')}, get_master('getResponsibles'))
+    set_choice("parent_salesgroup_id", parent.get('salesgroup_id'), get_sales_groups())
+    set_choice("parent_sales_name", parent.get('sales_name'), get_sales_name_by_sales_group(parent.get('salesgroup_id')))
+    set_choice("parent_stage_select", parent.get('stage'), [s.get("Stage") for s in get_master('getPresalesStages')])
+    st.session_state.parent_stage_notes = parent.get('stage_notes') or ''
+    st.session_state.parent_opportunity_name = parent.get('opportunity_name')
+    st.session_state.parent_start_date = datetime.strptime(parent['start_date'], "%Y-%m-%d").date()
+    # Company diisi sebagai teks bebas supaya nilai persis sama dengan yang dulu di-submit
+    st.session_state.parent_is_company_listed = "No"
+    st.session_state.parent_company_text_input = parent.get('company_name') or ''
+    set_choice("parent_vertical_industry_select", parent.get('vertical_industry'),
+               [c.get("Vertical Industry") for c in get_master('getCompanies')])
+
+    brands = [b.get('Brand') for b in get_master('getBrands')]
+    distributors = [d.get("Distributor") for d in get_master('getDistributors')]
+    st.session_state.product_lines = []
+    for i, line in enumerate(lines):
+        st.session_state.product_lines.append({"id": i})
+        set_choice(f"pillar_{i}", line.get('pillar'), get_pillars())
+        set_choice(f"solution_{i}", line.get('solution'), get_solutions(line.get('pillar')))
+        set_choice(f"service_{i}", line.get('service'), get_services(line.get('solution')))
+        set_choice(f"brand_{i}", line.get('brand'), brands)
+        set_choice(f"channel_{i}", line.get('channel'), get_channels(line.get('brand')))
+        st.session_state[f"cost_{i}"] = int(float(line.get('cost') or 0))
+        st.session_state[f"notes_{i}"] = line.get('notes') or ''
+        via = line.get('distributor_name') in distributors
+        st.session_state[f"is_via_{i}"] = "Yes" if via else "No"
+        set_choice(f"dist_{i}", line.get('distributor_name'), distributors)
+    # submission_id baru: submit hasil edit adalah submission berbeda
+    st.session_state.pop('opp_submission_id', None)
+    st.session_state.queued_message = (
+        f"Rejected submission #{item['seq']} loaded into the form. Fix it and submit again."
+    )
+    write_queue.dismiss(item['submission_id'])
+
+def render_kanban_detail(sel_id):
+    if st.button("⬅️ Back to Kanban View"):
+        st.session_state.selected_kanban_opp_id = None
+        st.rerun()
+
+    # Get Details (indexed lookup + cache per opportunity)
+    res = db.get_opportunity_lines(sel_id)
+    if res['status'] != 200:
+        st.error(f"Details not found: {res['message']}")
+        return
+
+    detail_df = pd.DataFrame(res['data'])
+    header = detail_df.iloc[0]
+    st.header(f"Detail for: {header['opportunity_name']}")
+    st.subheader(f"Client: {header['company_name']}")
+    st.markdown("---")
+    
+    k1, k2 = st.columns(2)
+    with k1:
+        st.markdown(f"**Inputter:** {header['presales_name']}")
+        st.markdown(f"**PAM:** {header['responsible_name']}")
+        st.markdown(f"**Start Date:** {header['start_date']}")
+    with k2:
+        st.markdown(f"**Stage:** {header.get('stage', 'Open')}")
+        st.markdown(f"**Opp ID:** {header['opportunity_id']}")
+    
+    st.subheader("Solution Details")
+    st.dataframe(clean_data_for_display(detail_df), use_container_width=True)
+
 @st.fragment
 def tab2():
     st.header("Kanban View by Opportunity Stage")
+
+    # --- DETAIL VIEW LOGIC (hanya query opportunity terpilih, tanpa load seluruh tabel) ---
+    if st.session_state.selected_kanban_opp_id:
+        render_kanban_detail(st.session_state.selected_kanban_opp_id)
+        return
     
     with st.spinner("Fetching leads..."):
         res = db.get_all_leads_presales() # Backend call
@@ -385,102 +696,209 @@ def tab2():
         
         st.markdown("---")
         
-        # --- DETAIL VIEW LOGIC ---
-        if st.session_state.selected_kanban_opp_id:
-            sel_id = st.session_state.selected_kanban_opp_id
-            if st.button("⬅️ Back to Kanban View"):
-                st.session_state.selected_kanban_opp_id = None
-                st.rerun()
+        # --- KANBAN BOARD LOGIC ---
+        if df_filtered.empty:
+            st.warning("No data after filter.")
+        else:
+            # Calculate Cost
+            if 'cost' not in df_filtered.columns: df_filtered['cost'] = 0
+            df_filtered['cost'] = pd.to_numeric(df_filtered['cost'], errors='coerce').fillna(0)
             
-            # Get Details
-            detail_df = df_filtered[df_filtered['opportunity_id'] == sel_id]
-            if detail_df.empty:
-                st.error("Details not found (might be hidden by filter).")
-            else:
-                header = detail_df.iloc[0]
-                st.header(f"Detail for: {header['opportunity_name']}")
-                st.subheader(f"Client: {header['company_name']}")
-                st.markdown("---")
-                
-                k1, k2 = st.columns(2)
-                with k1:
-                    st.markdown(f"**Inputter:** {header['presales_name']}")
-                    st.markdown(f"**PAM:** {header['responsible_name']}")
-                    st.markdown(f"**Start Date:** {header['start_date']}")
-                with k2:
-                    st.markdown(f"**Stage:** {header.get('stage', 'Open')}")
-                    st.markdown(f"**Opp ID:** {header['opportunity_id']}")
+            # 1. Aggregasi per Opportunity ID (Total Cost)
+            # Group by ID, ambil first untuk metadata, sum untuk cost
+            df_opps = df_filtered.groupby('opportunity_id').agg({
+                'opportunity_name': 'first',
+                'company_name': 'first',
+                'presales_name': 'first',
+                'stage': 'first',
+                'cost': 'sum'
+            }).reset_index()
+            
+            # Handle Stage Empty
+            df_opps['stage'] = df_opps['stage'].fillna('Open')
+            
+            # Split Stages
+            open_opps = df_opps[df_opps['stage'] == 'Open']
+            won_opps = df_opps[df_opps['stage'] == 'Closed Won']
+            lost_opps = df_opps[df_opps['stage'] == 'Closed Lost']
+            
+            # Totals
+            tot_open = open_opps['cost'].sum()
+            tot_won = won_opps['cost'].sum()
+            tot_lost = lost_opps['cost'].sum()
+            
+            k1, k2, k3 = st.columns(3)
+            
+            def render_card(row):
+                with st.container(border=True):
+                    st.markdown(f"**{row['opportunity_name']}**")
+                    st.caption(f"{row['company_name']}")
+                    st.caption(f"👤 {row['presales_name']}")
+                    st.markdown(f"💰 **Rp {format_number(row['cost'])}**")
+                    if st.button("View Details", key=f"btn_{row['opportunity_id']}"):
+                        st.session_state.selected_kanban_opp_id = row['opportunity_id']
+                        st.rerun()
+
+            with k1:
+                st.markdown(f"### 🧊 Open ({len(open_opps)})")
+                st.markdown(f"**Rp {format_number(tot_open)}**")
+                st.divider()
+                for _, r in open_opps.iterrows(): render_card(r)
+            
+            with k2:
+                st.markdown(f"### ✅ Won ({len(won_opps)})")
+                st.markdown(f"**Rp {format_number(tot_won)}**")
+                st.divider()
+                for _, r in won_opps.iterrows(): render_card(r)
                 
-                st.subheader("Solution Details")
-                st.dataframe(clean_data_for_display(detail_df), use_container_width=True)
+            with k3:
+                st.markdown(f"### ❌ Lost ({len(lost_opps)})")
+                st.markdown(f"**Rp {format_number(tot_lost)}**")
+                st.divider()
+                for _, r in lost_opps.iterrows(): render_card(r)
 
-        # --- KANBAN BOARD LOGIC ---
-        else:
-            if df_filtered.empty:
-                st.warning("No data after filter.")
+
+def render_pipeline_charts(pillars, stages, sales_groups, date_range):
+    """Chart nilai pipeline dari tabel pipeline_cube (pre-aggregated di DB)."""
+    st.markdown("### 📈 Pipeline Charts")
+    st.caption("Charts follow the Pillar, Stage, Sales Group and Start Date filters.")
+
+    start_d, end_d = date_range if isinstance(date_range, tuple) and len(date_range) == 2 else (None, None)
+    res = db.get_pipeline_cube(pillars, stages, sales_groups, start_d, end_d)
+    if res['status'] != 200:
+        st.error(f"Failed to load pipeline charts: {res['message']}")
+        return
+    if not res['data']:
+        st.info("No pipeline data for the selected filter.")
+        return
+
+    df_cube = pd.DataFrame(res['data'])
+    df_cube['total_cost'] = pd.to_numeric(df_cube['total_cost'], errors='coerce').fillna(0)
+    df_cube['start_month'] = pd.to_datetime(df_cube['start_month'], errors='coerce')
+
+    ch1, ch2 = st.columns(2)
+    with ch1:
+        st.markdown("**Pipeline Value by Stage & Pillar**")
+        by_stage = df_cube.pivot_table(index='stage', columns='pillar', values='total_cost', aggfunc='sum', fill_value=0)
+        st.bar_chart(by_stage)
+    with ch2:
+        st.markdown("**Pipeline Value by Sales Group & Stage**")
+        by_group = df_cube.pivot_table(index='salesgroup_id', columns='stage', values='total_cost', aggfunc='sum', fill_value=0)
+        st.bar_chart(by_group)
+
+    st.markdown("**Pipeline Value by Start Month**")
+    by_month = df_cube.pivot_table(index='start_month', columns='stage', values='total_cost', aggfunc='sum', fill_value=0)
+    st.line_chart(by_month)
+
+def render_export_panel(key_prefix, run_export):
+    """
+    Panel export (CSV / XLSX / Parquet). run_export(export, fmt) menulis file di server
+    secara streaming (lihat export.py); di sini hanya tombol download-nya.
+    """
+    import export
+
+    state_key = f"{key_prefix}_export_file"
+    e1, e2 = st.columns([1, 3])
+    with e1:
+        fmt = st.selectbox("Format", list(export.EXPORT_FORMATS.keys()), key=f"{key_prefix}_export_fmt")
+    with e2:
+        st.write("")
+        if st.button("Prepare Export", key=f"{key_prefix}_export_btn"):
+            # Hapus file export sebelumnya dari sesi ini
+            old = st.session_state.pop(state_key, None)
+            if old and os.path.exists(old['path']):
+                os.remove(old['path'])
+            with st.spinner("Exporting from database..."):
+                res = run_export(export, fmt)
+            if res['status'] == 200:
+                st.session_state[state_key] = res['data']
             else:
-                # Calculate Cost
-                if 'cost' not in df_filtered.columns: df_filtered['cost'] = 0
-                df_filtered['cost'] = pd.to_numeric(df_filtered['cost'], errors='coerce').fillna(0)
-                
-                # 1. Aggregasi per Opportunity ID (Total Cost)
-                # Group by ID, ambil first untuk metadata, sum untuk cost
-                df_opps = df_filtered.groupby('opportunity_id').agg({
-                    'opportunity_name': 'first',
-                    'company_name': 'first',
-                    'presales_name': 'first',
-                    'stage': 'first',
-                    'cost': 'sum'
-                }).reset_index()
-                
-                # Handle Stage Empty
-                df_opps['stage'] = df_opps['stage'].fillna('Open')
-                
-                # Split Stages
-                open_opps = df_opps[df_opps['stage'] == 'Open']
-                won_opps = df_opps[df_opps['stage'] == 'Closed Won']
-                lost_opps = df_opps[df_opps['stage'] == 'Closed Lost']
-                
-                # Totals
-                tot_open = open_opps['cost'].sum()
-                tot_won = won_opps['cost'].sum()
-                tot_lost = lost_opps['cost'].sum()
-                
-                k1, k2, k3 = st.columns(3)
-                
-                def render_card(row):
-                    with st.container(border=True):
-                        st.markdown(f"**{row['opportunity_name']}**")
-                        st.caption(f"{row['company_name']}")
-                        st.caption(f"👤 {row['presales_name']}")
-                        st.markdown(f"💰 **Rp {format_number(row['cost'])}**")
-                        if st.button("View Details", key=f"btn_{row['opportunity_id']}"):
-                            st.session_state.selected_kanban_opp_id = row['opportunity_id']
-                            st.rerun()
-
-                with k1:
-                    st.markdown(f"### 🧊 Open ({len(open_opps)})")
-                    st.markdown(f"**Rp {format_number(tot_open)}**")
-                    st.divider()
-                    for _, r in open_opps.iterrows(): render_card(r)
-                
-                with k2:
-                    st.markdown(f"### ✅ Won ({len(won_opps)})")
-                    st.markdown(f"**Rp {format_number(tot_won)}**")
-                    st.divider()
-                    for _, r in won_opps.iterrows(): render_card(r)
-                    
-                with k3:
-                    st.markdown(f"### ❌ Lost ({len(lost_opps)})")
-                    st.markdown(f"**Rp {format_number(tot_lost)}**")
-                    st.divider()
-                    for _, r in lost_opps.iterrows(): render_card(r)
+                st.error(res['message'])
+
+    file_info = st.session_state.get(state_key)
+    if file_info and not os.path.exists(file_info['path']):
+        # Sudah dihapus export.cleanup_old_exports() (lebih tua dari EXPORT_MAX_AGE_MINUTES)
+        st.session_state.pop(state_key, None)
+        st.caption("Export file expired, click Prepare Export again.")
+    elif file_info:
+        with open(file_info['path'], "rb") as f:
+            st.download_button(
+                f"⬇️ Download {file_info['file_name']} ({file_info['rows']} rows)",
+                data=f, file_name=file_info['file_name'], mime=file_info['mime'],
+                key=f"{key_prefix}_export_download"
+            )
+
+GRID_SORT_OPTIONS = {
+    "Created At": "created_at", "Updated At": "updated_at", "Start Date": "start_date",
+    "Cost": "cost", "Opportunity Name": "opportunity_name", "Company": "company_name",
+    "Stage": "stage", "Sales Group": "salesgroup_id", "Pillar": "pillar"
+}
+
+def render_paginated_grid(filters, start_date, end_date):
+    """Grid Detailed Data: sort, LIMIT/OFFSET & count dijalankan di DB, hanya halaman aktif yang diformat."""
+    res_count = db.count_opportunities(filters, start_date, end_date)
+    if res_count['status'] != 200:
+        st.error(f"Failed to count rows: {res_count['message']}")
+        return
+    total_rows = res_count['data']
+
+    g1, g2, g3, g4 = st.columns([2, 1, 1, 1])
+    with g1:
+        sort_label = st.selectbox("Sort by", list(GRID_SORT_OPTIONS.keys()), key="grid_sort_by")
+    with g2:
+        descending = st.selectbox("Order", ["Descending", "Ascending"], key="grid_sort_order") == "Descending"
+    with g3:
+        page_size = st.selectbox("Rows per page", [25, 50, 100, 200], index=1, key="grid_page_size")
+    total_pages = max(1, -(-total_rows // page_size))
+    # Nilai halaman hanya lewat session_state (tanpa value= di widget), supaya clamp di bawah
+    # tidak memicu warning "default value + Session State API" dari Streamlit
+    if "grid_page" not in st.session_state:
+        st.session_state.grid_page = 1
+    # Filter / page size berubah -> halaman lama bisa melebihi jumlah halaman baru
+    if st.session_state.grid_page > total_pages:
+        st.session_state.grid_page = total_pages
+    with g4:
+        page = st.number_input("Page", min_value=1, max_value=total_pages, step=1, key="grid_page")
+
+    res_page = db.get_opportunities_page(
+        filters, start_date, end_date,
+        sort_by=GRID_SORT_OPTIONS[sort_label], descending=descending, page=page, page_size=page_size
+    )
+    if res_page['status'] != 200:
+        st.error(f"Failed to load page: {res_page['message']}")
+        return
 
+    first_row = (page - 1) * page_size + 1 if total_rows else 0
+    last_row = min(page * page_size, total_rows)
+    st.caption(f"Showing rows {first_row}–{last_row} of {total_rows} (page {page} of {total_pages})")
+    st.dataframe(clean_data_for_display(pd.DataFrame(res_page['data'])), use_container_width=True, hide_index=True)
 
 @st.fragment
 def tab3():
     st.header("Interactive Dashboard & Search")
-    
+
+    # =================================================================
+    # 🔎 FULL-TEXT SEARCH (Query langsung ke index DB, tanpa load semua data)
+    # =================================================================
+    with st.container(border=True):
+        st.subheader("🔎 Quick Search")
+        keyword = st.text_input(
+            "Search opportunity, company, notes, stage notes or closing notes",
+            key="fts_keyword",
+            placeholder="e.g. bank firewall renewal"
+        )
+        if keyword:
+            res_search = db.search_opportunities(keyword)
+            if res_search['status'] != 200:
+                st.error(res_search['message'])
+            elif not res_search['data']:
+                st.info("No matching opportunity found.")
+            else:
+                df_search = pd.DataFrame(res_search['data'])
+                st.write(f"Found {len(df_search)} matching solution lines "
+                         f"in {df_search['opportunity_id'].nunique()} opportunities.")
+                st.dataframe(clean_data_for_display(df_search), use_container_width=True)
+
     # 1. Ambil semua data (Cached via Backend)
     with st.spinner("Loading dataset..."):
         response = db.get_all_leads_presales() # Direct DB Call
@@ -624,7 +1042,19 @@ def tab3():
             m1, m2, m3 = st.columns(3)
             m1.metric("Total Solutions Line", f"{total_opps}")
             m2.metric("Total Unique Opportunities", f"{total_unique_opps}")
-            m3.metric("Total Customers", f"{total_unique_customers}") 
+            m3.metric("Total Customers", f"{total_unique_customers}")
+
+            # Kirim hasil filter ke mode Bulk Stage Update di tab Update Opportunity
+            if total_unique_opps and st.button(f"📦 Send {total_unique_opps} opportunities to Bulk Stage Update"):
+                st.session_state.bulk_stage_ids = sorted(df_filtered['opportunity_id'].dropna().astype(str).unique().tolist())
+                st.success("Opportunity IDs sent. Open 'Update Opportunity' → 'Bulk Stage Update'.")
+
+            st.markdown("---")
+
+            # =================================================================
+            # 📈 PIPELINE CHARTS (dari pipeline cube, bukan dari df)
+            # =================================================================
+            render_pipeline_charts(sel_pillar, sel_stage, sel_group, date_range)
 
             st.markdown("---")
 
@@ -632,21 +1062,40 @@ def tab3():
             # 📋 DATA TABLE
             # =================================================================
             st.subheader(f"Detailed Data ({total_opps} rows)")
-            
-            if not df_filtered.empty:
+            grid_start, grid_end = date_range if isinstance(date_range, tuple) and len(date_range) == 2 else (None, None)
+
+            if df_filtered.empty:
+                st.warning("Tidak ada data yang cocok dengan kombinasi filter di atas.")
+            elif st.toggle("Show all rows at once", value=False, key="grid_show_all",
+                           help="Paginated mode only loads and formats the visible page."):
                 # Gunakan fungsi cleaning global untuk format tampilan akhir
                 st.dataframe(clean_data_for_display(df_filtered), use_container_width=True)
             else:
-                st.warning("Tidak ada data yang cocok dengan kombinasi filter di atas.")
+                render_paginated_grid(filters, grid_start, grid_end)
+
+            # =================================================================
+            # ⬇️ EXPORT (streaming dari DB dengan filter yang sama)
+            # =================================================================
+            with st.expander("⬇️ Export Filtered Data"):
+                export_start, export_end = date_range if isinstance(date_range, tuple) and len(date_range) == 2 else (None, None)
+                render_export_panel(
+                    "tab3",
+                    lambda export, fmt: export.export_opportunities(filters, export_start, export_end, fmt)
+                )
 
 @st.fragment
 def tab4():
     st.header("Update Opportunity")
+
+    # Pesan sukses dari submit sebelumnya (ditampilkan setelah rerun, tanpa sleep)
+    if st.session_state.get('update_flash'):
+        st.success(st.session_state.pop('update_flash'))
     
     # Pilihan Mode Update
     update_mode = st.radio(
         "Select Update Type:", 
-        ["🛠️ Update Solution Details (Cost/Notes)", "📈 Update Stage (Business Progression)"],
+        ["🛠️ Update Solution Details (Cost/Notes)", "📈 Update Stage (Business Progression)",
+         "📦 Bulk Stage Update (Multiple Opportunities)"],
         horizontal=True
     )
     
@@ -656,76 +1105,87 @@ def tab4():
     # MODE 1: UPDATE SOLUTION DETAILS (Cost/Notes)
     # ==========================================================================
     if update_mode == "🛠️ Update Solution Details (Cost/Notes)":
-        st.subheader("Update Specific Solution Line")
-        uid_in = st.text_input("Enter UID to search", key="uid_update_sol", help="Paste UID unik dari item solusi di sini.")
-        
-        if 'lead_sol_update' not in st.session_state: st.session_state.lead_sol_update = None
+        st.subheader("Update Solution Lines (Cost / Notes)")
+        st.caption("Load every line of an opportunity, or paste several UIDs, then edit Cost and Notes in the grid. "
+                   "Only changed cells are saved, all in one transaction.")
+
+        if 'sol_edit_lines' not in st.session_state: st.session_state.sol_edit_lines = None
+        if 'sol_edit_version' not in st.session_state: st.session_state.sol_edit_version = 0
+
+        s1, s2 = st.columns(2)
+        with s1:
+            opp_in = st.text_input("Opportunity ID (all lines)", key="sol_edit_opp_id")
+        with s2:
+            uid_in = st.text_area("...or UIDs (one per line / comma separated)", key="uid_update_sol", height=68,
+                                  help="Paste UID unik dari item solusi di sini.")
 
         if st.button("Get Solution Data"):
-            res = db.get_lead_by_uid(uid_in)
+            if opp_in.strip():
+                res = db.get_opportunity_lines(opp_in.strip())
+            else:
+                res = db.get_leads_by_uids(parse_id_list(uid_in))
             if res['status'] == 200:
-                st.session_state.lead_sol_update = res['data'][0]
+                st.session_state.sol_edit_lines = res['data']
+                st.session_state.sol_edit_version += 1
+                if res.get('missing'):
+                    st.warning(f"UID not found: {', '.join(res['missing'])}")
             else:
-                st.error("UID Not Found. Please check the UID again.")
-                st.session_state.lead_sol_update = None
+                st.error(f"{res['message']}. Please check the ID again.")
+                st.session_state.sol_edit_lines = None
+
+        if st.session_state.sol_edit_lines:
+            df_orig = pd.DataFrame(st.session_state.sol_edit_lines)
+            for col in ['opportunity_name', 'product_id', 'pillar', 'solution', 'service', 'brand', 'notes']:
+                if col not in df_orig.columns: df_orig[col] = None
+            df_orig['cost'] = pd.to_numeric(df_orig['cost'], errors='coerce').fillna(0).astype(float)
+            df_orig['notes'] = df_orig['notes'].fillna('').astype(str)
+            grid_cols = ['uid', 'opportunity_name', 'product_id', 'pillar', 'solution', 'service', 'brand', 'cost', 'notes']
+            df_grid = df_orig[grid_cols].reset_index(drop=True)
+
+            st.info(f"**{len(df_grid)} line(s)** in {df_orig['opportunity_id'].nunique()} opportunity(ies), "
+                    f"total cost Rp {format_number(df_grid['cost'].sum())}")
+
+            edited = st.data_editor(
+                df_grid,
+                key=f"sol_editor_{st.session_state.sol_edit_version}",
+                hide_index=True,
+                use_container_width=True,
+                disabled=[c for c in grid_cols if c not in ('cost', 'notes')],
+                column_config={
+                    "cost": st.column_config.NumberColumn("Cost (IDR)", min_value=0, step=1000000, format="%d"),
+                    "notes": st.column_config.TextColumn("Technical/Item Notes", width="large"),
+                }
+            )
 
-        if st.session_state.lead_sol_update:
-            lead = st.session_state.lead_sol_update
-            
-            # --- [BARU] TAMPILAN DETAIL ITEM ---
-            with st.container(border=True):
-                st.markdown(f"#### 📋 Item Details: `{lead.get('product_id')}`")
-                
-                # Baris 1: Info Opportunity
-                st.info(f"**Opportunity:** {lead.get('opportunity_name')} | **Client:** {lead.get('company_name')}")
-                
-                # Baris 2: Detail Teknis (Grid Layout)
-                d1, d2, d3, d4 = st.columns(4)
-                d1.markdown(f"**Pillar:**\n{lead.get('pillar')}")
-                d2.markdown(f"**Solution:**\n{lead.get('solution')}")
-                d3.markdown(f"**Service:**\n{lead.get('service')}")
-                d4.markdown(f"**Brand:**\n{lead.get('brand')}")
-                
-                st.divider()
-                
-                # Baris 3: Info Sales & Distributor
-                d5, d6, d7, d8 = st.columns(4)
-                d5.markdown(f"**Distributor:**\n{lead.get('distributor_name')}")
-                d6.markdown(f"**Presales Account Manager:**\n{lead.get('responsible_name')}")
-                d7.markdown(f"**Sales:**\n{lead.get('sales_name')}")
-                d8.markdown(f"**Inputter:**\n{lead.get('presales_name')}")
-            # -----------------------------------
-            
-            st.markdown("### ✏️ Edit Values")
-            
-            c1, c2 = st.columns(2)
-            with c1:
-                new_cost = st.number_input(
-                    "Cost (IDR)", 
-                    value=float(lead.get('cost') or 0), 
-                    step=1000000.0, 
-                    key="num_upd_cost",
-                    help="Update harga modal/cost di sini."
-                )
-                st.caption(f"Reads: Rp {format_number(new_cost)}")
-            with c2:
-                new_notes = st.text_area(
-                    "Technical/Item Notes", 
-                    value=lead.get('notes', ''),
-                    help="Update catatan teknis spesifik untuk item ini."
-                )
-            
-            if st.button("Save Solution Update"):
-                res = db.update_lead({
-                    "uid": lead['uid'], 
-                    "cost": new_cost, 
-                    "notes": new_notes, 
-                    "user": lead['presales_name']
-                })
+            # Diff per cell terhadap data yang di-load
+            new_cost = pd.to_numeric(edited['cost'], errors='coerce')
+            new_notes = edited['notes'].fillna('').astype(str)
+            cost_changed = new_cost.ne(df_grid['cost']) & new_cost.notna()
+            notes_changed = new_notes.ne(df_grid['notes'])
+
+            changes = []
+            for i in df_grid.index[cost_changed | notes_changed]:
+                change = {"uid": df_grid.at[i, 'uid']}
+                if cost_changed[i]: change['cost'] = float(new_cost[i])
+                if notes_changed[i]: change['notes'] = new_notes[i]
+                changes.append(change)
+
+            if new_cost.isna().any():
+                st.warning("Empty Cost cells are ignored. Enter 0 instead to clear a cost.")
+
+            presales_list = [p.get("PresalesName", "") for p in get_master('getPresales')]
+            default_user = df_orig['presales_name'].iloc[0] if 'presales_name' in df_orig.columns else None
+            updater = st.selectbox(
+                "Updated by", presales_list,
+                index=presales_list.index(default_user) if default_user in presales_list else 0,
+                key="sol_edit_user"
+            )
+
+            if st.button(f"Save {len(changes)} Changed Line(s)", type="primary", disabled=not changes):
+                res = db.update_leads_batch(changes, updater)
                 if res['status'] == 200:
-                    st.success("✅ Item Updated Successfully!")
-                    st.session_state.lead_sol_update = None
-                    time.sleep(1)
+                    st.session_state.update_flash = f"✅ {res['message']}"
+                    st.session_state.sol_edit_lines = None
                     st.rerun()
                 else:
                     st.error(res['message'])
@@ -733,7 +1193,7 @@ def tab4():
     # ==========================================================================
     # MODE 2: UPDATE STAGE (BUSINESS PROGRESSION) - (LOGIKA FINAL)
     # ==========================================================================
-    else:
+    elif update_mode == "📈 Update Stage (Business Progression)":
         st.subheader("Update Opportunity Stage & Context")
         st.info("Update stage untuk seluruh item dalam Opportunity ini.")
         
@@ -762,79 +1222,9 @@ def tab4():
                     c_info2.info(f"**Last Reason:** {opp_data.get('closing_reason')}")
 
             st.markdown("### 📝 Update Status Details")
-            
-            c_form1, c_form2 = st.columns(2)
-            
-            with c_form1:
-                # 1. Logic Dropdown Stage (Inject Closed Won/Lost)
-                stage_raw = get_master('getPresalesStages')
-                stage_opts = [s['Stage'] for s in stage_raw]
-                
-                # Manual Injection: Paksa munculkan opsi Closed
-                for s in ["Closed Won", "Closed Lost"]:
-                    if s not in stage_opts:
-                        stage_opts.append(s)
-                stage_opts = sorted(stage_opts)
-
-                # Set Default Index
-                try: curr_idx = stage_opts.index(opp_data['stage'])
-                except: curr_idx = 0    
-                
-                new_stage_val = st.selectbox("New Stage", stage_opts, index=curr_idx)
-
-            with c_form2:
-                # 2. Tanggal Manual
-                manual_date = st.date_input("Stage Changed Date", value="today")
-
-            # --- LOGIC CLOSING CATEGORY (WON vs LOST) ---
-            closing_reason_val = None 
-            
-            # Jika user memilih stage Closed Won atau Closed Lost
-            if new_stage_val in ["Closed Won", "Closed Lost"]:
-                st.markdown("---")
-                
-                if new_stage_val == "Closed Won":
-                    st.success(f"🎉 Closing Deal: **{new_stage_val}**")
-                    reason_opts = [
-                        "Commercial / Price Strategy",
-                        "Technical Solution Fit",
-                        "Relationship / Trust",
-                        "Delivery / Timeline",
-                        "After-Sales Service",
-                        "Other Winning Factors"
-                    ]
-                    label_text = "Winning Factor (Why did we win?)"
-                else:
-                    st.error(f"💀 Closing Deal: **{new_stage_val}**")
-                    reason_opts = [
-                        "Price / Budget Constraint",
-                        "Competitor - Technical",
-                        "Competitor - Price",
-                        "Feature Gap / Spec Mismatch",
-                        "Late Proposal Submission",
-                        "Project Cancelled",
-                        "Lost to Incumbent",
-                        "No Decision"
-                    ]
-                    label_text = "Loss Reason (Why did we lose?)"
-
-                # Dropdown Kategori (Full Width)
-                closing_reason_val = st.selectbox(label_text, reason_opts, key="close_reason_cat")
-                
-                # Text Area untuk Detail
-                new_stage_notes = st.text_area(
-                    "Closing Remarks / Post-Mortem", 
-                    placeholder="Ceritakan detail, kendala teknis, atau feedback user (tanpa perlu menyebut detail kompetitor jika tidak tahu)...",
-                    height=150
-                )
-
-            else:
-                # Jika Stage Masih Berjalan (Open, Proposal, dll)
-                new_stage_notes = st.text_area(
-                    "Stage Context / Reason", 
-                    placeholder="Example: Client approved BoQ on meeting yesterday...",
-                    height=100
-                )
+            new_stage_val, manual_date, closing_reason_val, new_stage_notes = stage_update_form(
+                "single", current_stage=opp_data['stage']
+            )
 
             # --- SUBMIT BUTTON ---
             if st.button("🚀 Update Stage Progression", type="primary"):
@@ -851,13 +1241,68 @@ def tab4():
                     )
                     
                     if res['status'] == 200:
-                        st.success(f"✅ Success! {res['message']}")
+                        st.session_state.update_flash = f"✅ Success! {res['message']}"
                         st.session_state.opp_stage_data = None # Reset
-                        time.sleep(2)
                         st.rerun()
                     else:
                         st.error(f"Failed: {res['message']}")
-                        
+
+    # ==========================================================================
+    # MODE 3: BULK STAGE UPDATE (BANYAK OPPORTUNITY SEKALIGUS)
+    # ==========================================================================
+    else:
+        st.subheader("Bulk Stage Update")
+        st.info("Apply the same stage, notes, closing reason and date to many opportunities in one transaction.")
+
+        if 'bulk_stage_ids' not in st.session_state: st.session_state.bulk_stage_ids = []
+        if 'bulk_stage_result' not in st.session_state: st.session_state.bulk_stage_result = None
+
+        b1, b2 = st.columns(2)
+        with b1:
+            pasted_ids = st.text_area(
+                "Paste Opportunity IDs",
+                placeholder="ENT1Q30005, ENT1Q30006\nGOV2Q30010",
+                height=150,
+                key="bulk_stage_pasted",
+                help="Pisahkan dengan koma, spasi, atau baris baru."
+            )
+        with b2:
+            dashboard_ids = st.multiselect(
+                "Or pick from the Search Opportunity filter",
+                st.session_state.bulk_stage_ids,
+                default=st.session_state.bulk_stage_ids,
+                key="bulk_stage_picked",
+                help="Gunakan tombol 'Send to Bulk Stage Update' di tab Search Opportunity."
+            )
+
+        target_ids = list(dict.fromkeys(parse_id_list(pasted_ids) + list(dashboard_ids)))
+        st.write(f"**{len(target_ids)}** opportunities selected.")
+
+        new_stage_val, manual_date, closing_reason_val, new_stage_notes = stage_update_form("bulk")
+
+        if st.button("🚀 Apply Stage to All Selected", type="primary", disabled=not target_ids):
+            with st.spinner(f"Updating {len(target_ids)} opportunities..."):
+                res = db.update_opportunity_stage_batch(
+                    target_ids,
+                    new_stage_val,
+                    new_stage_notes,
+                    manual_date,
+                    "Presales User",
+                    closing_reason_val
+                )
+            if res['status'] == 200:
+                st.session_state.bulk_stage_result = res
+            else:
+                st.error(f"Failed: {res['message']}")
+
+        if st.session_state.bulk_stage_result:
+            res = st.session_state.bulk_stage_result
+            st.success(f"✅ {res['message']}")
+            df_res = pd.DataFrame(res['data'])
+            st.dataframe(df_res, use_container_width=True)
+            if (df_res['status'] != "Updated").any():
+                st.warning("Some IDs were not found. Please check them again.")
+
 @st.fragment
 def tab5():
     st.header("Edit Data Entry (Error Correction)")
@@ -1147,8 +1592,118 @@ def tab6():
                 # Tampilkan
                 st.write(f"Found {len(df_display)} log entries for the selected filter.")
                 st.dataframe(df_display, use_container_width=True)
+
+                # Export tidak dibatasi 1000 baris terakhir seperti tabel di atas
+                with st.expander("⬇️ Export Activity Log"):
+                    log_filter = st.session_state.get("log_opportunity_filter", "All Opportunities")
+                    render_export_panel(
+                        "tab6",
+                        lambda export, fmt: export.export_activity_log(None if log_filter == "All Opportunities" else log_filter, fmt)
+                    )
             else:
                 st.info("No log data found for the selected Opportunity Name.")
 
         else:
             st.warning("No activity log has been recorded yet.")
+
+@st.fragment
+def tab7():
+    st.header("Pipeline Velocity")
+    st.info("Time-in-stage, stage-to-stage conversion and win rate, computed from the stage history.")
+
+    f1, f2 = st.columns(2)
+    with f1:
+        sel_pillars = st.multiselect("Pillar", get_pillars(), placeholder="All Pillars", key="velocity_pillars")
+    with f2:
+        sel_groups = st.multiselect("Sales Group", get_sales_groups(), placeholder="All Groups", key="velocity_groups")
+
+    velocity_box = st.container()
+    history_box = st.container()
+
+    # Input history di-render dulu (tampil di bawah) supaya ketiga query bisa jalan bersamaan
+    with history_box:
+        st.markdown("---")
+        st.subheader("🗓️ Pipeline History")
+        st.caption("Built from the daily pipeline snapshots (snapshot_job.py). History starts at the first snapshot.")
+
+        today = datetime.now().date()
+        h1, h2 = st.columns([2, 1])
+        with h1:
+            trend_range = st.date_input("Trend Period", value=(today - timedelta(days=90), today), key="history_trend_range")
+        with h2:
+            as_of = st.date_input("Pipeline As Of", value=today, max_value=today, key="history_as_of")
+    trend_start, trend_end = trend_range if isinstance(trend_range, tuple) and len(trend_range) == 2 else (None, None)
+
+    with st.spinner("Loading pipeline metrics..."):
+        results = adb.run(adb.gather_dict(
+            velocity=adb.get_pipeline_velocity(sel_pillars, sel_groups),
+            trend=adb.get_pipeline_trend(trend_start, trend_end, sel_pillars, None, sel_groups),
+            as_of=adb.get_pipeline_as_of(as_of, sel_pillars, None, sel_groups),
+        ))
+
+    with velocity_box:
+        render_velocity_metrics(results['velocity'])
+
+    with history_box:
+        res_trend = results['trend']
+        if res_trend['status'] != 200:
+            st.error(f"Failed to load pipeline trend: {res_trend['message']}")
+        elif not res_trend['data']:
+            st.caption("No snapshots in the selected period.")
+        else:
+            df_trend = pd.DataFrame(res_trend['data'])
+            df_trend['total_cost'] = pd.to_numeric(df_trend['total_cost'], errors='coerce').fillna(0)
+            st.line_chart(df_trend.pivot_table(index='snapshot_date', columns='stage', values='total_cost', aggfunc='sum', fill_value=0))
+
+        res_asof = results['as_of']
+        if res_asof['status'] != 200:
+            st.error(f"Failed to load pipeline as of {as_of}: {res_asof['message']}")
+        elif not res_asof['data']:
+            st.caption(f"No snapshot data on or before {as_of}.")
+        else:
+            df_asof = pd.DataFrame(res_asof['data'])
+            df_asof['cost'] = pd.to_numeric(df_asof['cost'], errors='coerce').fillna(0)
+            by_stage = df_asof.groupby('stage').agg(
+                opportunities=('opportunity_id', 'nunique'), lines=('uid', 'count'), total_cost=('cost', 'sum')
+            ).reset_index()
+            st.markdown(f"**Pipeline value as of {as_of}:** Rp {format_number(df_asof['cost'].sum())}")
+            st.dataframe(by_stage, use_container_width=True, hide_index=True)
+            with st.expander("Line details"):
+                st.dataframe(df_asof, use_container_width=True, hide_index=True)
+
+def render_velocity_metrics(res):
+    if res['status'] != 200:
+        st.error(f"Failed to load velocity metrics: {res['message']}")
+        return
+
+    data = res['data']
+    if not data['time_in_stage'] and not data['win_rate']:
+        st.warning("No stage history recorded yet for the selected filter.")
+        return
+
+    # --- 1. TIME IN STAGE ---
+    st.subheader("⏱️ Average Time in Stage (days)")
+    df_time = pd.DataFrame(data['time_in_stage'])
+    if not df_time.empty:
+        df_time['avg_days'] = pd.to_numeric(df_time['avg_days'], errors='coerce').fillna(0).round(1)
+        st.bar_chart(df_time.set_index('stage')['avg_days'])
+        st.dataframe(df_time, use_container_width=True, hide_index=True)
+
+    # --- 2. CONVERSION ---
+    st.subheader("🔀 Stage-to-Stage Conversion")
+    df_conv = pd.DataFrame(data['conversion'])
+    if not df_conv.empty:
+        df_conv['conversion_pct'] = pd.to_numeric(df_conv['conversion_pct'], errors='coerce').round(1)
+        st.dataframe(df_conv, use_container_width=True, hide_index=True)
+    else:
+        st.caption("No stage transitions yet.")
+
+    # --- 3. WIN RATE ---
+    st.subheader("🏆 Win Rate by Pillar & Sales Group")
+    df_win = pd.DataFrame(data['win_rate'])
+    if not df_win.empty:
+        df_win = df_win.fillna({'won': 0, 'lost': 0})
+        df_win['win_rate_pct'] = pd.to_numeric(df_win['win_rate_pct'], errors='coerce').round(1)
+        st.dataframe(df_win, use_container_width=True, hide_index=True)
+    else:
+        st.caption("No closed opportunities yet.")
@@ -0,0 +1,254 @@
+"""
+Antrian write lokal yang durable untuk submit form saat database tidak bisa dijangkau.
+
+Submit add_multi_line_opportunity / add_cps_opportunity lewat submit(): jika DB sedang down
+(circuit breaker open atau error transient setelah retry, lihat backend.is_unavailable),
+payload disimpan ke file SQLite lokal dan form user tidak hilang. Antrian di-replay berurutan
+(seq) saat DB kembali: otomatis dari app (render_write_queue_status di utils.py) atau manual:
+    python write_queue.py              # status antrian
+    python write_queue.py --replay     # replay sekarang (misal setelah maintenance window)
+
+Submission yang ditolak DB karena datanya (bukan karena down) tidak dihapus: payload-nya tetap
+disimpan di processed_submissions dan ditampilkan di sidebar, supaya user bisa memuatnya
+kembali ke form, memperbaiki lalu submit ulang (get_rejected / dismiss).
+
+Idempotent: setiap submit membawa submission_id, dan backend mencatatnya di tabel
+processed_submissions dalam transaksi yang sama dengan datanya
+(migrations/009_processed_submissions.sql). Replay ulang submission yang ternyata sudah
+tersimpan hanya mengembalikan response pertama, tidak membuat opportunity dobel.
+
+Lokasi file: env PRESALES_WRITE_QUEUE, atau di secrets.toml:
+    [write_queue]
+    path = "/var/lib/presales/write_queue.db"
+File ini per server; jika app berjalan di beberapa server, setiap server me-replay antriannya sendiri.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import streamlit as st
+
+import backend as db
+
+DEFAULT_QUEUE_PATH = "presales_write_queue.db"
+REPLAY_INTERVAL_SECONDS = 15   # jeda minimal antar replay otomatis (per proses)
+QUEUE_KINDS = ("add_multi_line_opportunity", "add_cps_opportunity")
+
+SCHEMA = [
+    # Payload tidak pernah diubah; baris pindah ke processed_submissions setelah di-replay
+    # (payload ikut dipindah jika ditolak, lihat replay)
+    """CREATE TABLE IF NOT EXISTS queued_submissions (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT, submission_id TEXT NOT NULL UNIQUE, kind TEXT NOT NULL,
+        label TEXT, submitted_by TEXT, payload TEXT NOT NULL, queued_at TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0, last_attempt_at TEXT, last_error TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS processed_submissions (
+        submission_id TEXT PRIMARY KEY, seq INTEGER, kind TEXT NOT NULL, label TEXT, submitted_by TEXT,
+        queued_at TEXT, processed_at TEXT NOT NULL, status INTEGER NOT NULL, message TEXT,
+        payload TEXT, dismissed_at TEXT
+    )""",
+]
+# Kolom yang ditambahkan setelah file antrian versi awal (file lama di-upgrade saat dibuka)
+ADDED_COLUMNS = {"processed_submissions": {"payload": "TEXT", "dismissed_at": "TEXT"}}
+
+_conn = None
+_conn_lock = threading.RLock()    # satu koneksi sqlite3 dipakai bersama antar thread sesi
+_replay_lock = threading.Lock()   # hanya satu replay berjalan per proses
+_last_replay_at = 0.0
+
+def _queue_path():
+    path = os.environ.get("PRESALES_WRITE_QUEUE", "").strip()
+    if path:
+        return path
+    try:
+        return st.secrets.get("write_queue", {}).get("path", DEFAULT_QUEUE_PATH)
+    except Exception:
+        return DEFAULT_QUEUE_PATH
+
+def _get_queue():
+    global _conn
+    if _conn is None:
+        with _conn_lock:
+            if _conn is None:
+                conn = sqlite3.connect(_queue_path(), check_same_thread=False, timeout=30, isolation_level=None)
+                conn.row_factory = sqlite3.Row
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=FULL")  # submit yang sudah diterima tidak boleh hilang
+                for ddl in SCHEMA:
+                    conn.execute(ddl)
+                for table, columns in ADDED_COLUMNS.items():
+                    existing = {r['name'] for r in conn.execute(f"PRAGMA table_info({table})")}
+                    for name, col_type in columns.items():
+                        if name not in existing:
+                            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {col_type}")
+                _conn = conn
+    return _conn
+
+def _execute(sql, params=()):
+    with _conn_lock:
+        return _get_queue().execute(sql, params).fetchall()
+
+def new_submission_id():
+    return uuid.uuid4().hex
+
+def pending_count():
+    return _execute("SELECT COUNT(*) FROM queued_submissions")[0][0]
+
+def get_pending():
+    """Submission yang masih menunggu replay, urut sesuai waktu submit."""
+    rows = _execute("""
+        SELECT seq, submission_id, kind, label, submitted_by, queued_at, attempts, last_attempt_at, last_error
+        FROM queued_submissions ORDER BY seq
+    """)
+    return [dict(r) for r in rows]
+
+def get_processed(limit=20):
+    """Submission antrian yang sudah di-replay (berhasil maupun ditolak DB), terbaru dulu."""
+    rows = _execute("""
+        SELECT submission_id, seq, kind, label, submitted_by, queued_at, processed_at, status, message
+        FROM processed_submissions ORDER BY processed_at DESC, seq DESC LIMIT ?
+    """, (int(limit),))
+    return [dict(r) for r in rows]
+
+def get_rejected():
+    """Submission yang ditolak DB saat replay dan belum di-dismiss user, lengkap dengan payload-nya."""
+    rows = _execute("""
+        SELECT submission_id, seq, kind, label, submitted_by, queued_at, processed_at, status, message, payload
+        FROM processed_submissions
+        WHERE status <> 200 AND payload IS NOT NULL AND dismissed_at IS NULL
+        ORDER BY seq
+    """)
+    return [{**dict(r), "payload": json.loads(r['payload'])} for r in rows]
+
+def dismiss(submission_id):
+    """Sembunyikan submission yang ditolak dari sidebar (payload tetap disimpan di file antrian)."""
+    _execute(
+        "UPDATE processed_submissions SET dismissed_at = ? WHERE submission_id = ?",
+        (datetime.now().isoformat(" "), submission_id)
+    )
+
+def _enqueue(kind, parent_data, lines, submission_id):
+    _execute("""
+        INSERT INTO queued_submissions (submission_id, kind, label, submitted_by, payload, queued_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (submission_id) DO NOTHING
+    """, (
+        submission_id, kind, parent_data.get('opportunity_name'), parent_data.get('presales_name'),
+        json.dumps({"parent_data": parent_data, "lines": lines}, default=str), datetime.now().isoformat(" ")
+    ))
+    return _execute("SELECT seq FROM queued_submissions WHERE submission_id = ?", (submission_id,))[0][0]
+
+def submit(kind, parent_data, lines, submission_id=None):
+    """
+    Simpan submission ke DB, atau antrekan jika DB sedang tidak bisa dijangkau.
+    Return kontrak backend biasa, plus status 202 + data {"submission_id", "seq"} jika diantrekan.
+    """
+    if kind not in QUEUE_KINDS:
+        return {"status": 400, "message": f"Unknown submission kind: {kind}"}
+    submission_id = submission_id or new_submission_id()
+
+    # Antrian lama harus masuk duluan supaya urutan submit tetap terjaga
+    if pending_count():
+        replay()
+    if not pending_count():
+        res = getattr(db, kind)(parent_data, lines, submission_id=submission_id)
+        if not db.is_unavailable(res):
+            return res
+
+    seq = _enqueue(kind, parent_data, lines, submission_id)
+    return {
+        "status": 202,
+        "message": f"Database is unavailable. Submission queued as #{seq} and will be saved automatically "
+                   f"when the database is back.",
+        "data": {"submission_id": submission_id, "seq": seq}
+    }
+
+def replay(max_items=None):
+    """
+    Replay antrian berurutan. Berhenti di item pertama yang gagal karena DB masih down
+    (urutan terjaga); item yang ditolak DB karena datanya (bukan karena down) dipindah ke
+    processed_submissions dengan status, pesan error & payload-nya supaya user bisa
+    memperbaiki dan submit ulang (get_rejected).
+    """
+    global _last_replay_at
+    if not _replay_lock.acquire(blocking=False):
+        return {"status": 409, "message": "Replay already running"}
+    try:
+        _last_replay_at = time.time()
+        saved = rejected = 0
+        for item in get_pending()[:max_items]:
+            row = _execute("SELECT payload FROM queued_submissions WHERE seq = ?", (item['seq'],))
+            if not row:
+                continue
+            payload = json.loads(row[0]['payload'])
+            res = getattr(db, item['kind'])(payload['parent_data'], payload['lines'], submission_id=item['submission_id'])
+            now = datetime.now().isoformat(" ")
+            if db.is_unavailable(res):
+                _execute("""
+                    UPDATE queued_submissions SET attempts = attempts + 1, last_attempt_at = ?, last_error = ?
+                    WHERE seq = ?
+                """, (now, res.get('message'), item['seq']))
+                break
+
+            with _conn_lock:
+                conn = _get_queue()
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("""
+                    INSERT OR REPLACE INTO processed_submissions
+                        (submission_id, seq, kind, label, submitted_by, queued_at, processed_at, status, message, payload)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (
+                    item['submission_id'], item['seq'], item['kind'], item['label'], item['submitted_by'],
+                    item['queued_at'], now, res['status'], res.get('message'),
+                    None if res['status'] == 200 else row[0]['payload']
+                ))
+                conn.execute("DELETE FROM queued_submissions WHERE seq = ?", (item['seq'],))
+                conn.execute("COMMIT")
+            if res['status'] == 200:
+                saved += 1
+            else:
+                rejected += 1
+
+        remaining = pending_count()
+        return {
+            "status": 200,
+            "message": f"Replayed {saved} queued submission(s), {rejected} rejected, {remaining} still pending.",
+            "data": {"saved": saved, "rejected": rejected, "pending": remaining}
+        }
+    finally:
+        _replay_lock.release()
+
+def replay_if_due():
+    """Replay otomatis dari rerun app: hanya jika ada antrian, DB tidak sedang open-circuit & sudah lewat jeda."""
+    if time.time() - _last_replay_at < REPLAY_INTERVAL_SECONDS or not pending_count():
+        return None
+    if db.get_db_health()["state"] == "open":
+        return None
+    return replay()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show or replay the local write queue")
+    parser.add_argument("--replay", action="store_true", help="replay queued submissions now")
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        print(replay()["message"])
+    for item in get_pending():
+        print(f"#{item['seq']:<5} {item['queued_at'][:19]}  {item['kind']:<28} {item['label'] or '-'}"
+              f"  attempts={item['attempts']}  {item['last_error'] or ''}")
+    for item in get_rejected():
+        print(f"#{item['seq']:<5} {item['queued_at'][:19]}  {item['kind']:<28} {item['label'] or '-'}"
+              f"  REJECTED  {item['message'] or ''}")
+    print(f"{pending_count()} submission(s) pending in {_queue_path()}")
+    return 1 if pending_count() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())